@@ -1,27 +1,87 @@
-from flask import Flask, jsonify, request
+import json
+import os
+from typing import Optional
+from flask import Flask, Response, jsonify, request, stream_with_context
 from flask_cors import CORS
+from serving import RequestTimeout, ServiceOverloaded, load_service
+from instrumentation import configure_from_env, metrics_registry
 
 app = Flask(__name__)
 CORS(app)
+# RAG_METRICS=prometheus serves /metrics, json logs every span to stderr, "prometheus,json" does both
+if os.environ.get("RAG_METRICS"):
+    configure_from_env(os.environ["RAG_METRICS"])
+# the RAGService (see serving.py) answering questions. With RAG_INDEX_PATH set the index is
+# loaded at import time, so `gunicorn --preload app:app` loads it once for all workers. A snapshot
+# root is checked for newly published snapshots every RAG_RELOAD_INTERVAL seconds.
+app.config["SERVICE"] = load_service(os.environ["RAG_INDEX_PATH"],
+                                     reload_interval=float(os.environ.get("RAG_RELOAD_INTERVAL", 30))
+                                     ) if os.environ.get("RAG_INDEX_PATH") else None
+
+
+def sse_event(data: dict, event: Optional[str] = None) -> str:
+    # tokens are JSON encoded so newlines inside them can't break the event framing
+    lines = [f"event: {event}"] if event else []
+    lines.append(f"data: {json.dumps(data)}")
+    return "\n".join(lines) + "\n\n"
 
 
-# TODO: IN PROGRESS
 # Endpoint to answer a user question
+# {"question": str, "session_id": str, "stream": bool} -> {"answer": str, "session_id": str}
+# the chat history is kept server side per session_id, a new session is started when it is missing.
+# With "stream": true the answer is sent as Server-Sent Events, one event per token.
 @app.route('/question', methods=['POST'])
 def answer_user_question():
     try:
         # Ensure the request contains JSON data
         data = request.get_json()
-        if not data or 'messages' not in data:
-            return jsonify({'error': 'Invalid request. Please provide conversation messages.'}), 400
+        if not data or 'question' not in data:
+            return jsonify({'error': 'Invalid request. Please provide a question.'}), 400
+
+        service = app.config["SERVICE"]
+        if service is None:
+            return jsonify({'error': 'No service is configured.'}), 503
+
+        if data.get('stream'):
+            tokens, session_id = service.ask_stream(data['question'], data.get('session_id'))
 
-        question = data['question']
+            def events():
+                yield sse_event({'session_id': session_id}, event='session')
+                try:
+                    for token in tokens:
+                        yield sse_event({'token': token})
+                except Exception as e:
+                    # the response has started, so timeouts and failed answers end the stream with an error event
+                    yield sse_event({'error': str(e)}, event='error')
+                    return
+                yield sse_event({}, event='done')
 
-        return jsonify({'answer': question}), 200
+            response = Response(stream_with_context(events()), mimetype='text/event-stream',
+                                headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+            # a client that disconnects before the first token never starts events(), closing the
+            # response still abandons the request
+            response.call_on_close(tokens.close)
+            return response
 
+        answer, session_id = service.ask(data['question'], data.get('session_id'))
+        return jsonify({'answer': answer, 'session_id': session_id}), 200
+
+    except ServiceOverloaded as e:
+        return jsonify({'error': str(e)}), 429, {'Retry-After': '1'}
+    except RequestTimeout as e:
+        return jsonify({'error': str(e)}), 504
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
+# Prometheus text exposition of the stage latencies, token counts and cache hit rates
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    registry = metrics_registry()
+    if registry is None:
+        return jsonify({'error': 'Metrics are not enabled, set RAG_METRICS=prometheus.'}), 404
+    return Response(registry.render_prometheus(), mimetype='text/plain; version=0.0.4')
+
+
 if __name__ == '__main__':
     app.run(debug=True, port=8000)
@@ -0,0 +1,45 @@
+import html
+import random
+from typing import List
+from document import Document
+
+# a small vocabulary so queries built from it match many pages, like questions about one docs site
+topics = ["faiss", "indexes", "embeddings", "retrieval", "sessions", "streaming", "crawling", "sitemaps",
+          "chunking", "caching", "latency", "workers", "queues", "prompts", "answers", "documents"]
+filler = ["the", "a", "of", "to", "and", "in", "is", "for", "with", "on", "by", "each", "when", "every"]
+
+
+def synthetic_docs(n: int, seed: int = 0, paragraphs: int = 4, words_per_paragraph: int = 60) -> List[Document]:
+    # the same seed always gives the same corpus, so runs on different releases index identical text
+    rng = random.Random(seed)
+    vocabulary = topics + filler
+    docs = []
+    for i in range(n):
+        content = "\n\n".join(" ".join(rng.choices(vocabulary, k=words_per_paragraph)) + "."
+                              for _ in range(paragraphs))
+        docs.append(Document(content=content, title=f"page {i}", source=f"https://example.com/{i}"))
+    return docs
+
+
+def synthetic_questions(n: int, seed: int = 0, words: int = 6) -> List[str]:
+    rng = random.Random(seed)
+    return [" ".join(rng.choices(topics, k=words)) + "?" for _ in range(n)]
+
+
+def render_html(doc: Document) -> str:
+    # a page shaped like a docs site, with the chrome clean_soup removes around the text it keeps
+    paragraphs = "\n".join(f"<p>{html.escape(paragraph)}</p>" for paragraph in doc.content.split("\n\n"))
+    return f"""<!DOCTYPE html>
+<html>
+<head><title>{html.escape(doc.title)}</title><meta charset="utf-8">
+<style>body {{ font-family: sans-serif; }}</style><script>window.analytics = [];</script></head>
+<body>
+<header><nav><ul><li><a href="/">Home</a></li><li><a href="/docs">Docs</a></li></ul></nav></header>
+<div class="content"><h1>{html.escape(doc.title)}</h1>
+{paragraphs}
+<ul><li><span>see also</span> <a href="{html.escape(doc.source)}" title="permalink">this page</a></li></ul>
+<img src="diagram.png" alt="diagram of {html.escape(doc.title)}"></div>
+<footer><form><input name="q"></form><p>footer text</p></footer>
+</body>
+</html>
+"""
@@ -0,0 +1,66 @@
+import hashlib
+import re
+import time
+from types import SimpleNamespace
+from typing import List
+import numpy as np
+
+# stand-ins for the OpenAI embedder and chat client, so the serving path can be load tested
+# offline with a controllable latency and without spending tokens
+
+
+class FakeEmbeddings:
+    """Deterministic hashed bag-of-words embeddings, texts sharing words end up close together."""
+
+    def __init__(self, dim: int = 256, latency: float = 0.0):
+        self.dim = dim
+        self.latency = latency
+
+    def embed(self, text: str) -> List[float]:
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for word in re.findall(r"\w+", text.lower()):
+            bucket = int.from_bytes(hashlib.blake2b(word.encode("utf-8"), digest_size=4).digest(), "little")
+            vector[bucket % self.dim] += 1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if self.latency:
+            time.sleep(self.latency)
+        return [self.embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        if self.latency:
+            time.sleep(self.latency)
+        return self.embed(text)
+
+
+class FakeChatClient:
+    """Mimics client.chat.completions.create, answering after `latency` seconds.
+
+    Streaming responses spread the same latency over `stream_chunks` chunks.
+    """
+
+    def __init__(self, latency: float = 0.05, answer: str = "This is a canned answer from the fake model.",
+                 stream_chunks: int = 8):
+        self.latency = latency
+        self.answer = answer
+        self.stream_chunks = stream_chunks
+        self.calls = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, model, messages, stream=False, **kwargs):
+        self.calls += 1
+        if stream:
+            return self.stream()
+        time.sleep(self.latency)
+        message = SimpleNamespace(content=self.answer)
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+    def stream(self):
+        words = self.answer.split(" ")
+        step = max(len(words) // self.stream_chunks, 1)
+        for i in range(0, len(words), step):
+            time.sleep(self.latency / self.stream_chunks)
+            content = " ".join(words[i:i + step]) + (" " if i + step < len(words) else "")
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=content))])
@@ -0,0 +1,91 @@
+"""Compares the lxml extractor with the BeautifulSoup tag walk and measures pages/sec of both.
+
+Every saved page in benchmarks/fixtures/html is extracted with both engines. The lxml engine emits
+each text node once where the tag walk repeats it for every enclosing tag, so the texts can't be
+equal. They have to contain the same words, and the check fails otherwise.
+
+    python benchmarks/html_extraction_benchmark.py --pages 2000 --processes 0
+"""
+import argparse
+import json
+import re
+import sys
+import time
+from pathlib import Path
+
+root = Path(__file__).resolve().parent.parent
+for folder in ["", "loaders"]:
+    sys.path.insert(0, str(root / folder))
+
+from sitemap_loader import SitemapLoader  # noqa: E402
+from html_extractor import iter_extract_documents  # noqa: E402
+from corpus import render_html, synthetic_docs  # noqa: E402
+
+fixtures_dir = Path(__file__).resolve().parent / "fixtures" / "html"
+
+
+def words(text: str) -> set:
+    return set(re.findall(r"\w+", text.lower()))
+
+
+def compare_fixtures(soup_loader: SitemapLoader, lxml_loader: SitemapLoader) -> list:
+    rows = []
+    for path in sorted(fixtures_dir.glob("*.html")):
+        page = path.read_text(encoding="utf-8")
+        old = soup_loader.parse_html(page, path.name)
+        new = lxml_loader.parse_html(page, path.name)
+        missing, extra = words(old.content) - words(new.content), words(new.content) - words(old.content)
+        rows.append({
+            "fixture": path.name,
+            "matches": not missing and not extra and old.title == new.title,
+            "missing_words": sorted(missing),
+            "extra_words": sorted(extra),
+            "soup_chars": len(old.content),
+            "lxml_chars": len(new.content),
+            "soup_lines": old.content.count("\n") + 1,
+            "lxml_lines": new.content.count("\n") + 1,
+        })
+    return rows
+
+
+def throughput(name: str, parse, pages: list) -> dict:
+    start = time.perf_counter()
+    docs = parse(pages)
+    seconds = time.perf_counter() - start
+    return {"engine": name, "pages": len(docs), "seconds": round(seconds, 3),
+            "pages_per_second": round(len(docs) / seconds, 1),
+            "chars_out": sum(len(doc.content) for doc in docs)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, default=1000, help="pages parsed per engine")
+    parser.add_argument("--processes", type=int, default=0, help="pool size for the lxml pool run, 0 for all cores")
+    parser.add_argument("--output", default=None, help="JSON file to write, stdout when omitted")
+    args = parser.parse_args()
+
+    soup_loader = SitemapLoader(url="https://example.com", extractor="soup")
+    lxml_loader = SitemapLoader(url="https://example.com", extractor="lxml")
+    fixtures = compare_fixtures(soup_loader, lxml_loader)
+
+    # the fixtures and synthetic pages in turn, so both deep real-world markup and plain pages are measured
+    saved = [(path.read_text(encoding="utf-8"), path.name, None) for path in sorted(fixtures_dir.glob("*.html"))]
+    synthetic = [(render_html(doc), doc.source, None) for doc in synthetic_docs(max(args.pages // 2, 1))]
+    pages = [(saved + synthetic)[i % (len(saved) + len(synthetic))] for i in range(args.pages)]
+
+    runs = [
+        throughput("soup", lambda batch: [soup_loader.parse_html(*page) for page in batch], pages),
+        throughput("lxml", lambda batch: [lxml_loader.parse_html(*page) for page in batch], pages),
+        throughput("lxml_pool", lambda batch: list(iter_extract_documents(batch, processes=args.processes)), pages),
+    ]
+    report = {"fixtures": fixtures, "throughput": runs}
+    output = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(output)
+    else:
+        print(output)
+    sys.exit(0 if all(row["matches"] for row in fixtures) else 1)
+
+
+if __name__ == "__main__":
+    main()
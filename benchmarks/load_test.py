@@ -0,0 +1,110 @@
+"""Local load generator for the /question endpoint.
+
+Builds a small index with fake embeddings, serves it through app.py with a fake chat model and
+fires concurrent requests through Flask's test client, then reports latency percentiles and QPS.
+
+    python benchmarks/load_test.py --requests 2000 --concurrency 64 --llm-latency 0.05
+"""
+import argparse
+import json
+import random
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+root = Path(__file__).resolve().parent.parent
+for folder in ["", "retrievers", "retrievers/vector_index", "retrievers/vector_database", "generators", "loaders"]:
+    sys.path.insert(0, str(root / folder))
+
+import numpy as np  # noqa: E402
+from serving import load_service  # noqa: E402
+from retriever import FAISSVectorIndex  # noqa: E402
+from app import app  # noqa: E402
+from context_builder import ContextBuilder  # noqa: E402
+from instrumentation import MetricsRegistry, set_instrumentation  # noqa: E402
+from fakes import FakeChatClient, FakeEmbeddings  # noqa: E402
+from corpus import synthetic_docs, synthetic_questions  # noqa: E402
+
+
+def run_client(client, questions, sessions, stream, results, lock):
+    for question in questions:
+        payload = {"question": question, "session_id": random.choice(sessions), "stream": stream}
+        start = time.perf_counter()
+        response = client.post("/question", json=payload)
+        # reading the body drains the whole stream, so streamed latency is time to the last token
+        body = response.get_data()
+        elapsed = time.perf_counter() - start
+        status = response.status_code
+        if stream and b"event: error" in body:
+            # a stream that times out has already sent its 200, the failure is in the last event
+            status = 504
+        with lock:
+            results.append((status, elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--sessions", type=int, default=100)
+    parser.add_argument("--docs", type=int, default=2000)
+    parser.add_argument("--llm-latency", type=float, default=0.05)
+    parser.add_argument("--max-workers", type=int, default=16)
+    parser.add_argument("--max-queue", type=int, default=64)
+    parser.add_argument("--timeout", type=float, default=10.0)
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument("--metrics", action="store_true", help="report where the time went, stage by stage")
+    args = parser.parse_args()
+    registry = MetricsRegistry() if args.metrics else None
+    set_instrumentation(registry)
+
+    embedder = FakeEmbeddings()
+    with tempfile.TemporaryDirectory() as index_path:
+        FAISSVectorIndex.from_documents(synthetic_docs(args.docs, paragraphs=1), split_docs=False,
+                                        embedder=embedder).save_local(index_path)
+        # the estimating token counter, so no tokenizer files have to be downloaded
+        service = load_service(index_path, embedder=embedder, client=FakeChatClient(latency=args.llm_latency),
+                               context_builder=ContextBuilder(encoding_name=None), max_workers=args.max_workers, max_queue=args.max_queue,
+                               request_timeout=args.timeout)
+    app.config["SERVICE"] = service
+
+    questions = synthetic_questions(args.requests)
+    sessions = [f"session-{i}" for i in range(args.sessions)]
+    results, lock = [], threading.Lock()
+    threads = [threading.Thread(target=run_client,
+                                args=(app.test_client(), questions[i::args.concurrency], sessions, args.stream,
+                                      results, lock))
+               for i in range(args.concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+    service.close()
+
+    ok = np.array([elapsed for status, elapsed in results if status == 200])
+    report = {
+        "requests": len(results),
+        "ok": int(len(ok)),
+        "rejected": sum(status == 429 for status, _ in results),
+        "timed_out": sum(status == 504 for status, _ in results),
+        "errors": sum(status not in (200, 429, 504) for status, _ in results),
+        "qps": round(len(ok) / wall, 1),
+        "p50_ms": round(float(np.percentile(ok, 50)) * 1000, 1) if len(ok) else None,
+        "p99_ms": round(float(np.percentile(ok, 99)) * 1000, 1) if len(ok) else None,
+        "sessions_live": len(service.sessions),
+    }
+    if registry is not None:
+        # mean milliseconds per call of every span, summed over its label values
+        report["stages_ms"] = {
+            name[:-len("_seconds")]: round(1000 * sum(h["sum"] for h in series.values())
+                                           / max(sum(h["count"] for h in series.values()), 1), 3)
+            for name, series in sorted(registry.snapshot()["histograms"].items()) if name.endswith("_seconds")}
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+"""Offline benchmark of every stage of the RAG pipeline.
+
+Generates a synthetic corpus, renders it to HTML and times each stage on its own: HTML parsing with
+SitemapLoader.parse_html, splitting, index building, save_local/load_local, retrieval at several k
+and the full answer_user_question path. Embeddings and the chat model are the deterministic fakes
+from fakes.py, so nothing is fetched or billed and the same seed always measures the same work.
+
+    python benchmarks/pipeline_benchmark.py --sizes 1000 10000 --ks 1 5 20 --output bench.json
+    python benchmarks/pipeline_benchmark.py --output new.json --baseline bench.json
+
+Peak memory is the process high-water RSS during each stage, FAISS's own buffers included. On
+linux the high-water mark is reset before every stage, elsewhere it only ever grows across the run.
+--trace-python-memory also reports the peak of Python allocations (tracemalloc), which makes
+allocation heavy stages several times slower, so its timings shouldn't be compared with a plain run.
+"""
+import argparse
+import contextlib
+import gc
+import json
+import platform
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+root = Path(__file__).resolve().parent.parent
+for folder in ["", "retrievers", "retrievers/vector_index", "retrievers/vector_database", "generators", "loaders"]:
+    sys.path.insert(0, str(root / folder))
+
+import faiss  # noqa: E402
+import numpy as np  # noqa: E402
+# retriever and generator have to be imported before their backends, see the note in each module
+from retriever import FAISSVectorIndex  # noqa: E402
+from generator import generator_types  # noqa: E402
+from index_factory import IndexSpec  # noqa: E402
+from text_splitters import DocumentSplitter  # noqa: E402
+from context_builder import ContextBuilder  # noqa: E402
+from sitemap_loader import SitemapLoader  # noqa: E402
+from fakes import FakeChatClient, FakeEmbeddings  # noqa: E402
+from corpus import render_html, synthetic_docs, synthetic_questions  # noqa: E402
+
+
+def reset_peak_rss():
+    # writing 5 to clear_refs resets VmHWM, so each stage reports its own peak and not the run's
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss_mb() -> float:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    # ru_maxrss is in kilobytes on linux and in bytes on macOS
+    scale = 2 ** 20 if sys.platform == "darwin" else 1024
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale, 1)
+
+
+def measure(fn, trace_memory: bool = False):
+    # (fn's result, timing and memory of the call)
+    gc.collect()
+    reset_peak_rss()
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    result = fn()
+    seconds = time.perf_counter() - start
+    peak = None
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    stats = {
+        "seconds": round(seconds, 4),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    if peak is not None:
+        stats["peak_python_mb"] = round(peak / 2 ** 20, 2)
+    return result, stats
+
+
+def timed_calls(fn, inputs):
+    # per call latencies of fn over inputs, so percentiles can be reported next to the total
+    results, latencies = [], []
+    for item in inputs:
+        start = time.perf_counter()
+        results.append(fn(item))
+        latencies.append(time.perf_counter() - start)
+    return results, np.array(latencies) * 1000
+
+
+def latency_stats(latencies_ms) -> dict:
+    return {"p50_ms": round(float(np.percentile(latencies_ms, 50)), 3),
+            "p99_ms": round(float(np.percentile(latencies_ms, 99)), 3)}
+
+
+def folder_bytes(path: Path) -> int:
+    return sum(f.stat().st_size for f in path.rglob("*") if f.is_file())
+
+
+def benchmark_size(args, size: int, work_dir: Path) -> list:
+    rows = []
+
+    def record(stage, stats, items, **extra):
+        row = {"stage": stage, "docs": size, "items": items, **stats, **extra}
+        if items and stats["seconds"]:
+            row["items_per_second"] = round(items / stats["seconds"], 1)
+        rows.append(row)
+        print(json.dumps(row), file=sys.stderr)
+
+    docs = synthetic_docs(size, seed=args.seed)
+    questions = synthetic_questions(args.queries, seed=args.seed)
+    embedder = FakeEmbeddings(dim=args.dim, latency=args.embed_latency)
+
+    # pages are written to disk first and read back during the stage, like a crawl saved for replay
+    html_dir = work_dir / f"html_{size}"
+    html_dir.mkdir()
+    pages = []
+    for i, doc in enumerate(docs[:args.html_pages]):
+        page = html_dir / f"{i}.html"
+        page.write_text(render_html(doc), encoding="utf-8")
+        pages.append((page, doc.source))
+    loader = SitemapLoader(url="https://example.com")
+    _, stats = measure(lambda: [loader.parse_html(page.read_text(encoding="utf-8"), source)
+                                for page, source in pages], args.trace_memory)
+    record("parse_html", stats, len(pages), html_bytes=folder_bytes(html_dir))
+
+    splitter = DocumentSplitter(chunk_size=args.chunk_size, chunk_overlap=args.chunk_overlap)
+    chunks, stats = measure(lambda: splitter.split_documents(docs), args.trace_memory)
+    record("split_documents", stats, len(docs), chunks=len(chunks))
+
+    index_spec = IndexSpec(kind=args.index_kind)
+    index, stats = measure(lambda: FAISSVectorIndex.from_documents(chunks, False, embedder, index_spec=index_spec,
+                                                                  search_mode=args.search_mode), args.trace_memory)
+    record("from_documents", stats, len(chunks), index=index_spec.factory_string(), search_mode=args.search_mode)
+
+    index_dir = work_dir / f"index_{size}"
+    _, stats = measure(lambda: index.save_local(index_dir), args.trace_memory)
+    record("save_local", stats, len(chunks), index_bytes=folder_bytes(index_dir))
+    index, stats = measure(lambda: FAISSVectorIndex.load_local(index_dir, embedder), args.trace_memory)
+    record("load_local", stats, len(chunks))
+
+    for k in args.ks:
+        # one warm-up query so the first call doesn't pay for page faults of the freshly mapped files
+        index.retrieve_similar_docs(questions[0], k)
+        (_, latencies), stats = measure(lambda: timed_calls(lambda q: index.retrieve_similar_docs(q, k), questions),
+                                        args.trace_memory)
+        record("retrieve_similar_docs", stats, len(questions), k=k, **latency_stats(latencies))
+
+    # the estimating token counter, so no tokenizer files have to be downloaded
+    generator = generator_types["openai"](retriever=index, client=FakeChatClient(latency=args.llm_latency),
+                                          context_builder=ContextBuilder(encoding_name=None))
+    (answers, latencies), stats = measure(
+        lambda: timed_calls(lambda q: generator.answer_user_question(q, []), questions), args.trace_memory)
+    failed = [answer for answer in answers if answer.startswith("Question failed")]
+    if failed:
+        raise RuntimeError(f"answer_user_question failed: {failed[0]}")
+    record("answer_user_question", stats, len(questions), **latency_stats(latencies))
+    return rows
+
+
+def compare(rows: list, baseline_rows: list, threshold: float) -> list:
+    # the stages that got slower than threshold times their time in the baseline run
+    key = lambda row: (row["stage"], row["docs"], row.get("k"))  # noqa: E731
+    baseline = {key(row): row for row in baseline_rows}
+    regressions = []
+    for row in rows:
+        before = baseline.get(key(row))
+        if before is None or not before["seconds"]:
+            continue
+        row["baseline_seconds"] = before["seconds"]
+        row["change"] = round(row["seconds"] / before["seconds"], 3)
+        if row["change"] > threshold:
+            regressions.append(row)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000], help="documents per corpus")
+    parser.add_argument("--ks", type=int, nargs="+", default=[1, 5, 20])
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--html-pages", type=int, default=500, help="pages parsed per corpus size")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    parser.add_argument("--chunk-overlap", type=int, default=100)
+    parser.add_argument("--index-kind", default="flat")
+    parser.add_argument("--search-mode", default="dense")
+    parser.add_argument("--embed-latency", type=float, default=0.0, help="seconds per fake embedding call")
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="seconds per fake completion")
+    parser.add_argument("--trace-python-memory", dest="trace_memory", action="store_true")
+    parser.add_argument("--label", default=None, help="e.g. the release being measured")
+    parser.add_argument("--output", default=None, help="JSON file to write, stdout when omitted")
+    parser.add_argument("--baseline", default=None, help="an earlier --output to compare against")
+    parser.add_argument("--regression-threshold", type=float, default=1.2)
+    args = parser.parse_args()
+
+    rows = []
+    # the loaders, splitters and indexes print their progress, stdout is kept for the JSON report
+    with tempfile.TemporaryDirectory() as work_dir, contextlib.redirect_stdout(sys.stderr):
+        for size in args.sizes:
+            rows.extend(benchmark_size(args, size, Path(work_dir)))
+
+    report = {
+        "label": args.label,
+        "config": vars(args),
+        "environment": {"python": platform.python_version(), "platform": platform.platform(),
+                        "numpy": np.__version__, "faiss": faiss.__version__},
+        "results": rows,
+    }
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(rows, json.load(f)["results"], args.regression_threshold)
+        report["regressions"] = [{"stage": row["stage"], "docs": row["docs"], "k": row.get("k"),
+                                  "change": row["change"]} for row in regressions]
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(output)
+    else:
+        print(output)
+    for row in regressions:
+        print(f"Regression: {row['stage']} on {row['docs']} docs took {row['change']}x the baseline time.",
+              file=sys.stderr)
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
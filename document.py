@@ -1,22 +1,351 @@
-from pydantic import BaseModel
-from typing import Optional, Dict
+import hashlib
+import json
+import os
+import numpy as np
+from pathlib import Path
+from pydantic import BaseModel, PrivateAttr
+from typing import Any, Dict, Iterable, List, Optional, Tuple
 
 
 class Document(BaseModel):
     content: str
     title: Optional[str] = None
     source: Optional[str] = None
+    # character offsets of a chunk within the content of the page it was split from
+    start_index: Optional[int] = None
+    end_index: Optional[int] = None
+
+
+class ScoredDocument(BaseModel):
+    document: Document
+    # higher is better: negated L2 distance or inner product, BM25 score or fused reciprocal rank score
+    score: float
+    # docstore row id, which is also the FAISS id
+    id: int
+
+
+# on disk layout written by DocStore.save:
+#   docstore.blob        - the JSON encoded documents back to back
+#   docstore.offsets.npy - int64 byte offsets, row i spans offsets[i]:offsets[i + 1] of the blob
+#   docstore.meta.json   - the row count and the deleted row ids
+#   docstore.sources.npy - the source -> row ids index, loaded memory-mapped (see FieldIndex)
+#   docstore.titles.npy  - the same for titles
+DOCSTORE_BLOB = "docstore.blob"
+DOCSTORE_OFFSETS = "docstore.offsets.npy"
+DOCSTORE_META = "docstore.meta.json"
+# {filter field -> file of its index}
+DOCSTORE_FIELDS = {"source": "docstore.sources.npy", "title": "docstore.titles.npy"}
+# written by DocStore.spill, the blob alone: the offsets of spilled rows stay in memory
+DOCSTORE_SPILL = "docstore.spill"
+
+
+def key_hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+class FieldIndex:
+    """{field value -> row ids} of the first rows of a store, as sorted 64-bit key hashes and CSR row ids.
+
+    Saved as a single int64 array [groups, rows, hashes, indptr, ids], so loading maps it instead of
+    parsing it. Group i holds the row ids ids[indptr[i]:indptr[i + 1]] of one value, groups are sorted
+    by hash and values whose hashes collide get a group each, told apart by reading their first row.
+    """
+
+    def __init__(self, rows: int = 0, hashes=None, indptr=None, ids=None):
+        # the rows [0, rows) the index covers
+        self.rows = rows
+        self.hashes = np.zeros(0, dtype=np.uint64) if hashes is None else hashes
+        self.indptr = np.zeros(1, dtype=np.int64) if indptr is None else indptr
+        self.ids = np.zeros(0, dtype=np.int64) if ids is None else ids
+
+    def groups(self, key: str) -> range:
+        # the groups whose hash matches key, one unless hashes collide
+        h = np.uint64(key_hash(key))
+        return range(int(np.searchsorted(self.hashes, h, "left")), int(np.searchsorted(self.hashes, h, "right")))
+
+    def group_ids(self, group: int) -> np.ndarray:
+        return self.ids[self.indptr[group]:self.indptr[group + 1]]
+
+    def to_array(self) -> np.ndarray:
+        return np.concatenate([np.array([len(self.hashes), self.rows], dtype=np.int64),
+                               self.hashes.view(np.int64), self.indptr, self.ids])
+
+    @classmethod
+    def from_array(cls, array: np.ndarray) -> 'FieldIndex':
+        groups, rows = int(array[0]), int(array[1])
+        return cls(rows, array[2:groups + 2].view(np.uint64), array[groups + 2:2 * groups + 3],
+                   array[2 * groups + 3:])
 
 
 class DocStore(BaseModel):
-    # {UUID -> Document}
-    mapping: Dict[str, Document] = {}
+    """Append-only store of documents addressed by integer row ids.
+
+    Row ids are handed out in insertion order and line up with the FAISS ids. Rows loaded from
+    disk are read lazily from a memory-mapped blob, rows added since then are kept in memory.
+    """
+    _offsets: Any = PrivateAttr(default=None)
+    _blob: Any = PrivateAttr(default=None)
+    # rows [0, _mapped_rows) come from the blob, the rest from _docs
+    _mapped_rows: int = PrivateAttr(default=0)
+    _docs: List[Document] = PrivateAttr(default_factory=list)
+    _deleted: set = PrivateAttr(default_factory=set)
+    # {field -> FieldIndex} of the rows [0, _indexed_rows) as of the last save or load, deleted rows
+    # are only dropped from it by the next save
+    _indexed_rows: int = PrivateAttr(default=0)
+    _field_index: Dict[str, FieldIndex] = PrivateAttr(default_factory=dict)
+    # {source -> row ids} of the rows added since, documents without a source are filed under ""
+    _source_ids: Dict[str, List[int]] = PrivateAttr(default_factory=dict)
+    # {title -> row ids}, same for titles
+    _title_ids: Dict[str, List[int]] = PrivateAttr(default_factory=dict)
+    # where the store was last saved, so the next save there only appends the new rows
+    _saved_blob: Any = PrivateAttr(default=None)
+    _saved_offsets: Any = PrivateAttr(default=None)
+    # (device, inode) of the file _blob maps
+    _mapped_file: Any = PrivateAttr(default=None)
+
+    def __len__(self) -> int:
+        return self._mapped_rows + len(self._docs)
+
+    def add(self, documents: Iterable[Document]) -> List[int]:
+        start = len(self)
+        self._docs.extend(documents)
+        ids = list(range(start, len(self)))
+        for _id in ids:
+            doc = self._docs[_id - self._mapped_rows]
+            self._source_ids.setdefault(doc.source or "", []).append(_id)
+            self._title_ids.setdefault(doc.title or "", []).append(_id)
+        return ids
+
+    def search(self, id: int) -> Document:
+        id = int(id)
+        if id in self._deleted or not 0 <= id < len(self):
+            raise KeyError(f"No document with id {id}")
+        return self.row(id)
+
+    def row(self, id: int) -> Document:
+        # the document of a row, deleted or not
+        if id >= self._mapped_rows:
+            return self._docs[id - self._mapped_rows]
+        start, end = self._offsets[id], self._offsets[id + 1]
+        return Document(**json.loads(bytes(self._blob[start:end])))
+
+    def delete(self, ids: Iterable[int]):
+        for _id in ids:
+            doc = self.search(_id)
+            self._deleted.add(int(_id))
+            if int(_id) < self._indexed_rows:
+                continue
+            for key, field_ids in ((doc.source or "", self._source_ids), (doc.title or "", self._title_ids)):
+                field_ids[key].remove(int(_id))
+                if not field_ids[key]:
+                    del field_ids[key]
+
+    def ids_for_sources(self, sources: Iterable[Optional[str]]) -> List[int]:
+        return self.ids_for_field("source", sources)
+
+    def ids_for_field(self, field: str, values: Iterable[Optional[str]]) -> List[int]:
+        if field not in DOCSTORE_FIELDS:
+            raise ValueError(f"Unsupported filter field: {field}")
+        pending = self._source_ids if field == "source" else self._title_ids
+        ids = []
+        for value in values:
+            key = value or ""
+            group = self.indexed_group(field, key)
+            if group is not None:
+                ids.extend(_id for _id in self._field_index[field].group_ids(group).tolist()
+                           if _id not in self._deleted)
+            ids.extend(pending.get(key, []))
+        return ids
+
+    def field_key(self, field: str, id: int) -> str:
+        doc = self.row(int(id))
+        return (doc.source if field == "source" else doc.title) or ""
+
+    def indexed_group(self, field: str, key: str) -> Optional[int]:
+        # the group of key in the saved index, checked against its first row so a colliding hash never matches
+        index = self._field_index.get(field)
+        if index is None:
+            return None
+        for group in index.groups(key):
+            if self.field_key(field, index.ids[index.indptr[group]]) == key:
+                return group
+        return None
+
+    def build_field_index(self, field: str) -> FieldIndex:
+        # the saved index of field merged with the rows added since, without deleted rows
+        index = self._field_index.get(field) or FieldIndex()
+        pending = self._source_ids if field == "source" else self._title_ids
+        hashes = [index.hashes]
+        group_of = [np.repeat(np.arange(len(index.hashes), dtype=np.int64), np.diff(index.indptr))]
+        ids = [np.asarray(index.ids, dtype=np.int64)]
+        for key, key_ids in pending.items():
+            group = self.indexed_group(field, key)
+            if group is None:
+                group = len(index.hashes) + len(hashes) - 1
+                hashes.append(np.array([key_hash(key)], dtype=np.uint64))
+            group_of.append(np.full(len(key_ids), group, dtype=np.int64))
+            ids.append(np.array(key_ids, dtype=np.int64))
+        hashes, group_of, ids = np.concatenate(hashes), np.concatenate(group_of), np.concatenate(ids)
+        if self._deleted:
+            live = ~np.isin(ids, np.fromiter(self._deleted, dtype=np.int64, count=len(self._deleted)))
+            group_of, ids = group_of[live], ids[live]
+        # groups sorted by hash, their row ids ascending, groups left empty by deletes dropped
+        rank = np.empty(len(hashes), dtype=np.int64)
+        order = np.argsort(hashes, kind="stable")
+        rank[order] = np.arange(len(hashes))
+        group_of = rank[group_of]
+        by_group = np.lexsort((ids, group_of))
+        counts = np.bincount(group_of, minlength=len(hashes))
+        kept = counts > 0
+        indptr = np.zeros(int(kept.sum()) + 1, dtype=np.int64)
+        np.cumsum(counts[kept], out=indptr[1:])
+        return FieldIndex(len(self), hashes[order][kept], indptr, ids[by_group])
+
+    def save(self, folder_path) -> None:
+        path = Path(folder_path)
+        path.mkdir(exist_ok=True, parents=True)
+        blob_path = path / DOCSTORE_BLOB
+        offsets = np.zeros(len(self) + 1, dtype=np.int64)
+
+        tmp_blob = None
+        if self._saved_blob is not None and self._saved_blob == self.file_id(blob_path):
+            # saving back to the same blob file only appends the rows added since
+            persisted = len(self._saved_offsets) - 1
+            offsets[:persisted + 1] = self._saved_offsets
+            self.write_rows(blob_path, offsets, persisted, append=True)
+        else:
+            # a new file swapped in rather than truncating the old one, which may be hard-linked into a
+            # checkpoint or mapped, and a crash before the swap leaves the previous save as it was
+            tmp_blob = path / (DOCSTORE_BLOB + ".tmp")
+            self.write_rows(tmp_blob, offsets, 0, append=False)
+
+        # rows are only ever read through the offsets and the row count in the meta file, which is
+        # swapped in last, so a crash halfway through appending leaves the previous save readable
+        tmp_offsets = path / (DOCSTORE_OFFSETS + ".tmp")
+        with open(tmp_offsets, "wb") as f:
+            np.save(f, offsets)
+        if tmp_blob is not None:
+            os.replace(tmp_blob, blob_path)
+        os.replace(tmp_offsets, path / DOCSTORE_OFFSETS)
+        field_index = {field: self.build_field_index(field) for field in DOCSTORE_FIELDS}
+        for field, file_name in DOCSTORE_FIELDS.items():
+            tmp_index = path / (file_name + ".tmp")
+            with open(tmp_index, "wb") as f:
+                np.save(f, field_index[field].to_array())
+            os.replace(tmp_index, path / file_name)
+        meta = {"rows": len(self), "deleted": sorted(self._deleted)}
+        self.write_atomic(path / DOCSTORE_META, json.dumps(meta).encode("utf-8"))
+        self._saved_blob = self.file_id(blob_path)
+        self._saved_offsets = offsets
+        # the rows indexed so far move from the dicts into the arrays just saved
+        self._field_index = field_index
+        self._indexed_rows = len(self)
+        self._source_ids, self._title_ids = {}, {}
+
+    def write_rows(self, blob_path: Path, offsets: np.ndarray, persisted: int, append: bool):
+        # writes rows [persisted, len(self)) after the first persisted rows of the blob and fills in their offsets
+        with open(blob_path, "r+b" if append else "wb") as f:
+            f.seek(int(offsets[persisted]))
+            f.truncate()
+            position = int(offsets[persisted])
+            for _id in range(persisted, len(self)):
+                data = self.serialize(_id)
+                f.write(data)
+                position += len(data)
+                offsets[_id + 1] = position
+
+    def spill(self, folder_path) -> None:
+        """Moves the rows kept in memory to a blob in folder_path and reads them from there from now on.
+
+        Called every few batches while a large corpus is indexed, so memory holds 8 bytes of offset
+        per row instead of its text. Only the first spill to a folder copies the rows already mapped
+        from elsewhere, later ones append. The folder is scratch space to keep while the store is in
+        use, save writes a loadable copy.
+        """
+        if not self._docs:
+            return
+        path = Path(folder_path)
+        path.mkdir(exist_ok=True, parents=True)
+        blob_path = path / DOCSTORE_SPILL
+        offsets = np.zeros(len(self) + 1, dtype=np.int64)
+        if self._mapped_file is not None and self._mapped_file == self.file_id(blob_path):
+            offsets[:self._mapped_rows + 1] = self._offsets
+            self.write_rows(blob_path, offsets, self._mapped_rows, append=True)
+        else:
+            # written next to the old spill and swapped in, the store may still be reading that one
+            tmp_blob = path / (DOCSTORE_SPILL + ".tmp")
+            self.write_rows(tmp_blob, offsets, 0, append=False)
+            os.replace(tmp_blob, blob_path)
+        self._mapped_rows = len(self)
+        self._offsets = offsets
+        self._docs = []
+        self.map_blob(blob_path)
+
+    def release_saved(self, folder_path) -> None:
+        # once every row is saved in folder_path, reads them from there instead of from memory
+        blob_path = Path(folder_path) / DOCSTORE_BLOB
+        if not self._docs or self._saved_blob is None or self._saved_blob != self.file_id(blob_path):
+            return
+        if len(self._saved_offsets) - 1 != len(self):
+            return
+        self._mapped_rows = len(self)
+        self._offsets = self._saved_offsets
+        self._docs = []
+        self.map_blob(blob_path)
+
+    def map_blob(self, blob_path: Path):
+        self._blob = np.memmap(blob_path, dtype=np.uint8, mode="r") if self._offsets[-1] > 0 else None
+        self._mapped_file = self.file_id(blob_path)
+
+    @staticmethod
+    def file_id(path: Path):
+        # identifies the file itself, a directory that was renamed or recreated won't match
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return stat.st_dev, stat.st_ino
+
+    def serialize(self, id: int) -> bytes:
+        if id >= self._mapped_rows:
+            return json.dumps(self._docs[id - self._mapped_rows].dict()).encode("utf-8")
+        # deleted rows are copied too so row ids stay aligned with the FAISS ids
+        return bytes(self._blob[self._offsets[id]:self._offsets[id + 1]])
 
-    def add(self, mapping: Dict[str, Document]):
-        overlap = set(mapping).intersection(self.mapping)
-        if overlap:
-            raise ValueError(f"IDs already exist in map: {overlap}")
-        self.mapping = {**self.mapping, **mapping}
+    @staticmethod
+    def write_atomic(path: Path, data: bytes):
+        tmp_path = path.with_name(path.name + ".tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
 
-    def search(self, id):
-        return self.mapping[id]
+    @classmethod
+    def load(cls, folder_path) -> 'DocStore':
+        path = Path(folder_path)
+        with open(path / DOCSTORE_META, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        store = cls()
+        store._mapped_rows = meta["rows"]
+        store._offsets = np.load(path / DOCSTORE_OFFSETS, mmap_mode="r")[:store._mapped_rows + 1]
+        store._saved_blob = cls.file_id(path / DOCSTORE_BLOB)
+        store._saved_offsets = np.array(store._offsets)
+        store.map_blob(path / DOCSTORE_BLOB)
+        store._deleted = set(meta["deleted"])
+        field_index = {}
+        for field, file_name in DOCSTORE_FIELDS.items():
+            if (path / file_name).exists():
+                index = FieldIndex.from_array(np.load(path / file_name, mmap_mode="r"))
+                # left over from a save that crashed before its meta file was written otherwise
+                if index.rows == store._mapped_rows:
+                    field_index[field] = index
+        if len(field_index) == len(DOCSTORE_FIELDS):
+            store._field_index = field_index
+            store._indexed_rows = store._mapped_rows
+        else:
+            # older stores and ones without a usable index are scanned once
+            for _id in range(store._mapped_rows):
+                if _id not in store._deleted:
+                    doc = store.row(_id)
+                    store._source_ids.setdefault(doc.source or "", []).append(_id)
+                    store._title_ids.setdefault(doc.title or "", []).append(_id)
+        return store
@@ -0,0 +1,104 @@
+import re
+from functools import lru_cache
+from typing import List, Optional, Set, Tuple
+from pydantic import BaseModel
+import tiktoken
+from document import Document
+from instrumentation import count, observe
+
+# placed between chunks in the prompt, matches utils.format_docs
+DOC_SEPARATOR = "\n\n"
+
+
+@lru_cache(maxsize=None)
+def get_encoding(encoding_name: str):
+    # loading an encoding parses its BPE ranks, so it is done once per process
+    return tiktoken.get_encoding(encoding_name)
+
+
+def shingles(text: str, size: int = 3) -> Set[Tuple[str, ...]]:
+    words = re.findall(r"\w+", text.lower())
+    if len(words) < size:
+        return {tuple(words)}
+    return {tuple(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+def jaccard(a: Set, b: Set) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def format_turn(human_turn: str, ai_turn: str) -> str:
+    return f"user: {human_turn}\nassistant: {ai_turn}"
+
+
+class ContextBuilder(BaseModel):
+    """Fits retrieved chunks and the chat history into fixed token budgets.
+
+    Tokens are counted with the tiktoken encoding named by encoding_name, None falls back to a
+    ~4 characters per token estimate and needs no tokenizer files.
+    """
+    encoding_name: Optional[str] = "cl100k_base"
+    max_context_tokens: int = 3000
+    max_history_tokens: int = 1000
+    # chunks whose word 3-shingles overlap an already packed chunk at least this much are dropped
+    duplicate_threshold: float = 0.8
+
+    def count_tokens(self, text: str) -> int:
+        if self.encoding_name is None:
+            return len(text) // 4 + 1
+        return len(get_encoding(self.encoding_name).encode_ordinary(text))
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        if self.encoding_name is None:
+            return text[:max_tokens * 4]
+        encoding = get_encoding(self.encoding_name)
+        return encoding.decode(encoding.encode_ordinary(text)[:max_tokens])
+
+    def pack(self, docs: List[Document]) -> List[Document]:
+        # docs come best first from the retriever, that order is kept. A chunk that doesn't fit is
+        # skipped rather than ending the packing, so a shorter one further down can still use the room.
+        budget = self.max_context_tokens
+        separator_tokens = self.count_tokens(DOC_SEPARATOR)
+        packed, packed_shingles = [], []
+        for doc in docs:
+            doc_shingles = shingles(doc.content)
+            if any(jaccard(doc_shingles, other) >= self.duplicate_threshold for other in packed_shingles):
+                count("context.dropped_chunks", reason="duplicate")
+                continue
+            tokens = self.count_tokens(doc.content) + (separator_tokens if packed else 0)
+            if tokens > budget:
+                if not packed:
+                    # the best chunk alone is over budget, a truncated copy beats an empty context
+                    packed.append(doc.model_copy(update={"content": self.truncate(doc.content, budget)}))
+                    packed_shingles.append(doc_shingles)
+                    budget = 0
+                else:
+                    count("context.dropped_chunks", reason="budget")
+                continue
+            packed.append(doc)
+            packed_shingles.append(doc_shingles)
+            budget -= tokens
+        observe("context.packed_tokens", self.max_context_tokens - budget)
+        return packed
+
+    def history_tokens(self, chat_history: List[Tuple[str, str]]) -> int:
+        return sum(self.count_tokens(format_turn(*turn)) for turn in chat_history)
+
+    def needs_compaction(self, chat_history: List[Tuple[str, str]]) -> bool:
+        return len(chat_history) > 1 and self.history_tokens(chat_history) > self.max_history_tokens
+
+    def split_history(self, chat_history: List[Tuple[str, str]]) -> Tuple[List[Tuple[str, str]],
+                                                                          List[Tuple[str, str]]]:
+        # (turns to fold into the summary, turns to keep verbatim). Once over budget the recent turns are
+        # cut down to half of it, so the summary is updated every few turns instead of on every turn.
+        if not self.needs_compaction(chat_history):
+            return [], list(chat_history)
+        keep, tokens = 1, self.count_tokens(format_turn(*chat_history[-1]))
+        while keep < len(chat_history):
+            tokens += self.count_tokens(format_turn(*chat_history[-keep - 1]))
+            if tokens > self.max_history_tokens // 2:
+                break
+            keep += 1
+        return list(chat_history[:-keep]), list(chat_history[-keep:])
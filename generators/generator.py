@@ -1,23 +1,58 @@
-from pydantic import BaseModel
+import asyncio
+from pydantic import BaseModel, Field
 from abc import ABC, abstractmethod
-from typing import List, Tuple, Optional
-from openai_generator import OpenAIGenerator
-from retrievers.retriever import Retriever
-
-generator_types = {
-    "openai": OpenAIGenerator
-}
+from typing import AsyncIterator, Iterator, List, Tuple, Optional
+from retriever import Retriever
+from context_builder import ContextBuilder
 
 
 class Generator(ABC, BaseModel):
     retriever: Retriever
     standalone: bool = True
     system_prompt: Optional[str] = None
+    # token budgets for the retrieved context and the verbatim part of the chat history
+    context_builder: ContextBuilder = Field(default_factory=ContextBuilder)
 
     @abstractmethod
-    def answer_user_question(self, query: str, chat_history: List[Tuple[str, str]]) -> str:
+    def answer_user_question(self, query: str, chat_history: List[Tuple[str, str]], summary: str = "") -> str:
+        # summary condenses the turns that came before chat_history, see summarize_chat_history
         pass
 
+    def answer_user_question_stream(self, query: str, chat_history: List[Tuple[str, str]],
+                                    summary: str = "") -> Iterator[str]:
+        # generators that can stream tokens should override this
+        yield self.answer_user_question(query, chat_history, summary)
+
+    def generate_answer(self, query: str, chat_history: List[Tuple[str, str]], summary: str = "") -> str:
+        # like answer_user_question, but a failure raises instead of being answered with its message,
+        # so callers that keep the chat history can tell the two apart
+        return self.answer_user_question(query, chat_history, summary)
+
+    def generate_answer_stream(self, query: str, chat_history: List[Tuple[str, str]],
+                               summary: str = "") -> Iterator[str]:
+        yield from self.answer_user_question_stream(query, chat_history, summary)
+
+    async def aanswer_user_question(self, query: str, chat_history: List[Tuple[str, str]], summary: str = "") -> str:
+        # generators without an async client run the blocking call on a worker thread
+        return await asyncio.to_thread(self.answer_user_question, query, chat_history, summary)
+
+    async def aanswer_user_question_stream(self, query: str, chat_history: List[Tuple[str, str]],
+                                           summary: str = "") -> AsyncIterator[str]:
+        yield await self.aanswer_user_question(query, chat_history, summary)
+
+    def summarize_chat_history(self, summary: str, turns: List[Tuple[str, str]]) -> str:
+        # folds turns into the running summary. Generators that can call a model should override this,
+        # the base class keeps the old summary and the turns are dropped.
+        return summary
+
+
+# the backends subclass Generator from this module, so they can only be imported once it is defined
+from openai_generator import OpenAIGenerator  # noqa: E402
+
+generator_types = {
+    "openai": OpenAIGenerator
+}
+
 
 def get_generator(retriever: Retriever, generator_type: str = "openai"):
     generator_class = generator_types.get(generator_type)
@@ -1,9 +1,17 @@
-from typing import List, Tuple, Optional
-from openai import OpenAI
+import asyncio
+import time
+from typing import Any, AsyncIterator, Callable, Iterator, List, Tuple, Optional
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, OpenAI
+import httpx
+import numpy as np
 import utils
+from document import Document
 from generator import Generator
-from prompts import (standalone_question_prompt,
-                     standalone_question_answer_prompt, question_answer_prompt)
+from semantic_cache import SemanticCache, chunk_ids
+from context_builder import format_turn
+from instrumentation import count, observe, span
+from prompts import (standalone_question_prompt, standalone_question_answer_prompt,
+                     question_answer_prompt, chat_summary_prompt)
 
 MODELS = {
     "gpt3.5": "gpt-3.5-turbo-1106",
@@ -14,31 +22,58 @@ MODELS = {
 class OpenAIGenerator(Generator):
     # will get from os.environ.get("OPENAI_API_KEY") by default
     api_key: Optional[str] = None
+    # will get from os.environ.get("OPENAI_BASE_URL") by default, point it at a local fake server in tests
+    base_url: Optional[str] = None
+    client: Any = None
+    # one async client per generator, its connection pool is shared by every in-flight session.
+    # It is created on first use and bound to that event loop.
+    async_client: Any = None
+    max_connections: int = 200
+    # skips the final completion for near-identical standalone questions answered from the same chunks
+    semantic_cache: Optional[SemanticCache] = None
 
     def __init__(self, **data):
         super().__init__(**data)
-        self.create_client()
+        if self.client is None:
+            self.create_client()
 
     def create_client(self):
-        self.client = OpenAI(api_key=self.api_key)
+        self.client = OpenAI(api_key=self.api_key, base_url=self.base_url)
 
-    def format_chat_history(self, chat_history: List[Tuple[str, str]]) -> str:
-        buffer = ""
-        for human_turn, ai_turn in chat_history:
-            human = f"user: {human_turn}"
-            ai = f"assistant: {ai_turn}"
-            buffer += f"\n{human}\n{ai}"
-        return buffer
+    def get_async_client(self) -> AsyncOpenAI:
+        if self.async_client is None:
+            limits = httpx.Limits(max_connections=self.max_connections,
+                                  max_keepalive_connections=self.max_connections)
+            self.async_client = AsyncOpenAI(api_key=self.api_key, base_url=self.base_url,
+                                            http_client=DefaultAsyncHttpxClient(limits=limits))
+        return self.async_client
 
-    def call_openai(self, prompt: str, model: str = "gpt3.5") -> str:
+    def format_chat_history(self, chat_history: List[Tuple[str, str]], summary: str = "") -> str:
+        parts = [f"summary of the earlier conversation: {summary}"] if summary else []
+        parts.extend(format_turn(human_turn, ai_turn) for human_turn, ai_turn in chat_history)
+        return "\n".join(parts)
+
+    def summarize_chat_history(self, summary: str, turns: List[Tuple[str, str]]) -> str:
+        # only the turns that dropped out of the verbatim history are sent, never the whole conversation
+        new_lines = "\n".join(format_turn(human_turn, ai_turn) for human_turn, ai_turn in turns)
+        return self.call_openai(chat_summary_prompt.format(summary=summary or "(none)", new_lines=new_lines),
+                                purpose="summary")
+
+    def build_messages(self, prompt: str) -> List[dict]:
         messages = []
         if self.system_prompt:
             messages.append({"role": "system", "content": self.system_prompt})
         messages.append({"role": "user", "content": prompt})
-        response = self.client.chat.completions.create(
-            model=MODELS[model],
-            messages=messages
-        )
+        return messages
+
+    def call_openai(self, prompt: str, model: str = "gpt3.5", purpose: str = "answer") -> str:
+        # purpose labels the completion in the metrics: answer, standalone_rewrite or summary
+        with span("llm.completion", purpose=purpose, stream=False):
+            response = self.client.chat.completions.create(
+                model=MODELS[model],
+                messages=self.build_messages(prompt)
+            )
+        record_usage(response, purpose)
 
         try:
             answer = response.choices[0].message.content
@@ -49,28 +84,232 @@ class OpenAIGenerator(Generator):
 
         return answer
 
-    def answer_standalone_question(self, query: str, chat_history: str) -> str:
-        formatted_sq_prompt = standalone_question_prompt.format(chat_history=chat_history, question=query)
-        standalone_query = self.call_openai(formatted_sq_prompt)
-        relevant_docs = self.retriever.retrieve_similar_docs(standalone_query)
+    def call_openai_stream(self, prompt: str, model: str = "gpt3.5", purpose: str = "answer") -> Iterator[str]:
+        # timed by hand rather than with a span, the generator may be abandoned between two tokens
+        start, first_token = time.perf_counter(), True
+        stream = self.client.chat.completions.create(
+            model=MODELS[model],
+            messages=self.build_messages(prompt),
+            stream=True
+        )
+        for chunk in stream:
+            # the final chunk carries no choices when usage is reported, role-only deltas have no content
+            if chunk.choices and chunk.choices[0].delta.content:
+                if first_token:
+                    observe("llm.first_token_seconds", time.perf_counter() - start, purpose=purpose)
+                    first_token = False
+                yield chunk.choices[0].delta.content
+        observe("llm.completion_seconds", time.perf_counter() - start, purpose=purpose, stream=True)
+
+    def retrieve_standalone(self, query: str, chat_history: str) -> Tuple[str, List[Document], Optional[np.ndarray]]:
+        # (standalone question, packed context, the retriever's embedding of the question or None)
+        standalone_query = query
+        if chat_history:
+            # without any history there is nothing to fold into the question, so skip the rewrite call
+            formatted_sq_prompt = standalone_question_prompt.format(chat_history=chat_history, question=query)
+            standalone_query = self.call_openai(formatted_sq_prompt, purpose="standalone_rewrite")
+        return (standalone_query, *self.retrieve_context_with_vector(standalone_query))
+
+    def retrieve_context(self, query: str) -> List[Document]:
+        return self.retrieve_context_with_vector(query)[0]
+
+    def retrieve_context_with_vector(self, query: str) -> Tuple[List[Document], Optional[np.ndarray]]:
+        with span("generator.retrieve"):
+            docs, vector = self.retriever.retrieve_similar_docs_with_vector(query)
+        with span("generator.pack_context"):
+            return self.context_builder.pack(docs), vector
+
+    def format_standalone_prompt(self, standalone_query: str, relevant_docs: List[Document]) -> str:
+        context_str = utils.format_docs(relevant_docs)
+        return standalone_question_answer_prompt.format(context=context_str, question=standalone_query)
+
+    def build_standalone_prompt(self, query: str, chat_history: str) -> str:
+        standalone_query, relevant_docs, _ = self.retrieve_standalone(query, chat_history)
+        return self.format_standalone_prompt(standalone_query, relevant_docs)
+
+    def build_prompt(self, query: str, chat_history: str) -> str:
+        if self.standalone:
+            return self.build_standalone_prompt(query, chat_history)
+        relevant_docs = self.retrieve_context(query)
         context_str = utils.format_docs(relevant_docs)
-        formatted_sqa_prompt = standalone_question_answer_prompt.format(context=context_str, question=standalone_query)
+        return question_answer_prompt.format(chat_history=chat_history, context=context_str, question=query)
+
+    def answer_standalone_question(self, query: str, chat_history: str) -> str:
+        formatted_sqa_prompt = self.build_standalone_prompt(query, chat_history)
         answer = self.call_openai(formatted_sqa_prompt)
         return answer
 
-    def answer_user_question(self, query: str, chat_history: List[Tuple[str, str]]) -> str:
-        chat_history_str = self.format_chat_history(chat_history)
+    def cached_answer_stream(self, query: str, chat_history: str, call: Callable) -> Iterator[str]:
+        # the semantic cache sits in front of the final completion only. Answers in the
+        # non-standalone flow depend on the whole chat history, so they are never cached.
+        standalone_query, relevant_docs, query_vector = self.retrieve_standalone(query, chat_history)
+        vector, ids = self.cache_vector(standalone_query, query_vector), chunk_ids(relevant_docs)
+        answer = self.semantic_cache.lookup(vector, ids)
+        if answer is not None:
+            yield answer
+            return
+        start, parts = time.perf_counter(), []
+        for token in call(self.format_standalone_prompt(standalone_query, relevant_docs)):
+            parts.append(token)
+            yield token
+        self.semantic_cache.store(vector, ids, relevant_docs, "".join(parts), time.perf_counter() - start)
+
+    def generate_answer(self, query: str, chat_history: List[Tuple[str, str]], summary: str = "") -> str:
+        chat_history_str = self.format_chat_history(chat_history, summary)
+
+        with span("generator.answer") as answer_span:
+            try:
+                if self.standalone and self.semantic_cache is not None:
+                    return "".join(self.cached_answer_stream(query, chat_history_str,
+                                                             lambda prompt: [self.call_openai(prompt)]))
+                return self.call_openai(self.build_prompt(query, chat_history_str))
+            except Exception:
+                answer_span.set(failed=True)
+                count("generator.failures")
+                raise
+
+    def cache_vector(self, standalone_query: str, query_vector: Optional[np.ndarray]) -> np.ndarray:
+        # the retriever's embedding of the question is reused when the cache embeds with the same model
+        if query_vector is not None and self.semantic_cache.embedder is getattr(self.retriever, "embedder", None):
+            return self.semantic_cache.normalize(query_vector)
+        return self.semantic_cache.embed(standalone_query)
 
+    def answer_user_question(self, query: str, chat_history: List[Tuple[str, str]], summary: str = "") -> str:
         try:
-            if self.standalone:
-                answer = self.answer_standalone_question(query, chat_history_str)
+            return self.generate_answer(query, chat_history, summary)
+        except Exception as e:
+            return f"Question failed due to:\n {e.args[0]}"
+
+    def generate_answer_stream(self, query: str, chat_history: List[Tuple[str, str]],
+                               summary: str = "") -> Iterator[str]:
+        # the standalone rewrite still runs to completion, only the final answer is streamed
+        chat_history_str = self.format_chat_history(chat_history, summary)
+
+        if self.standalone and self.semantic_cache is not None:
+            yield from self.cached_answer_stream(query, chat_history_str, self.call_openai_stream)
+        else:
+            yield from self.call_openai_stream(self.build_prompt(query, chat_history_str))
+
+    def answer_user_question_stream(self, query: str, chat_history: List[Tuple[str, str]],
+                                    summary: str = "") -> Iterator[str]:
+        try:
+            yield from self.generate_answer_stream(query, chat_history, summary)
+        except Exception as e:
+            yield f"Question failed due to:\n {e.args[0]}"
+
+    async def acall_openai(self, prompt: str, model: str = "gpt3.5", purpose: str = "answer") -> str:
+        with span("llm.completion", purpose=purpose, stream=False):
+            response = await self.get_async_client().chat.completions.create(
+                model=MODELS[model],
+                messages=self.build_messages(prompt)
+            )
+        record_usage(response, purpose)
+
+        answer = response.choices[0].message.content
+        if answer is None:
+            raise ValueError(f"Chat completion for: {prompt}\n returned None.")
+        return answer
+
+    async def acall_openai_stream(self, prompt: str, model: str = "gpt3.5",
+                                  purpose: str = "answer") -> AsyncIterator[str]:
+        start, first_token = time.perf_counter(), True
+        stream = await self.get_async_client().chat.completions.create(
+            model=MODELS[model],
+            messages=self.build_messages(prompt),
+            stream=True
+        )
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                if first_token:
+                    observe("llm.first_token_seconds", time.perf_counter() - start, purpose=purpose)
+                    first_token = False
+                yield chunk.choices[0].delta.content
+        observe("llm.completion_seconds", time.perf_counter() - start, purpose=purpose, stream=True)
+
+    async def aretrieve_standalone(self, query: str,
+                                   chat_history: str) -> Tuple[str, List[Document], Optional[np.ndarray]]:
+        # retrieval for the raw question starts right away and runs alongside the rewrite call.
+        # Its result is used whenever the rewrite leaves the question unchanged.
+        speculative = asyncio.create_task(self.retriever.aretrieve_similar_docs_with_vector(query))
+        try:
+            standalone_query = query
+            if chat_history:
+                formatted_sq_prompt = standalone_question_prompt.format(chat_history=chat_history, question=query)
+                standalone_query = await self.acall_openai(formatted_sq_prompt, purpose="standalone_rewrite")
+            if normalize_question(standalone_query) == normalize_question(query):
+                count("generator.speculative_retrievals", used=True)
+                relevant_docs, query_vector = await speculative
             else:
-                relevant_docs = self.retriever.retrieve_similar_docs(query)
-                context_str = utils.format_docs(relevant_docs)
-                formatted_qa_prompt = question_answer_prompt.format(chat_history=chat_history_str,
-                                                                    context=context_str, question=query)
-                answer = self.call_openai(formatted_qa_prompt)
+                count("generator.speculative_retrievals", used=False)
+                speculative.cancel()
+                relevant_docs, query_vector = await self.retriever.aretrieve_similar_docs_with_vector(standalone_query)
+        except BaseException:
+            speculative.cancel()
+            raise
+        return standalone_query, self.context_builder.pack(relevant_docs), query_vector
+
+    async def abuild_prompt(self, query: str, chat_history: str) -> str:
+        if self.standalone:
+            standalone_query, relevant_docs, _ = await self.aretrieve_standalone(query, chat_history)
+            return self.format_standalone_prompt(standalone_query, relevant_docs)
+        relevant_docs = self.context_builder.pack(await self.retriever.aretrieve_similar_docs(query))
+        context_str = utils.format_docs(relevant_docs)
+        return question_answer_prompt.format(chat_history=chat_history, context=context_str, question=query)
+
+    async def acached_answer_stream(self, query: str, chat_history: str, call: Callable) -> AsyncIterator[str]:
+        standalone_query, relevant_docs, query_vector = await self.aretrieve_standalone(query, chat_history)
+        vector = await asyncio.to_thread(self.cache_vector, standalone_query, query_vector)
+        ids = chunk_ids(relevant_docs)
+        answer = self.semantic_cache.lookup(vector, ids)
+        if answer is not None:
+            yield answer
+            return
+        start, parts = time.perf_counter(), []
+        async for token in call(self.format_standalone_prompt(standalone_query, relevant_docs)):
+            parts.append(token)
+            yield token
+        self.semantic_cache.store(vector, ids, relevant_docs, "".join(parts), time.perf_counter() - start)
+
+    async def aanswer_user_question(self, query: str, chat_history: List[Tuple[str, str]],
+                                    summary: str = "") -> str:
+        chat_history_str = self.format_chat_history(chat_history, summary)
+
+        try:
+            if self.standalone and self.semantic_cache is not None:
+                answer = "".join([token async for token in self.acached_answer_stream(
+                    query, chat_history_str, self.acall_openai_once)])
+            else:
+                answer = await self.acall_openai(await self.abuild_prompt(query, chat_history_str))
         except Exception as e:
             answer = f"Question failed due to:\n {e.args[0]}"
 
         return answer
+
+    async def acall_openai_once(self, prompt: str) -> AsyncIterator[str]:
+        yield await self.acall_openai(prompt)
+
+    async def aanswer_user_question_stream(self, query: str, chat_history: List[Tuple[str, str]],
+                                           summary: str = "") -> AsyncIterator[str]:
+        chat_history_str = self.format_chat_history(chat_history, summary)
+
+        try:
+            if self.standalone and self.semantic_cache is not None:
+                tokens = self.acached_answer_stream(query, chat_history_str, self.acall_openai_stream)
+            else:
+                tokens = self.acall_openai_stream(await self.abuild_prompt(query, chat_history_str))
+            async for token in tokens:
+                yield token
+        except Exception as e:
+            yield f"Question failed due to:\n {e.args[0]}"
+
+
+def record_usage(response, purpose: str):
+    # token counts as billed, when the server reports them
+    usage = getattr(response, "usage", None)
+    if usage is not None:
+        count("llm.prompt_tokens", usage.prompt_tokens or 0, purpose=purpose)
+        count("llm.completion_tokens", usage.completion_tokens or 0, purpose=purpose)
+
+
+def normalize_question(question: str) -> str:
+    return " ".join(question.lower().split()).rstrip("?.! ")
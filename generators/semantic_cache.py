@@ -0,0 +1,141 @@
+import hashlib
+import threading
+import time
+import faiss
+import numpy as np
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional
+from pydantic import BaseModel, PrivateAttr
+from instrumentation import count
+from document import Document
+
+
+def chunk_ids(docs: List[Document]) -> List[str]:
+    # content addressed, so a chunk that changes on re-crawl gets a new id and stale answers stop matching
+    return sorted(hashlib.sha1(f"{doc.source}\0{doc.content}".encode("utf-8")).hexdigest() for doc in docs)
+
+
+class CacheEntry(BaseModel):
+    answer: str
+    chunk_ids: List[str]
+    sources: List[str]
+    created_at: float
+    completion_seconds: float
+
+
+class SemanticCache(BaseModel):
+    """Caches final answers keyed on the standalone question's embedding plus the retrieved chunk ids.
+
+    A lookup hits when a cached question is at least similarity_threshold (cosine) close and was
+    answered from exactly the same chunks, so the completion call can be skipped.
+    """
+    embedder: Any
+    similarity_threshold: float = 0.95
+    ttl_seconds: float = 24 * 60 * 60
+    max_entries: int = 10_000
+    # number of nearest cached questions checked for a matching chunk set
+    candidates: int = 4
+    hits: int = 0
+    misses: int = 0
+    latency_saved_seconds: float = 0.0
+
+    _index: Any = PrivateAttr(default=None)
+    _entries: Any = PrivateAttr(default=None)
+    _next_id: int = PrivateAttr(default=0)
+    _lock: Any = PrivateAttr(default=None)
+
+    def __init__(self, **data):
+        super().__init__(**data)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def metrics(self) -> Dict[str, float]:
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hit_rate,
+                "latency_saved_seconds": self.latency_saved_seconds, "entries": len(self._entries)}
+
+    def embed(self, question: str) -> np.ndarray:
+        return self.normalize(self.embedder.embed_query(question))
+
+    @staticmethod
+    def normalize(embedding) -> np.ndarray:
+        # a (1, dim) unit vector, embedding can also be the query vector the retriever already computed
+        vector = np.array(embedding, dtype=np.float32).reshape(1, -1)
+        faiss.normalize_L2(vector)
+        return vector
+
+    def lookup(self, vector: np.ndarray, ids: List[str]) -> Optional[str]:
+        with self._lock:
+            entry = self.lookup_locked(vector, ids)
+            if entry is None:
+                self.misses += 1
+                count("cache.misses", cache="semantic")
+                return None
+            self.hits += 1
+            count("cache.hits", cache="semantic")
+            self.latency_saved_seconds += entry.completion_seconds
+            return entry.answer
+
+    def lookup_locked(self, vector, ids) -> Optional[CacheEntry]:
+        if self._index is None or not self._entries:
+            return None
+        scores, entry_ids = self._index.search(vector, min(self.candidates, len(self._entries)))
+        now = time.time()
+        for score, entry_id in zip(scores[0], entry_ids[0]):
+            if entry_id == -1 or score < self.similarity_threshold:
+                break
+            entry = self._entries[int(entry_id)]
+            if now - entry.created_at > self.ttl_seconds:
+                self.remove([int(entry_id)])
+                continue
+            if entry.chunk_ids == ids:
+                self._entries.move_to_end(int(entry_id))
+                return entry
+        return None
+
+    def store(self, vector: np.ndarray, ids: List[str], docs: List[Document], answer: str,
+              completion_seconds: float):
+        with self._lock:
+            if self._index is None:
+                self._index = faiss.IndexIDMap2(faiss.IndexFlatIP(vector.shape[1]))
+            if len(self._entries) >= self.max_entries:
+                self.evict()
+            entry_id = self._next_id
+            self._next_id += 1
+            self._index.add_with_ids(vector, np.array([entry_id], dtype=np.int64))
+            self._entries[entry_id] = CacheEntry(answer=answer, chunk_ids=ids,
+                                                 sources=sorted({doc.source or "" for doc in docs}),
+                                                 created_at=time.time(), completion_seconds=completion_seconds)
+
+    def evict(self):
+        # drop expired entries, then the least recently used ones until there is room for one more
+        now = time.time()
+        expired = [entry_id for entry_id, entry in self._entries.items() if now - entry.created_at > self.ttl_seconds]
+        self.remove(expired)
+        overflow = len(self._entries) - self.max_entries + 1
+        if overflow > 0:
+            self.remove(list(self._entries)[:overflow])
+
+    def remove(self, entry_ids: List[int]):
+        if not entry_ids:
+            return
+        self._index.remove_ids(np.array(entry_ids, dtype=np.int64))
+        for entry_id in entry_ids:
+            del self._entries[entry_id]
+
+    def invalidate_sources(self, sources: Iterable[str]) -> int:
+        # call after re-indexing pages, every answer built from one of their chunks is dropped
+        sources = set(sources)
+        with self._lock:
+            stale = [entry_id for entry_id, entry in self._entries.items() if sources.intersection(entry.sources)]
+            self.remove(stale)
+        return len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._index = None
+            self._entries.clear()
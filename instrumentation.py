@@ -0,0 +1,302 @@
+import contextvars
+import json
+import random
+import sys
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# Spans, histograms and counters for every stage of the pipeline. Components call the module
+# functions span/observe/count, which forward to the installed Instrumentation. The default one
+# does nothing, so an uninstrumented process pays a function call per stage and nothing else.
+#
+#   with span("retriever.dense_search", mode="hybrid"):
+#       ...
+#   count("llm.prompt_tokens", usage.prompt_tokens)
+
+# upper bounds in seconds of the latency histogram buckets
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# upper bounds of every other histogram (tokens, bytes, documents), powers of 4 up to ~16M
+SIZE_BUCKETS = tuple(4 ** i for i in range(13))
+
+# (trace id, span id) of the innermost open span, per thread and per asyncio task
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+def new_id() -> str:
+    # 64 random bits, far cheaper than uuid4 and plenty to tell the spans of a process apart
+    return f"{random.getrandbits(64):016x}"
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def set(self, **labels):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Span:
+    __slots__ = ("instrumentation", "name", "labels", "trace_id", "span_id", "parent_id", "start", "_token")
+
+    def __init__(self, instrumentation: 'Instrumentation', name: str, labels: Dict[str, str]):
+        self.instrumentation = instrumentation
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        parent = _current_span.get()
+        self.trace_id = parent[0] if parent else new_id()
+        self.parent_id = parent[1] if parent else None
+        self.span_id = new_id()
+        self._token = _current_span.set((self.trace_id, self.span_id))
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self.start
+        _current_span.reset(self._token)
+        self.instrumentation.record_span(self, seconds, exc_type.__name__ if exc_type else None)
+        return False
+
+    def set(self, **labels):
+        # labels only known once the stage ran, e.g. whether a cache lookup hit
+        self.labels.update(labels)
+
+
+class Instrumentation:
+    """Does nothing, subclasses decide what spans, observations and counts turn into."""
+
+    def span(self, name: str, **labels):
+        return _NULL_SPAN
+
+    def observe(self, name: str, value: float, **labels):
+        pass
+
+    def count(self, name: str, value: float = 1, **labels):
+        pass
+
+    def record_span(self, span: Span, seconds: float, error: Optional[str]):
+        pass
+
+
+def label_key(labels: Dict) -> Tuple[Tuple[str, str], ...]:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def metric_name(name: str) -> str:
+    return "rag_" + name.replace(".", "_").replace("-", "_")
+
+
+def format_labels(labels: Tuple[Tuple[str, str], ...], extra: Sequence[Tuple[str, str]] = ()) -> str:
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + "}"
+
+
+class MetricsRegistry(Instrumentation):
+    """Keeps counters and histograms in memory and renders them in the Prometheus text format.
+
+    A span named "retriever.dense_search" is observed in the histogram rag_retriever_dense_search_seconds,
+    and counted in rag_retriever_dense_search_errors_total when it raised.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, Dict[tuple, float]] = {}
+        # name -> labels -> [bucket counts..., +Inf count, sum]
+        self._histograms: Dict[str, Dict[tuple, List[float]]] = {}
+
+    def span(self, name: str, **labels):
+        return Span(self, name, labels)
+
+    def record_span(self, span: Span, seconds: float, error: Optional[str]):
+        self.observe(span.name + "_seconds", seconds, **span.labels)
+        if error is not None:
+            self.count(span.name + "_errors", error=error, **span.labels)
+
+    @staticmethod
+    def buckets_for(name: str) -> Tuple[float, ...]:
+        return SECONDS_BUCKETS if name.endswith("_seconds") else SIZE_BUCKETS
+
+    def observe(self, name: str, value: float, **labels):
+        buckets = self.buckets_for(name)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            values = series.get(label_key(labels))
+            if values is None:
+                values = series[label_key(labels)] = [0.0] * (len(buckets) + 2)
+            # cumulative counts are computed when rendering, here only the first fitting bucket is bumped
+            values[bisect_left(buckets, value)] += 1
+            values[-1] += value
+
+    def count(self, name: str, value: float = 1, **labels):
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            key = label_key(labels)
+            series[key] = series.get(key, 0.0) + value
+
+    def counter_value(self, name: str, **labels) -> float:
+        with self._lock:
+            return self._counters.get(name, {}).get(label_key(labels), 0.0)
+
+    def snapshot(self) -> Dict[str, Dict]:
+        # {"counters": {name: {labels: value}}, "histograms": {name: {labels: {"count", "sum"}}}}, for tests
+        with self._lock:
+            counters = {name: {key: value for key, value in series.items()} for name, series in self._counters.items()}
+            histograms = {name: {key: {"count": sum(values[:-1]), "sum": values[-1]} for key, values in series.items()}
+                          for name, series in self._histograms.items()}
+        return {"counters": counters, "histograms": histograms}
+
+    def render_prometheus(self) -> str:
+        lines = []
+        with self._lock:
+            for name, series in sorted(self._counters.items()):
+                full_name = metric_name(name) + "_total"
+                lines.append(f"# TYPE {full_name} counter")
+                for key, value in sorted(series.items()):
+                    lines.append(f"{full_name}{format_labels(key)} {value!r}")
+            for name, series in sorted(self._histograms.items()):
+                full_name = metric_name(name)
+                buckets = self.buckets_for(name)
+                lines.append(f"# TYPE {full_name} histogram")
+                for key, values in sorted(series.items()):
+                    cumulative = 0.0
+                    for bound, bucket_count in zip(buckets, values):
+                        cumulative += bucket_count
+                        lines.append(f"{full_name}_bucket{format_labels(key, [('le', repr(bound))])} {cumulative!r}")
+                    total = cumulative + values[len(buckets)]
+                    lines.append(f"{full_name}_bucket{format_labels(key, [('le', '+Inf')])} {total!r}")
+                    lines.append(f"{full_name}_sum{format_labels(key)} {values[-1]!r}")
+                    lines.append(f"{full_name}_count{format_labels(key)} {total!r}")
+        return "\n".join(lines) + "\n"
+
+
+class JSONLogger(Instrumentation):
+    """Writes one JSON line per finished span, with trace and parent ids to reassemble each request."""
+
+    def __init__(self, stream=None, min_seconds: float = 0.0):
+        self.stream = stream or sys.stderr
+        # spans faster than this are not logged, keeps per-chunk stages out of the log
+        self.min_seconds = min_seconds
+        self._lock = threading.Lock()
+
+    def span(self, name: str, **labels):
+        return Span(self, name, labels)
+
+    def record_span(self, span: Span, seconds: float, error: Optional[str]):
+        if seconds < self.min_seconds and error is None:
+            return
+        record = {"ts": round(time.time(), 6), "span": span.name, "duration_ms": round(seconds * 1000, 3),
+                  "trace_id": span.trace_id, "span_id": span.span_id, "parent_id": span.parent_id}
+        if error is not None:
+            record["error"] = error
+        if span.labels:
+            record["labels"] = {key: str(value) for key, value in span.labels.items()}
+        line = json.dumps(record)
+        with self._lock:
+            self.stream.write(line + "\n")
+
+
+class Fanout(Instrumentation):
+    """Sends everything to several instrumentations, e.g. Prometheus metrics and JSON logs."""
+
+    def __init__(self, instrumentations: Sequence[Instrumentation]):
+        self.instrumentations = list(instrumentations)
+
+    def span(self, name: str, **labels):
+        return Span(self, name, labels)
+
+    def record_span(self, span: Span, seconds: float, error: Optional[str]):
+        for instrumentation in self.instrumentations:
+            instrumentation.record_span(span, seconds, error)
+
+    def observe(self, name: str, value: float, **labels):
+        for instrumentation in self.instrumentations:
+            instrumentation.observe(name, value, **labels)
+
+    def count(self, name: str, value: float = 1, **labels):
+        for instrumentation in self.instrumentations:
+            instrumentation.count(name, value, **labels)
+
+    def find(self, cls) -> Optional[Instrumentation]:
+        return next((instrumentation for instrumentation in self.instrumentations
+                     if isinstance(instrumentation, cls)), None)
+
+
+_instrumentation = Instrumentation()
+
+
+def get_instrumentation() -> Instrumentation:
+    return _instrumentation
+
+
+def set_instrumentation(instrumentation: Optional[Instrumentation]) -> Instrumentation:
+    # process wide, returns the previous one. None restores the no-op default.
+    global _instrumentation
+    previous = _instrumentation
+    _instrumentation = instrumentation or Instrumentation()
+    return previous
+
+
+@contextmanager
+def use_instrumentation(instrumentation: Instrumentation):
+    previous = set_instrumentation(instrumentation)
+    try:
+        yield instrumentation
+    finally:
+        set_instrumentation(previous)
+
+
+def metrics_registry() -> Optional[MetricsRegistry]:
+    # the registry behind /metrics, when one is installed
+    if isinstance(_instrumentation, MetricsRegistry):
+        return _instrumentation
+    if isinstance(_instrumentation, Fanout):
+        return _instrumentation.find(MetricsRegistry)
+    return None
+
+
+def configure_from_env(value: Optional[str]) -> Instrumentation:
+    # "prometheus", "json" or "prometheus,json", as given in RAG_METRICS
+    exporters = [name.strip() for name in (value or "").split(",") if name.strip()]
+    instrumentations = []
+    for exporter in exporters:
+        if exporter == "prometheus":
+            instrumentations.append(MetricsRegistry())
+        elif exporter == "json":
+            instrumentations.append(JSONLogger())
+        else:
+            raise ValueError(f"Unsupported metrics exporter: {exporter}")
+    if not instrumentations:
+        instrumentation = Instrumentation()
+    elif len(instrumentations) == 1:
+        instrumentation = instrumentations[0]
+    else:
+        instrumentation = Fanout(instrumentations)
+    set_instrumentation(instrumentation)
+    return instrumentation
+
+
+def span(name: str, **labels):
+    return _instrumentation.span(name, **labels)
+
+
+def observe(name: str, value: float, **labels):
+    _instrumentation.observe(name, value, **labels)
+
+
+def count(name: str, value: float = 1, **labels):
+    _instrumentation.count(name, value, **labels)
@@ -0,0 +1,130 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import Callable, Dict, Optional
+from urllib.parse import urlsplit
+from urllib.robotparser import RobotFileParser
+import httpx
+
+# helpers for SitemapLoader's async crawl mode: per-host throttling, a robots.txt cache and
+# a bounded pool of reusable Selenium drivers for the pages that actually need JavaScript
+
+
+def host_of(url: str) -> str:
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+class HostRateLimiter:
+    """Caps concurrent requests per host and spaces request starts by a minimum interval."""
+
+    def __init__(self, per_host_concurrency: int = 4, min_interval: float = 0.0):
+        self.per_host_concurrency = per_host_concurrency
+        self.min_interval = min_interval
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._next_start: Dict[str, float] = {}
+
+    @asynccontextmanager
+    async def slot(self, url: str, interval: Optional[float] = None):
+        host = host_of(url)
+        interval = self.min_interval if interval is None else max(interval, self.min_interval)
+        semaphore = self._semaphores.setdefault(host, asyncio.Semaphore(self.per_host_concurrency))
+        async with semaphore:
+            if interval > 0:
+                lock = self._locks.setdefault(host, asyncio.Lock())
+                async with lock:
+                    now = time.monotonic()
+                    start = max(now, self._next_start.get(host, now))
+                    self._next_start[host] = start + interval
+                if start > now:
+                    await asyncio.sleep(start - now)
+            yield
+
+
+class RobotsCache:
+    """Fetches and parses robots.txt once per host. Unreachable or missing files allow everything."""
+
+    def __init__(self, client: httpx.AsyncClient, user_agent: str):
+        self.client = client
+        self.user_agent = user_agent
+        self._parsers: Dict[str, Optional[RobotFileParser]] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+
+    async def _get_parser(self, url: str) -> Optional[RobotFileParser]:
+        host = host_of(url)
+        lock = self._locks.setdefault(host, asyncio.Lock())
+        async with lock:
+            if host not in self._parsers:
+                self._parsers[host] = await self._fetch(host)
+        return self._parsers[host]
+
+    async def _fetch(self, host: str) -> Optional[RobotFileParser]:
+        try:
+            response = await self.client.get(f"{host}/robots.txt")
+        except httpx.HTTPError:
+            return None
+        if response.status_code >= 400:
+            return None
+        parser = RobotFileParser()
+        parser.parse(response.text.splitlines())
+        return parser
+
+    async def allowed(self, url: str) -> bool:
+        parser = await self._get_parser(url)
+        return parser is None or parser.can_fetch(self.user_agent, url)
+
+    async def crawl_delay(self, url: str) -> Optional[float]:
+        parser = await self._get_parser(url)
+        if parser is None:
+            return None
+        delay = parser.crawl_delay(self.user_agent)
+        if delay is not None:
+            return float(delay)
+        rate = parser.request_rate(self.user_agent)
+        if rate is not None and rate.requests:
+            return rate.seconds / rate.requests
+        return None
+
+
+class DriverPool:
+    """Bounded pool of reusable web drivers. Drivers are created lazily and used from worker threads."""
+
+    def __init__(self, factory: Callable, size: int = 2):
+        self.factory = factory
+        self.size = size
+        self._idle: Optional[asyncio.Queue] = None
+        self._created = 0
+        self._drivers = []
+
+    async def __aenter__(self) -> 'DriverPool':
+        self._idle = asyncio.Queue()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        for driver in self._drivers:
+            try:
+                await asyncio.to_thread(driver.quit)
+            except Exception as e:
+                print(f"Error closing web driver: {e}")
+        self._drivers = []
+
+    async def _acquire(self):
+        if self._idle.empty() and self._created < self.size:
+            # count it before the await so concurrent callers don't overshoot the pool size
+            self._created += 1
+            try:
+                driver = await asyncio.to_thread(self.factory)
+            except BaseException:
+                self._created -= 1
+                raise
+            self._drivers.append(driver)
+            return driver
+        return await self._idle.get()
+
+    async def run(self, fn: Callable, *args, **kwargs):
+        driver = await self._acquire()
+        try:
+            return await asyncio.to_thread(fn, driver, *args, **kwargs)
+        finally:
+            self._idle.put_nowait(driver)
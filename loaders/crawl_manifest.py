@@ -0,0 +1,54 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Dict, List, Optional
+from pydantic import BaseModel
+from document import Document
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class ManifestEntry(BaseModel):
+    lastmod: Optional[str] = None
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    content_hash: Optional[str] = None
+
+    def conditional_headers(self) -> Dict[str, str]:
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class CrawlManifest(BaseModel):
+    # {URL -> ManifestEntry}
+    entries: Dict[str, ManifestEntry] = {}
+
+    @classmethod
+    def load(cls, path) -> 'CrawlManifest':
+        path = Path(path)
+        if not path.exists():
+            return cls()
+        with open(path, "r", encoding="utf-8") as f:
+            return cls(**json.load(f))
+
+    def save(self, path) -> None:
+        path = Path(path)
+        path.parent.mkdir(exist_ok=True, parents=True)
+        tmp_path = path.with_suffix(path.suffix + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"entries": {url: entry.dict() for url, entry in self.entries.items()}}, f)
+        # replace in one step so a crash never leaves a half written manifest behind
+        os.replace(tmp_path, path)
+
+
+class CrawlDiff(BaseModel):
+    changed: List[Document] = []
+    deleted: List[str] = []
+    unchanged: int = 0
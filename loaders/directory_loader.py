@@ -0,0 +1,176 @@
+import json
+import mmap
+import queue
+import re
+import threading
+from collections import deque
+from pathlib import Path
+from typing import Iterator, List, Optional
+from document import Document
+from loader import Loader
+from instrumentation import count, span
+
+# how each file suffix is read
+file_types = {".txt": "text", ".md": "markdown", ".markdown": "markdown", ".jsonl": "jsonl"}
+
+_END = object()
+
+
+class DirectoryLoader(Loader):
+    """Text, Markdown and JSONL files under a directory, read on a pool of threads.
+
+    Text and Markdown files are memory-mapped and cut into documents of at most max_document_bytes
+    at paragraph breaks, each with its character offset in the file as start_index, so a file of any
+    size is read a window at a time. JSONL files are read line by line, one document per record.
+    Documents come out in file name order whatever the number of threads.
+    """
+    path: str
+    # glob patterns relative to path
+    patterns: List[str] = ["**/*.txt", "**/*.md", "**/*.jsonl"]
+    # text files are cut at line breaks, so this has to be utf-8 or another ascii compatible encoding
+    encoding: str = "utf-8"
+    max_document_bytes: int = 1_000_000
+    # fields of a JSONL record, records without a source get "<file>#<line number>"
+    content_field: str = "content"
+    title_field: str = "title"
+    source_field: str = "source"
+    max_workers: int = 4
+    # documents each file being read may hold ahead of the consumer
+    prefetch: int = 64
+
+    def list_files(self) -> List[Path]:
+        root = Path(self.path)
+        if not root.is_dir():
+            raise ValueError(f"Not a directory: {self.path}")
+        files = sorted({path for pattern in self.patterns for path in root.glob(pattern) if path.is_file()})
+        for path in files:
+            if path.suffix.lower() not in file_types:
+                raise ValueError(f"Unsupported file type: {path}")
+        return files
+
+    def iter_documents(self) -> Iterator[Document]:
+        files = self.list_files()
+        stop = threading.Event()
+        tasks = queue.Queue()
+        # daemon threads rather than an executor, a generator that is dropped without being closed
+        # must not keep the interpreter from exiting
+        readers = [threading.Thread(target=self.reader, args=(tasks, stop), daemon=True)
+                   for _ in range(min(self.max_workers, len(files)))]
+        for reader in readers:
+            reader.start()
+        try:
+            pending = deque()
+            for path in files:
+                handoff = queue.Queue(maxsize=self.prefetch)
+                tasks.put((path, handoff))
+                pending.append(handoff)
+                # the next few files are read ahead while the oldest one is drained
+                if len(pending) > self.max_workers:
+                    yield from self.drain(pending.popleft())
+            while pending:
+                yield from self.drain(pending.popleft())
+        finally:
+            # readers blocked on a full queue give up once the consumer stops early
+            stop.set()
+            for _ in readers:
+                tasks.put(None)
+            for reader in readers:
+                reader.join()
+
+    def reader(self, tasks: queue.Queue, stop: threading.Event):
+        while True:
+            task = tasks.get()
+            if task is None or stop.is_set():
+                return
+            self.read_into(*task, stop)
+
+    def read_into(self, path: Path, handoff: queue.Queue, stop: threading.Event):
+        try:
+            with span("loader.read_file", kind=file_types[path.suffix.lower()]):
+                for doc in self.iter_file(path):
+                    if not self.put(handoff, doc, stop):
+                        return
+            item = _END
+        except Exception as e:
+            item = e
+        self.put(handoff, item, stop)
+
+    @staticmethod
+    def put(handoff: queue.Queue, item, stop: threading.Event) -> bool:
+        while not stop.is_set():
+            try:
+                handoff.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    @staticmethod
+    def drain(handoff: queue.Queue) -> Iterator[Document]:
+        while True:
+            item = handoff.get()
+            if item is _END:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def iter_file(self, path: Path) -> Iterator[Document]:
+        kind = file_types[path.suffix.lower()]
+        count("loader.files", kind=kind)
+        count("loader.read_bytes", path.stat().st_size, kind=kind)
+        if kind == "jsonl":
+            return self.iter_jsonl_file(path)
+        return self.iter_text_file(path, markdown=kind == "markdown")
+
+    def iter_text_file(self, path: Path, markdown: bool = False) -> Iterator[Document]:
+        if path.stat().st_size == 0:
+            return
+        title = None
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            start, chars = 0, 0
+            while start < len(data):
+                end = self.cut(data, start)
+                text = data[start:end].decode(self.encoding, errors="replace")
+                if title is None:
+                    title = (markdown and self.markdown_title(text)) or path.stem
+                if text.strip():
+                    yield Document(content=text, title=title, source=str(path), start_index=chars)
+                chars += len(text)
+                start = end
+
+    def cut(self, data: mmap.mmap, start: int) -> int:
+        # end of the document starting at start: the last paragraph break in the window, else the last
+        # line break, else the last whole utf-8 character
+        end = start + self.max_document_bytes
+        if end >= len(data):
+            return len(data)
+        for separator in (b"\n\n", b"\n"):
+            position = data.rfind(separator, start, end)
+            if position > start:
+                return position + len(separator)
+        while end > start + 1 and data[end] & 0xC0 == 0x80:
+            end -= 1
+        return end
+
+    @staticmethod
+    def markdown_title(text: str) -> Optional[str]:
+        match = re.search(r"^#\s+(.+?)\s*#*\s*$", text, re.MULTILINE)
+        return match.group(1) if match else None
+
+    def iter_jsonl_file(self, path: Path) -> Iterator[Document]:
+        with open(path, "r", encoding=self.encoding, errors="replace", buffering=2 ** 20) as f:
+            for line_no, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                    content = record[self.content_field]
+                except (json.JSONDecodeError, KeyError, TypeError) as e:
+                    # one bad record shouldn't fail a dump of millions
+                    print(f"Skipping line {line_no} of {path}: {e!r}")
+                    count("loader.errors", stage="jsonl")
+                    continue
+                title, source = record.get(self.title_field), record.get(self.source_field)
+                yield Document(content=str(content), title=str(title) if title is not None else None,
+                               source=str(source) if source is not None else f"{path}#{line_no}")
@@ -1,11 +1,19 @@
-from typing import List, Tuple, Optional
+from typing import Iterator, List, Tuple, Optional
 from document import Document
 from loader import Loader
 
 
 class GenericTextLoader(Loader):
     content: List[str]
+    # one per text when given, otherwise texts get no title and "text://<position>" as their source
+    titles: Optional[List[str]] = None
+    sources: Optional[List[str]] = None
 
-    def load_documents(self) -> List[Document]:
-        print("documents")
-
+    def iter_documents(self) -> Iterator[Document]:
+        for field, values in (("titles", self.titles), ("sources", self.sources)):
+            if values is not None and len(values) != len(self.content):
+                raise ValueError(f"Expected {len(self.content)} {field}, got {len(values)}")
+        for i, text in enumerate(self.content):
+            yield Document(content=text,
+                           title=self.titles[i] if self.titles is not None else None,
+                           source=self.sources[i] if self.sources is not None else f"text://{i}")
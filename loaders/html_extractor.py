@@ -0,0 +1,145 @@
+import json
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Iterator, List, Optional, Tuple
+from lxml import html as lxml_html
+from document import Document
+
+# single pass replacement for SitemapLoader.clean_soup + extract_text_from_soup, built on lxml
+
+# subtrees dropped entirely, the same tags clean_soup removes
+REMOVED_TAGS = frozenset(["script", "style", "head", "meta", "svg", "iframe", "nav", "footer", "form", "noscript",
+                          "header"])
+# each of these becomes its own line of text
+BLOCK_TAGS = frozenset(["p", "h1", "h2", "h3", "h4", "h5", "h6", "li", "div"])
+# these join the line of the block they are in, and only become a line of their own outside any block
+INLINE_TAGS = frozenset(["span", "a"])
+# these only start a new line inside one of the blocks above, text outside them is never extracted
+BREAK_TAGS = frozenset(["tr", "td", "th", "dt", "dd", "blockquote", "pre"])
+ATTRIBUTES = ("data-sheets-value", "alt", "title")
+
+parser = lxml_html.HTMLParser(encoding="utf-8")
+
+
+def attribute_text(value: str) -> str:
+    # google sheets cells keep their text in data-sheets-value as {"1": {"2": text}}
+    try:
+        json_content = json.loads(value)
+    except json.JSONDecodeError:
+        return value
+    if isinstance(json_content, dict) and isinstance(json_content.get("1"), dict) and "2" in json_content["1"]:
+        return json_content["1"]["2"]
+    return str(json_content)
+
+
+class _Block:
+    __slots__ = ("element", "parts", "attributes")
+
+    def __init__(self, element):
+        self.element = element
+        self.parts = []
+        self.attributes = []
+
+
+def parse(page_content: str):
+    # lxml rejects str input with an xml encoding declaration, bytes with an explicit encoding are fine
+    return lxml_html.document_fromstring(page_content.encode("utf-8"), parser=parser)
+
+
+def extract_title(root) -> Optional[str]:
+    title = root.find(".//title")
+    if title is None:
+        return None
+    return title.text_content().strip()
+
+
+def extract_text(root) -> str:
+    """Text of every block in document order, one line per block and each line only once.
+
+    Every text node is emitted once, as part of the innermost p/h1-h6/li/div around it, so nested
+    blocks don't repeat their children's text the way a get_text per matched tag does. The
+    data-sheets-value, alt and title attributes of the same tags follow their block's text.
+    """
+    lines, seen = [], set()
+
+    def emit(text):
+        if text and text not in seen:
+            seen.add(text)
+            lines.append(text)
+
+    def add_text(text):
+        if blocks and text:
+            text = text.strip()
+            if text:
+                blocks[-1].parts.append(text)
+
+    blocks: List[_Block] = []
+    # an explicit stack instead of recursion, deeply nested pages don't hit the recursion limit
+    stack = [(root, False)]
+    while stack:
+        node, closing = stack.pop()
+        if closing:
+            if blocks and blocks[-1].element is node:
+                block = blocks.pop()
+                emit(" ".join(block.parts))
+                for attribute in block.attributes:
+                    emit(attribute)
+            add_text(node.tail)
+            continue
+        tag = node.tag
+        if not isinstance(tag, str) or tag in REMOVED_TAGS:
+            # comments and removed subtrees still leave their tail text in the parent
+            add_text(node.tail)
+            continue
+        if tag in BLOCK_TAGS or (tag in INLINE_TAGS and not blocks) or (tag in BREAK_TAGS and blocks):
+            if blocks and blocks[-1].parts:
+                # text before a nested block is its own line, so the lines stay in document order
+                emit(" ".join(blocks[-1].parts))
+                blocks[-1].parts = []
+            blocks.append(_Block(node))
+        if blocks and (tag in BLOCK_TAGS or tag in INLINE_TAGS):
+            for attribute in ATTRIBUTES:
+                value = node.get(attribute)
+                if value:
+                    blocks[-1].attributes.append(attribute_text(value))
+        add_text(node.text)
+        stack.append((node, True))
+        stack.extend((child, False) for child in reversed(node))
+    return "\n".join(lines)
+
+
+def extract_document(page_content: str, url: str, page_title: Optional[str] = None) -> Document:
+    if not page_content.strip():
+        return Document(content="", title=page_title, source=url)
+    root = parse(page_content)
+    if page_title is None:
+        page_title = extract_title(root)
+    return Document(content=extract_text(root), title=page_title, source=url)
+
+
+def extract_batch(pages: List[Tuple[str, str, Optional[str]]]) -> List[Document]:
+    return [extract_document(*page) for page in pages]
+
+
+def iter_extract_documents(pages: Iterable[Tuple[str, str, Optional[str]]], processes: int = 0,
+                           batch_size: int = 64) -> Iterator[Document]:
+    # (page_content, url, title) in, documents out in the same order. 1 parses in this process and
+    # 0 uses every core, a couple of batches per worker are in flight so memory stays bounded.
+    if processes == 1:
+        yield from (extract_document(*page) for page in pages)
+        return
+    processes = processes or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        pending, batch = deque(), []
+        for page in pages:
+            batch.append(page)
+            if len(batch) >= batch_size:
+                pending.append(pool.submit(extract_batch, batch))
+                batch = []
+                if len(pending) >= 2 * processes:
+                    yield from pending.popleft().result()
+        if batch:
+            pending.append(pool.submit(extract_batch, batch))
+        while pending:
+            yield from pending.popleft().result()
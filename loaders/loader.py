@@ -1,6 +1,6 @@
 from pydantic import BaseModel
 from abc import ABC, abstractmethod
-from typing import List, Tuple, Optional
+from typing import Iterator, List, Tuple, Optional
 from document import Document
 
 
@@ -8,9 +8,13 @@ class Loader(ABC, BaseModel):
     # system_prompt: Optional[str] = None
 
     @abstractmethod
-    def load_documents(self) -> List[Document]:
+    def iter_documents(self) -> Iterator[Document]:
+        # documents one at a time, so they can be split and embedded without holding the whole corpus
         pass
 
+    def load_documents(self) -> List[Document]:
+        return list(self.iter_documents())
+
 
 # def get_generator(retriever: Retriever, generator_type: str = "openai"):
 #     generator_class = generator_types.get(generator_type)
@@ -1,4 +1,7 @@
+import asyncio
 import httpx
+import queue
+import threading
 import time
 import json
 import xml.etree.ElementTree as ET
@@ -9,15 +12,49 @@ from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.common.by import By
 from selenium.common.exceptions import TimeoutException
 from bs4 import BeautifulSoup
-from typing import List
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from pydantic import PrivateAttr
+from typing import Any, AsyncIterator, Callable, Iterator, List, Optional, Tuple
 from document import Document
 from loader import Loader
+from async_crawler import DriverPool, HostRateLimiter, RobotsCache
+from crawl_manifest import CrawlDiff, CrawlManifest, ManifestEntry, content_hash
+from html_extractor import extract_document
+from instrumentation import count, span
+
+crawl_modes = ["selenium", "async"]
+# lxml: single pass extraction in html_extractor. soup: the original BeautifulSoup tag walk, which
+# repeats the text of nested tags once per enclosing p/li/span/a/div
+extraction_engines = ["lxml", "soup"]
 
 
 class SitemapLoader(Loader):
     url: str
+    # "selenium" visits every page with one driver, "async" fetches static pages concurrently
+    # and only falls back to a pool of headless drivers for pages that need JavaScript
+    crawl_mode: str = "selenium"
+    max_connections: int = 64
+    per_host_concurrency: int = 4
+    min_request_interval: float = 0.0
+    respect_robots: bool = True
+    user_agent: str = "easy-rag"
+    request_timeout: float = 30.0
+    max_drivers: int = 2
+    js_post_load_sleep: float = 2
+    # pages whose static html yields less text than this (and that ship scripts) are rendered with Selenium
+    js_text_threshold: int = 200
+    extractor: str = "lxml"
+    # processes parsing pages during an async crawl, 1 parses on a thread of this process and 0 uses
+    # every core. Only the lxml extractor runs on the pool.
+    parse_processes: int = 1
+    # documents an async crawl queues ahead of its consumer, stream_documents queues as many again for
+    # its caller. Beyond that each of the max_connections workers waits with the page it fetched last.
+    prefetch: int = 64
 
-    def fetch_sitemap_urls(self, sitemap_url):
+    _parse_pool: Any = PrivateAttr(default=None)
+
+    def fetch_sitemap_entries(self, sitemap_url) -> List[Tuple[str, Optional[str]]]:
         if not sitemap_url.endswith('.xml'):
             sitemap_url += '/sitemap.xml'  # Append '/sitemap.xml' if not present
 
@@ -29,21 +66,29 @@ class SitemapLoader(Loader):
                 # Parse the XML content
                 root = ET.fromstring(response.content)
 
-                urls = [elem.text for elem in root.findall('.//{http://www.sitemaps.org/schemas/sitemap/0.9}loc')]
-
                 # If no URLs are found, try without the namespace
-                if not urls:
-                    urls = [elem.text for elem in root.findall('.//loc')]
+                entries = []
+                for ns in ('{http://www.sitemaps.org/schemas/sitemap/0.9}', ''):
+                    for parent in root.iter():
+                        loc = parent.find(f'{ns}loc')
+                        if loc is not None:
+                            lastmod = parent.find(f'{ns}lastmod')
+                            entries.append((loc.text, lastmod.text if lastmod is not None else None))
+                    if entries:
+                        break
 
-                if not urls:
+                if not entries:
                     raise ValueError("Could not parse sitemap format")
 
-                print(f"Found {len(urls)} URLs in sitemap: {sitemap_url}.")
-                return urls
+                print(f"Found {len(entries)} URLs in sitemap: {sitemap_url}.")
+                return entries
 
         except (httpx.RequestError, httpx.HTTPStatusError) as e:
             raise RuntimeError(f"Failed to fetch a sitemap at {sitemap_url}") from e
 
+    def fetch_sitemap_urls(self, sitemap_url):
+        return [url for url, _ in self.fetch_sitemap_entries(sitemap_url)]
+
     def initialize_driver(self, headless=False):
         options = Options()
         if headless:
@@ -104,30 +149,282 @@ class SitemapLoader(Loader):
         time.sleep(post_load_sleep)  # Additional wait for dynamic content
         return driver.page_source, page_title
 
+    def parse_html(self, page_content, url, page_title=None) -> Document:
+        with span("loader.parse", extractor=self.extractor):
+            if self.extractor == "lxml":
+                doc = extract_document(page_content, url, page_title)
+            else:
+                doc = self.parse_html_soup(page_content, url, page_title)
+        count("loader.extracted_chars", len(doc.content))
+        return doc
+
+    def parse_html_soup(self, page_content, url, page_title=None) -> Document:
+        if self.extractor != "soup":
+            raise ValueError(f"Unsupported extractor: {self.extractor}")
+        soup = BeautifulSoup(page_content, 'html.parser')
+        if page_title is None and soup.title is not None:
+            page_title = soup.title.get_text(strip=True)
+        soup = self.clean_soup(soup)  # Clean the soup to remove unnecessary tags
+        text = self.extract_text_from_soup(soup)
+        return Document(content=text, title=page_title, source=url)
+
     def process_url(self, driver, url, post_load_sleep=0):
         try:
             page_content, page_title = self.load_url(driver, url, post_load_sleep=post_load_sleep)
             if page_content is None:
                 return None
             else:
-                soup = BeautifulSoup(page_content, 'html.parser')
-                soup = self.clean_soup(soup)  # Clean the soup to remove unnecessary tags
-                text = self.extract_text_from_soup(soup)
-                doc = Document(content=text, title=page_title, source=url)
-                return doc
+                return self.parse_html(page_content, url, page_title=page_title)
         except Exception as e:
             print(f"Error processing URL {url}: {e}")
+            count("loader.errors", stage="render")
             return None
 
     def load_urls_with_sleep(self, urls, headless=False, post_load_sleep=5):
-        documents = []
+        return list(self.iter_urls_with_sleep(urls, headless=headless, post_load_sleep=post_load_sleep))
+
+    def iter_urls_with_sleep(self, urls, headless=False, post_load_sleep=5) -> Iterator[Document]:
         with self.initialize_driver(headless=headless) as driver:
             for url in urls:
                 doc = self.process_url(driver, url, post_load_sleep=post_load_sleep)
                 if doc:
-                    documents.append(doc)
-        return documents
+                    yield doc
+
+    def needs_javascript(self, page_content: str, doc: Document) -> bool:
+        return len(doc.content) < self.js_text_threshold and "<script" in page_content.lower()
+
+    async def fetch_page(self, client, url, limiter, robots, headers=None) -> Optional[httpx.Response]:
+        delay = None
+        if robots is not None:
+            if not await robots.allowed(url):
+                print(f"Skipping {url}: disallowed by robots.txt")
+                return None
+            delay = await robots.crawl_delay(url)
+
+        try:
+            async with limiter.slot(url, delay):
+                with span("loader.fetch"):
+                    response = await client.get(url, headers=headers)
+            count("loader.pages", status=response.status_code)
+            count("loader.fetched_bytes", len(response.content))
+            if response.status_code == 304:
+                return response
+            response.raise_for_status()
+        except (httpx.RequestError, httpx.HTTPStatusError) as e:
+            print(f"Error fetching URL {url}: {e}")
+            count("loader.errors", stage="fetch")
+            return None
+        return response
+
+    async def response_to_document(self, response, url, drivers) -> Optional[Document]:
+        if "html" not in response.headers.get("content-type", "text/html"):
+            return None
+        page_content = response.text
+        try:
+            # parsing is CPU bound, keep it off the event loop so other fetches progress
+            if self._parse_pool is not None:
+                with span("loader.parse", extractor="lxml_pool"):
+                    doc = await asyncio.get_running_loop().run_in_executor(self._parse_pool, extract_document,
+                                                                           page_content, url)
+                count("loader.extracted_chars", len(doc.content))
+            else:
+                doc = await asyncio.to_thread(self.parse_html, page_content, url)
+        except Exception as e:
+            print(f"Error processing URL {url}: {e}")
+            count("loader.errors", stage="parse")
+            return None
 
-    def load_documents(self) -> List[Document]:
+        if self.needs_javascript(page_content, doc):
+            rendered = await drivers.run(self.process_url, url, post_load_sleep=self.js_post_load_sleep)
+            if rendered is not None:
+                doc = rendered
+        return doc
+
+    async def crawl_url(self, client, url, limiter, robots, drivers) -> Optional[Document]:
+        response = await self.fetch_page(client, url, limiter, robots)
+        if response is None:
+            return None
+        return await self.response_to_document(response, url, drivers)
+
+    async def refresh_url(self, client, sitemap_entry, limiter, robots, drivers,
+                          manifest: CrawlManifest) -> Tuple[str, Optional[Document]]:
+        url, lastmod = sitemap_entry
+        entry = manifest.entries.get(url)
+        if entry is not None and lastmod and entry.lastmod == lastmod:
+            return "unchanged", None
+
+        headers = entry.conditional_headers() if entry is not None else None
+        response = await self.fetch_page(client, url, limiter, robots, headers=headers)
+        if response is None:
+            # keep whatever is indexed for this page, the next refresh will retry it
+            return "failed", None
+        if response.status_code == 304:
+            entry.lastmod = lastmod or entry.lastmod
+            return "unchanged", None
+
+        doc = await self.response_to_document(response, url, drivers)
+        if doc is None:
+            return "failed", None
+        new_entry = ManifestEntry(lastmod=lastmod, etag=response.headers.get("etag"),
+                                  last_modified=response.headers.get("last-modified"),
+                                  content_hash=content_hash(doc.content))
+        manifest.entries[url] = new_entry
+        if entry is not None and entry.content_hash == new_entry.content_hash:
+            return "unchanged", None
+        return "changed", doc
+
+    async def crawl(self, items: list, handler: Callable) -> AsyncIterator[Any]:
+        # runs handler(client, item, limiter, robots, drivers) over items with a bounded set of workers
+        # and yields every non-None result as soon as it is ready. At most prefetch results wait for the
+        # caller, beyond that each worker holds on to its result and stops fetching until there is room.
+        limiter = HostRateLimiter(per_host_concurrency=self.per_host_concurrency,
+                                  min_interval=self.min_request_interval)
+        limits = httpx.Limits(max_connections=self.max_connections,
+                              max_keepalive_connections=self.max_connections)
+        item_queue = asyncio.Queue()
+        for item in items:
+            item_queue.put_nowait(item)
+        results = asyncio.Queue()
+        # taken by a worker before it queues a result and given back once the caller took one, the
+        # done markers don't need room so a worker can always finish
+        room = asyncio.Semaphore(self.prefetch)
+        done = object()
+
+        async with httpx.AsyncClient(limits=limits, timeout=self.request_timeout, follow_redirects=True,
+                                     headers={"User-Agent": self.user_agent}) as client:
+            robots = RobotsCache(client, self.user_agent) if self.respect_robots else None
+            async with DriverPool(lambda: self.initialize_driver(headless=True), size=self.max_drivers) as drivers:
+
+                async def worker():
+                    try:
+                        while not item_queue.empty():
+                            item = item_queue.get_nowait()
+                            result = await handler(client, item, limiter, robots, drivers)
+                            if result is not None:
+                                await room.acquire()
+                                results.put_nowait(result)
+                    finally:
+                        results.put_nowait(done)
+
+                if self.parse_processes != 1 and self.extractor == "lxml":
+                    self._parse_pool = ProcessPoolExecutor(max_workers=self.parse_processes or None)
+                num_workers = max(1, min(self.max_connections, len(items)))
+                workers = [asyncio.create_task(worker()) for _ in range(num_workers)]
+                try:
+                    finished = 0
+                    while finished < num_workers:
+                        result = await results.get()
+                        if result is done:
+                            finished += 1
+                        else:
+                            room.release()
+                            yield result
+                    # surface worker errors instead of silently dropping pages
+                    for task in workers:
+                        task.result()
+                finally:
+                    for task in workers:
+                        task.cancel()
+                    await asyncio.gather(*workers, return_exceptions=True)
+                    if self._parse_pool is not None:
+                        self._parse_pool.shutdown(cancel_futures=True)
+                        self._parse_pool = None
+
+    async def aiter_documents(self, urls: List[str]) -> AsyncIterator[Document]:
+        async for doc in self.crawl(urls, self.crawl_url):
+            yield doc
+
+    def stream_documents(self, urls: List[str]) -> Iterator[Document]:
+        # runs the async crawl on a background event loop and hands documents over as they are parsed,
+        # so callers can start splitting/embedding before the crawl has finished
+        handoff = queue.Queue(maxsize=self.prefetch)
+        done = object()
+        stop = threading.Event()
+        loop = asyncio.new_event_loop()
+
+        def put(item) -> bool:
+            # blocks while the consumer is behind, gives up once it stopped reading
+            while not stop.is_set():
+                try:
+                    handoff.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        async def pump():
+            async for doc in self.aiter_documents(urls):
+                # waits on a worker thread rather than blocking the loop. While it waits the crawl isn't
+                # read, so its workers stop fetching once prefetch more results are queued
+                if not await asyncio.to_thread(put, doc):
+                    return
+
+        task = loop.create_task(pump())
+
+        def run():
+            try:
+                loop.run_until_complete(task)
+                put(done)
+            except BaseException as e:
+                put(e)
+            finally:
+                loop.run_until_complete(loop.shutdown_default_executor())
+                loop.close()
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = handoff.get()
+                if item is done:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            if thread.is_alive():
+                loop.call_soon_threadsafe(task.cancel)
+            thread.join()
+
+    def iter_documents(self) -> Iterator[Document]:
+        if self.crawl_mode not in crawl_modes:
+            raise ValueError(f"Unsupported crawl mode: {self.crawl_mode}")
         sitemap_urls = self.fetch_sitemap_urls(sitemap_url=self.url)
-        return self.load_urls_with_sleep(sitemap_urls)
+        if self.crawl_mode == "async":
+            yield from self.stream_documents(sitemap_urls)
+        else:
+            yield from self.iter_urls_with_sleep(sitemap_urls)
+
+    def refresh_documents(self, manifest: CrawlManifest) -> CrawlDiff:
+        # conditional requests need plain http, so refreshes always go through the async crawler.
+        # The manifest is updated in place; save it only once the index has applied the diff.
+        sitemap_entries = self.fetch_sitemap_entries(sitemap_url=self.url)
+        live_urls = {url for url, _ in sitemap_entries}
+        diff = CrawlDiff(deleted=[url for url in manifest.entries if url not in live_urls])
+
+        async def run():
+            async for status, doc in self.crawl(sitemap_entries, partial(self.refresh_url, manifest=manifest)):
+                if status == "changed":
+                    diff.changed.append(doc)
+                elif status == "unchanged":
+                    diff.unchanged += 1
+
+        asyncio.run(run())
+        for url in diff.deleted:
+            del manifest.entries[url]
+        print(f"Refreshed {len(sitemap_entries)} URLs: {len(diff.changed)} changed, "
+              f"{diff.unchanged} unchanged, {len(diff.deleted)} deleted.")
+        return diff
+
+    def refresh_index(self, index, manifest_path, split_docs=True, semantic_cache=None, **kwargs) -> CrawlDiff:
+        # index is any retriever with delete_documents/upsert_documents, e.g. FAISSVectorIndex
+        manifest = CrawlManifest.load(manifest_path)
+        diff = self.refresh_documents(manifest)
+        index.delete_documents(diff.deleted)
+        index.upsert_documents(diff.changed, split_docs=split_docs, **kwargs)
+        if semantic_cache is not None:
+            # answers built from pages that changed or disappeared are no longer valid
+            semantic_cache.invalidate_sources(diff.deleted + [doc.source for doc in diff.changed])
+        manifest.save(manifest_path)
+        return diff
@@ -26,3 +26,15 @@ Context:
 
 Question: {question}
 """
+
+chat_summary_prompt = """
+Progressively summarize the lines of conversation provided, adding onto the
+previous summary and returning a new summary. Keep names, facts and open questions.
+
+Current summary:
+{summary}
+
+New lines of conversation:
+{new_lines}
+
+New summary:"""
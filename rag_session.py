@@ -1,12 +1,77 @@
-from pydantic import BaseModel
-from typing import Optional, NamedTuple, List, Literal, Any, Tuple
-from retrievers.retriever import Retriever
-from generators.generator import Generator
+import threading
+import time
+from collections import OrderedDict
+from pydantic import BaseModel, PrivateAttr
+from typing import Any, Callable, List, Optional, Tuple
 
 
 class RAGSession(BaseModel):
-    retriever: Retriever
-    generator: Generator
+    # the retriever and generator are shared by every session in the process,
+    # a session only carries the per-user conversation state
+    session_id: str
+    # the most recent turns verbatim, older ones are folded into summary by compact
     chat_history: List[Tuple[str, str]] = []
+    summary: str = ""
+    summarized_turns: int = 0
+    last_used: float = 0.0
 
-# TODO: rethink the notion of a RAG Session
+    _lock: Any = PrivateAttr(default=None)
+    # completes when the last request queued for this session has run, see RAGService.submit
+    _tail: Any = PrivateAttr(default=None)
+
+    def __init__(self, **data):
+        super().__init__(**data)
+        # guards _tail, requests within one session are chained on it so turns are appended in order
+        self._lock = threading.Lock()
+
+    def record_turn(self, question: str, answer: str):
+        self.chat_history.append((question, answer))
+
+    def compact(self, split_history: Callable, summarize: Callable[[str, List[Tuple[str, str]]], str]) -> int:
+        # split_history is ContextBuilder.split_history and summarize Generator.summarize_chat_history.
+        # Only the turns leaving the verbatim history are summarized, on top of the previous summary.
+        old_turns, recent_turns = split_history(self.chat_history)
+        if not old_turns:
+            return 0
+        self.summary = summarize(self.summary, old_turns)
+        self.chat_history = recent_turns
+        self.summarized_turns += len(old_turns)
+        return len(old_turns)
+
+
+class SessionStore(BaseModel):
+    """Bounded, thread-safe LRU store of sessions keyed by session id."""
+    max_sessions: int = 10_000
+
+    _sessions: Any = PrivateAttr(default=None)
+    _lock: Any = PrivateAttr(default=None)
+
+    def __init__(self, **data):
+        super().__init__(**data)
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def get_or_create(self, session_id: str) -> RAGSession:
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = RAGSession(session_id=session_id)
+                self._sessions[session_id] = session
+                # the least recently used sessions are dropped once the store is full
+                while len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+            else:
+                self._sessions.move_to_end(session_id)
+            session.last_used = time.time()
+            return session
+
+    def get(self, session_id: str) -> Optional[RAGSession]:
+        with self._lock:
+            return self._sessions.get(session_id)
+
+    def delete(self, session_id: str):
+        with self._lock:
+            self._sessions.pop(session_id, None)
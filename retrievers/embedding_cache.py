@@ -0,0 +1,269 @@
+import asyncio
+import atexit
+import hashlib
+import json
+import os
+import threading
+import weakref
+import numpy as np
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, List
+from pydantic import BaseModel, PrivateAttr
+from instrumentation import count
+
+try:
+    import fcntl
+except ImportError:
+    # windows, the single process rule below is then not enforced
+    fcntl = None
+
+# on disk layout of a cache directory:
+#   vectors.f32 - memory-mapped float32 matrix of shape (capacity, dim), one row per slot
+#   index.json  - dim, capacity and the [key, slot] pairs from least to most recently used
+#   lock        - held with flock by the one process using the cache
+
+
+class CachedEmbeddings(BaseModel):
+    """Wraps any embedder from embedding_types and only calls it for texts it hasn't seen before.
+
+    A cache directory belongs to one process at a time: the slot table lives in memory, so two
+    processes writing the same vectors file would hand each other's slots out. Opening a directory
+    another process holds raises RuntimeError, and a process forked from the owner embeds without
+    the cache.
+    """
+    embedder: Any
+    cache_dir: str
+    model_name: str
+    max_entries: int = 100_000
+    # persist the slot table after this many new entries, and on close and at exit
+    flush_every: int = 1000
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+    _lock: Any = PrivateAttr(default=None)
+    _slots: Any = PrivateAttr(default=None)
+    _free: Any = PrivateAttr(default=None)
+    _vectors: Any = PrivateAttr(default=None)
+    _dim: int = PrivateAttr(default=0)
+    _capacity: int = PrivateAttr(default=0)
+    _dirty: int = PrivateAttr(default=0)
+    # slots evicted since the last flush, the saved slot table still points at them so they
+    # can only be reused once a flush has dropped them from it
+    _evicted: list = PrivateAttr(default_factory=list)
+    _lock_file: Any = PrivateAttr(default=None)
+    _owner_pid: int = PrivateAttr(default=0)
+
+    def __init__(self, **data):
+        super().__init__(**data)
+        self._lock = threading.Lock()
+        self._slots = OrderedDict()
+        self.acquire_directory()
+        self.open_cache()
+        atexit.register(flush_at_exit, weakref.ref(self))
+
+    def acquire_directory(self):
+        Path(self.cache_dir).mkdir(exist_ok=True, parents=True)
+        self._owner_pid = os.getpid()
+        if fcntl is None:
+            return
+        self._lock_file = open(Path(self.cache_dir) / "lock", "a")
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._lock_file.close()
+            self._lock_file = None
+            raise RuntimeError(f"The embedding cache {self.cache_dir} is in use by another process")
+
+    @property
+    def owned(self) -> bool:
+        # False in a child forked from the owner, e.g. a gunicorn worker under --preload. The child
+        # inherits the lock but writing would corrupt the parent's slots.
+        return self._owner_pid == os.getpid()
+
+    def close(self):
+        with self._lock:
+            if not self.owned:
+                return
+            self.flush_locked()
+            if self._lock_file is not None:
+                self._lock_file.close()
+                self._lock_file = None
+            self._owner_pid = 0
+
+    @property
+    def vectors_path(self) -> Path:
+        return Path(self.cache_dir) / "vectors.f32"
+
+    @property
+    def index_path(self) -> Path:
+        return Path(self.cache_dir) / "index.json"
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def open_cache(self):
+        if not self.index_path.exists():
+            return
+        with open(self.index_path, "r", encoding="utf-8") as f:
+            state = json.load(f)
+        self._dim = state["dim"]
+        self._capacity = state["capacity"]
+        self._vectors = np.memmap(self.vectors_path, dtype=np.float32, mode="r+",
+                                  shape=(self._capacity, self._dim))
+        self._slots = OrderedDict((key, slot) for key, slot in state["slots"])
+        self._free = []
+        # the capacity of an existing file is fixed, a smaller max_entries just evicts down to it
+        while len(self._slots) > min(self.max_entries, self._capacity):
+            self._evicted.append(self._slots.popitem(last=False)[1])
+        self._dirty = len(self._evicted)
+        self.flush_locked()
+        used = set(self._slots.values())
+        self._free = [slot for slot in range(self._capacity - 1, -1, -1) if slot not in used]
+
+    def create_cache(self, dim: int):
+        Path(self.cache_dir).mkdir(exist_ok=True, parents=True)
+        self._dim = dim
+        self._capacity = self.max_entries
+        self._vectors = np.memmap(self.vectors_path, dtype=np.float32, mode="w+",
+                                  shape=(self._capacity, self._dim))
+        self._free = list(range(self._capacity - 1, -1, -1))
+
+    def cache_key(self, text: str) -> str:
+        return f"{self.model_name}:{hashlib.sha256(text.encode('utf-8')).hexdigest()}"
+
+    def lookup(self, key: str):
+        # caller holds the lock
+        slot = self._slots.get(key)
+        if slot is None:
+            return None
+        self._slots.move_to_end(key)
+        return np.array(self._vectors[slot])
+
+    def store(self, key: str, vector):
+        # caller holds the lock
+        if self._vectors is None:
+            self.create_cache(len(vector))
+        if len(vector) != self._dim:
+            raise ValueError(f"Embedding dimension {len(vector)} does not match cache dimension {self._dim}")
+        if key in self._slots:
+            slot = self._slots[key]
+            self._slots.move_to_end(key)
+        else:
+            if not self._free:
+                self.make_room()
+            slot = self._free.pop()
+            self._slots[key] = slot
+            self._dirty += 1
+        self._vectors[slot] = vector
+        if self._dirty >= self.flush_every:
+            self.flush_locked()
+
+    def make_room(self):
+        # caller holds the lock. Evicts a batch of the least recently used entries and flushes, so
+        # the saved slot table never names a slot whose vector was overwritten after it was saved.
+        for _ in range(min(max(1, min(self.flush_every, self._capacity // 20)), len(self._slots))):
+            self._evicted.append(self._slots.popitem(last=False)[1])
+            self.evictions += 1
+        self.flush_locked()
+
+    def flush(self):
+        with self._lock:
+            self.flush_locked()
+
+    def flush_locked(self):
+        if self._vectors is None or not self.owned or not (self._dirty or self._evicted):
+            return
+        self._vectors.flush()
+        state = {"dim": self._dim, "capacity": self._capacity, "slots": list(self._slots.items())}
+        tmp_path = self.index_path.with_suffix(".json.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.index_path)
+        self._dirty = 0
+        self._free.extend(self._evicted)
+        self._evicted = []
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not self.owned:
+            return self.embedder.embed_documents(texts)
+        keys = [self.cache_key(text) for text in texts]
+        results = [None] * len(texts)
+        missing = {}
+        with self._lock:
+            for i, key in enumerate(keys):
+                vector = self.lookup(key)
+                if vector is None:
+                    missing.setdefault(key, []).append(i)
+                else:
+                    results[i] = vector
+            misses = sum(len(positions) for positions in missing.values())
+            self.hits += len(texts) - misses
+            self.misses += misses
+        count("cache.hits", len(texts) - misses, cache="embedding")
+        count("cache.misses", misses, cache="embedding")
+
+        if missing:
+            # identical chunks inside one call are embedded once
+            missing_keys = list(missing)
+            embeddings = self.embedder.embed_documents([texts[missing[key][0]] for key in missing_keys])
+            with self._lock:
+                for key, embedding in zip(missing_keys, embeddings):
+                    vector = np.asarray(embedding, dtype=np.float32)
+                    self.store(key, vector)
+                    for i in missing[key]:
+                        results[i] = vector
+
+        return [vector.tolist() for vector in results]
+
+    def cached_query(self, key: str):
+        with self._lock:
+            vector = self.lookup(key)
+            if vector is not None:
+                self.hits += 1
+                count("cache.hits", cache="embedding")
+                return vector.tolist()
+            self.misses += 1
+            count("cache.misses", cache="embedding")
+            return None
+
+    def remember_query(self, key: str, embedding):
+        with self._lock:
+            self.store(key, np.asarray(embedding, dtype=np.float32))
+
+    def embed_query(self, text: str) -> List[float]:
+        if not self.owned:
+            return self.embedder.embed_query(text)
+        key = self.cache_key(text)
+        cached = self.cached_query(key)
+        if cached is not None:
+            return cached
+        embedding = self.embedder.embed_query(text)
+        self.remember_query(key, embedding)
+        return embedding
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        return await asyncio.to_thread(self.embed_documents, texts)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        owned = self.owned
+        key = self.cache_key(text)
+        cached = self.cached_query(key) if owned else None
+        if cached is not None:
+            return cached
+        if hasattr(self.embedder, "aembed_query"):
+            embedding = await self.embedder.aembed_query(text)
+        else:
+            embedding = await asyncio.to_thread(self.embedder.embed_query, text)
+        if owned:
+            self.remember_query(key, embedding)
+        return embedding
+
+
+def flush_at_exit(ref):
+    cache = ref()
+    if cache is not None:
+        cache.flush()
@@ -0,0 +1,94 @@
+import random
+import time
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Iterable, Iterator, List, Optional, Tuple
+from pydantic import BaseModel
+from document import Document
+from instrumentation import count, span
+
+
+def estimate_tokens(text: str) -> int:
+    # ~4 characters per token for English text, good enough to size request batches
+    return len(text) // 4 + 1
+
+
+def batch_documents(docs: Iterable[Document], max_batch_tokens: int = 8000,
+                    max_batch_size: int = 256) -> Iterator[List[Document]]:
+    batch, batch_tokens = [], 0
+    for doc in docs:
+        tokens = estimate_tokens(doc.content)
+        if batch and (batch_tokens + tokens > max_batch_tokens or len(batch) >= max_batch_size):
+            yield batch
+            batch, batch_tokens = [], 0
+        batch.append(doc)
+        batch_tokens += tokens
+    if batch:
+        yield batch
+
+
+def is_rate_limit_error(e: Exception) -> bool:
+    status_code = getattr(e, "status_code", None)
+    if status_code is None:
+        status_code = getattr(getattr(e, "response", None), "status_code", None)
+    return status_code == 429 or type(e).__name__ == "RateLimitError"
+
+
+def retry_after(e: Exception) -> Optional[float]:
+    headers = getattr(getattr(e, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class EmbeddingPipeline(BaseModel):
+    """Embeds a stream of chunks in token-budgeted batches with a bounded number of requests in flight."""
+    embedder: Any
+    max_batch_tokens: int = 8000
+    max_batch_size: int = 256
+    max_in_flight: int = 4
+    max_retries: int = 6
+    initial_backoff: float = 1.0
+    max_backoff: float = 60.0
+
+    def embed_batch(self, texts: List[str]) -> np.ndarray:
+        backoff = self.initial_backoff
+        for attempt in range(self.max_retries + 1):
+            try:
+                with span("embedder.embed_documents"):
+                    embeddings = np.array(self.embedder.embed_documents(texts), dtype=np.float32)
+                count("embedder.texts", len(texts))
+                count("embedder.estimated_tokens", sum(estimate_tokens(text) for text in texts))
+                return embeddings
+            except Exception as e:
+                if not is_rate_limit_error(e) or attempt == self.max_retries:
+                    raise
+                count("embedder.rate_limited")
+                wait = retry_after(e) or backoff * (1 + random.random())
+                print(f"Rate limited while embedding {len(texts)} chunks, retrying in {wait:.1f}s.")
+                time.sleep(wait)
+                backoff = min(backoff * 2, self.max_backoff)
+
+    def run(self, docs: Iterable[Document], skip_batches: int = 0) -> Iterator[Tuple[int, List[Document], np.ndarray]]:
+        # Yields (batch number, chunks, embeddings) in input order. At most max_in_flight batches are
+        # pending at any time, so memory stays bounded no matter how many chunks the stream holds.
+        # The first skip_batches batches are dropped without being embedded, which is how a build resumes.
+        batches = batch_documents(docs, self.max_batch_tokens, self.max_batch_size)
+        pending = {}
+        next_to_yield = skip_batches
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as executor:
+            for batch_no, batch in enumerate(batches):
+                if batch_no < skip_batches:
+                    continue
+                pending[batch_no] = (batch, executor.submit(self.embed_batch, [doc.content for doc in batch]))
+                if len(pending) >= self.max_in_flight:
+                    done_batch, future = pending.pop(next_to_yield)
+                    yield next_to_yield, done_batch, future.result()
+                    next_to_yield += 1
+            while pending:
+                done_batch, future = pending.pop(next_to_yield)
+                yield next_to_yield, done_batch, future.result()
+                next_to_yield += 1
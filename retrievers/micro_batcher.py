@@ -0,0 +1,98 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, List, Optional, Tuple
+from pydantic import PrivateAttr
+from document import Document
+from retriever import Retriever
+
+
+class MicroBatchingRetriever(Retriever):
+    """Groups concurrent single-query callers into retrieve_similar_docs_batch_with_vectors calls.
+
+    The first waiting query opens a window of max_wait_ms, every query that arrives in that
+    window (up to max_batch_size) shares one embedding request and one index search.
+    """
+    retriever: Retriever
+    max_batch_size: int = 32
+    max_wait_ms: float = 5.0
+
+    _queue: Any = PrivateAttr(default=None)
+    _worker: Any = PrivateAttr(default=None)
+    _lock: Any = PrivateAttr(default=None)
+
+    def __init__(self, **data):
+        super().__init__(**data)
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self.run_batches, daemon=True)
+                self._worker.start()
+
+    def close(self):
+        if self._worker is not None:
+            self._queue.put(None)
+            self._worker.join()
+            self._worker = None
+
+    @property
+    def embedder(self):
+        # lets the semantic cache see that the query vectors came from its own embedder
+        return getattr(self.retriever, "embedder", None)
+
+    def retrieve_similar_docs(self, query, max_docs=5) -> List[Document]:
+        return self.retrieve_similar_docs_with_vector(query, max_docs)[0]
+
+    def retrieve_similar_docs_with_vector(self, query, max_docs=5) -> Tuple[List[Document], Optional[Any]]:
+        self.start()
+        future = Future()
+        self._queue.put((query, max_docs, future))
+        return future.result()
+
+    def retrieve_similar_docs_batch(self, queries, max_docs=5) -> List[List[Document]]:
+        # callers that already have a batch skip the batching window
+        return self.retriever.retrieve_similar_docs_batch(queries, max_docs)
+
+    def retrieve_similar_docs_batch_with_vectors(self, queries, max_docs=5) -> Tuple[List[List[Document]],
+                                                                                      Optional[Any]]:
+        return self.retriever.retrieve_similar_docs_batch_with_vectors(queries, max_docs)
+
+    def collect_batch(self, first) -> list:
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait_ms / 1000
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if request is None:
+                # keep the shutdown signal for the worker loop
+                self._queue.put(None)
+                break
+            batch.append(request)
+        return batch
+
+    def run_batches(self):
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+            batch = self.collect_batch(first)
+            # search once with the largest k in the batch and trim each result to its own max_docs
+            max_docs = max(request_max_docs for _, request_max_docs, _ in batch)
+            try:
+                results, vectors = self.retriever.retrieve_similar_docs_batch_with_vectors(
+                    [query for query, _, _ in batch], max_docs)
+            except Exception as e:
+                for _, _, future in batch:
+                    future.set_exception(e)
+                continue
+            for i, ((_, request_max_docs, future), docs) in enumerate(zip(batch, results)):
+                future.set_result((docs[:request_max_docs], vectors[i:i + 1] if vectors is not None else None))
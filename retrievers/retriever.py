@@ -1,16 +1,61 @@
+import asyncio
 from abc import ABC, abstractmethod
-from typing import List, Optional
+from typing import Any, List, Optional, Tuple
 from pydantic import BaseModel
 from document import Document
-from vector_index.faiss_vector_index import FAISSVectorIndex
-from vector_database.chroma_vector_database import ChromaVectorDatabase
-from langchain.embeddings import OpenAIEmbeddings
+
+
+class Retriever(ABC, BaseModel):
+    # docs: List[Document]
+    # split_docs: bool
+
+    @abstractmethod
+    def retrieve_similar_docs(self, query: str,
+                              max_docs: int = 5) -> List[Document]:
+        pass
+
+    def retrieve_similar_docs_batch(self, queries: List[str],
+                                    max_docs: int = 5) -> List[List[Document]]:
+        # backends that can embed and search many queries at once should override this
+        return [self.retrieve_similar_docs(query, max_docs) for query in queries]
+
+    async def aretrieve_similar_docs(self, query: str,
+                                     max_docs: int = 5) -> List[Document]:
+        # backends without native async support run the blocking call on a worker thread
+        return await asyncio.to_thread(self.retrieve_similar_docs, query, max_docs)
+
+    def retrieve_similar_docs_with_vector(self, query: str,
+                                          max_docs: int = 5) -> Tuple[List[Document], Optional[Any]]:
+        # also returns the (1, dim) float32 query embedding the search used, so callers that need it too
+        # don't embed the query a second time. Backends that embed the query should override this.
+        return self.retrieve_similar_docs(query, max_docs), None
+
+    async def aretrieve_similar_docs_with_vector(self, query: str,
+                                                 max_docs: int = 5) -> Tuple[List[Document], Optional[Any]]:
+        return await asyncio.to_thread(self.retrieve_similar_docs_with_vector, query, max_docs)
+
+    def retrieve_similar_docs_batch_with_vectors(self, queries: List[str],
+                                                 max_docs: int = 5) -> Tuple[List[List[Document]], Optional[Any]]:
+        # the batch version of retrieve_similar_docs_with_vector, row i of the (n, dim) embeddings is queries[i]
+        return self.retrieve_similar_docs_batch(queries, max_docs), None
+
+
+# the backends subclass Retriever from this module, so they can only be imported once it is defined
+from faiss_vector_index import FAISSVectorIndex  # noqa: E402
+from sharded_faiss_index import ShardedFAISSIndex  # noqa: E402
+from snapshots import SnapshotManager, SnapshotRetriever  # noqa: E402
+from index_factory import IndexSpec  # noqa: E402
+from chroma_vector_database import ChromaVectorDatabase  # noqa: E402
+from embedding_cache import CachedEmbeddings  # noqa: E402
+from micro_batcher import MicroBatchingRetriever  # noqa: E402
+from langchain.embeddings import OpenAIEmbeddings  # noqa: E402
 
 # shoutout langchain for their OpenAIEmbeddings class, I did NOT feel like rewriting this one
 # source: https://api.python.langchain.com/en/latest/embeddings/langchain_community.embeddings.openai.OpenAIEmbeddings.html#langchain_community.embeddings.openai.OpenAIEmbeddings
 
 retriever_types = {
     "faiss": FAISSVectorIndex,
+    "faiss_sharded": ShardedFAISSIndex,
     "chromadb": ChromaVectorDatabase
 }
 
@@ -19,20 +64,12 @@ embedding_types = {
 }
 
 
-class Retriever(ABC, BaseModel):
-    # docs: List[Document]
-    # split_docs: bool
-
-    @abstractmethod
-    def retrieve_similar_docs(self, query: str,
-                              max_docs: int = 5) -> List[Document]:
-        pass
-
-
 def get_retriever(docs: List[Document], retriever_type: str = "faiss",
                   embedding_type: str = "openai", split_docs: bool = True,
                   language: Optional[str] = None, chunk_size: Optional[int] = None,
-                  chunk_overlap: Optional[int] = None):
+                  chunk_overlap: Optional[int] = None, cache_dir: Optional[str] = None,
+                  cache_max_entries: int = 100_000, index_spec: Optional[IndexSpec] = None,
+                  search_mode: Optional[str] = None):
     retriever_class = retriever_types.get(retriever_type)
     if not retriever_class:
         raise ValueError(f"Unsupported retriever type: {retriever_type}")
@@ -43,6 +80,10 @@ def get_retriever(docs: List[Document], retriever_type: str = "faiss",
 
     # Instantiate the embedder
     embedder = embedding_class()
+    if cache_dir is not None:
+        model_name = getattr(embedder, "model", None) or embedding_type
+        embedder = CachedEmbeddings(embedder=embedder, cache_dir=cache_dir, model_name=model_name,
+                                    max_entries=cache_max_entries)
 
     # Prepare additional keyword arguments for DocumentSplitter, if needed
     splitter_kwargs = {}
@@ -53,5 +94,12 @@ def get_retriever(docs: List[Document], retriever_type: str = "faiss",
     if chunk_overlap is not None:
         splitter_kwargs["chunk_overlap"] = chunk_overlap
 
+    # approximate index types (IVF/HNSW/PQ/SQ) are only understood by the FAISS backend
+    if index_spec is not None:
+        splitter_kwargs["index_spec"] = index_spec
+    # so are the BM25 postings behind the "hybrid" and "lexical" search modes
+    if search_mode is not None:
+        splitter_kwargs["search_mode"] = search_mode
+
     # Call from_documents with the necessary arguments
     return retriever_class.from_documents(docs=docs, split_docs=split_docs, embedder=embedder, **splitter_kwargs)
@@ -1,60 +1,139 @@
+import os
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import Any, Iterable, Iterator, List, Optional, Tuple
 from langchain.text_splitter import Language, RecursiveCharacterTextSplitter
-from langchain.docstore.document import Document as LangchainDocument
 from document import Document
+from instrumentation import count
 
 # this file uses Langchain RecursiveCharacterTextSplitter under the hood
 
-language_types = {
-    "python": Language.PYTHON
-}
+# every language Langchain has separators for, keyed by its enum value ("python", "js", "markdown", ...)
+language_types = {language.value: language for language in Language}
+language_types.update({
+    "javascript": Language.JS,
+    "typescript": Language.TS,
+    "c++": Language.CPP,
+    "c#": Language.CSHARP,
+    "md": Language.MARKDOWN,
+    "tex": Language.LATEX,
+    "solidity": Language.SOL,
+})
+
+
+def build_rcts(language: Optional[str], chunk_size: int, chunk_overlap: int) -> RecursiveCharacterTextSplitter:
+    if language:
+        language_enum = language_types.get(language.lower())
+        if language_enum:
+            return RecursiveCharacterTextSplitter.from_language(language_enum, chunk_size=chunk_size,
+                                                                chunk_overlap=chunk_overlap)
+        raise ValueError("Unsupported language type.")
+    return RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+
+
+def split_text_with_offsets(rcts, text: str, chunk_overlap: int) -> List[Tuple[str, int, int]]:
+    # (chunk, start, end) with text[start:end] == chunk. Chunks come back in order and overlap by at
+    # most chunk_overlap, so each one is searched for from just before where the previous one ended.
+    chunks, start, end = [], -1, 0
+    for chunk in rcts.split_text(text):
+        found = text.find(chunk, max(start + 1, end - chunk_overlap))
+        start = found if found != -1 else text.find(chunk, start + 1)
+        end = start + len(chunk)
+        chunks.append((chunk, start, end))
+    return chunks
+
+
+# the splitter of each pool worker, built once by init_split_worker
+worker_rcts = None
+worker_chunk_overlap = 0
+
+
+def init_split_worker(language: Optional[str], chunk_size: int, chunk_overlap: int):
+    global worker_rcts, worker_chunk_overlap
+    worker_rcts = build_rcts(language, chunk_size, chunk_overlap)
+    worker_chunk_overlap = chunk_overlap
+
+
+def split_batch(texts: List[str]) -> List[List[Tuple[str, int, int]]]:
+    # only the page text crosses the process boundary, titles and sources stay with the parent
+    return [split_text_with_offsets(worker_rcts, text, worker_chunk_overlap) for text in texts]
 
 
 class DocumentSplitter(BaseModel):
     language: Optional[str] = None
     chunk_size: int = 1000
     chunk_overlap: int = 100
+    # worker processes used by iter_split_documents, 1 splits in this process and 0 uses every core
+    processes: int = 1
+    # documents are sent to the workers in batches of roughly this many characters
+    batch_chars: int = 1_000_000
+    progress_every: int = 100_000
+    rcts: Any = None
 
     def __init__(self, **data):
         super().__init__(**data)
         self.get_rcts_instance()
 
     def get_rcts_instance(self):
-        if self.language:
-            language_enum = language_types.get(self.language)
-            if language_enum:
-                self.rcts = RecursiveCharacterTextSplitter.from_language(language_enum, chunk_size=self.chunk_size,
-                                                                         chunk_overlap=self.chunk_overlap)
-            else:
-                raise ValueError("Unsupported language type.")
-        else:
-            self.rcts = RecursiveCharacterTextSplitter(chunk_size=self.chunk_size,
-                                                       chunk_overlap=self.chunk_overlap)
+        self.rcts = build_rcts(self.language, self.chunk_size, self.chunk_overlap)
 
-    def convert_to_langchain_documents(self, documents: List[Document]) -> List[LangchainDocument]:
-        langchain_documents = []
-        for doc in documents:
-            metadata = {'source': doc.source, 'title': doc.title}
-            langchain_doc = LangchainDocument(
-                page_content=doc.content, metadata=metadata)
-            langchain_documents.append(langchain_doc)
-        return langchain_documents
-
-    def convert_to_documents(self, langchain_documents: List[LangchainDocument]) -> List[Document]:
-        documents = []
-        for langchain_doc in langchain_documents:
-            content = langchain_doc.page_content
-            source = langchain_doc.metadata['source']
-            title = langchain_doc.metadata['title']
-            doc = Document(content=content, source=source, title=title)
-            documents.append(doc)
-        return documents
+    def make_chunks(self, doc: Document, chunks: List[Tuple[str, int, int]]) -> List[Document]:
+        # offsets are relative to the content of the page the chunk was split from
+        base = doc.start_index or 0
+        return [Document(content=content, title=doc.title, source=doc.source,
+                         start_index=base + start, end_index=base + end)
+                for content, start, end in chunks]
+
+    def split_document(self, doc: Document) -> List[Document]:
+        return self.make_chunks(doc, split_text_with_offsets(self.rcts, doc.content, self.chunk_overlap))
 
     def split_documents(self, documents: List[Document]) -> List[Document]:
-        langchain_documents = self.convert_to_langchain_documents(documents)
-        split_langchain_docs = self.rcts.split_documents(langchain_documents)
-        split_docs = self.convert_to_documents(split_langchain_docs)
-        print(f"Split {len(documents)} documents into {len(split_docs)} documents \
-              based on chunk size {self.chunk_size} with overlap {self.chunk_overlap}.")
-        return split_docs
+        return list(self.iter_split_documents(documents))
+
+    def iter_batches(self, documents: Iterable[Document]) -> Iterator[List[Document]]:
+        batch, batch_chars = [], 0
+        for doc in documents:
+            batch.append(doc)
+            batch_chars += len(doc.content)
+            if batch_chars >= self.batch_chars:
+                yield batch
+                batch, batch_chars = [], 0
+        if batch:
+            yield batch
+
+    def iter_split_pool(self, documents: Iterable[Document]) -> Iterator[Tuple[Document, List[Tuple[str, int, int]]]]:
+        processes = self.processes or os.cpu_count() or 1
+        with ProcessPoolExecutor(max_workers=processes, initializer=init_split_worker,
+                                 initargs=(self.language, self.chunk_size, self.chunk_overlap)) as pool:
+            # a couple of batches per worker are in flight, so memory stays bounded however long the input is
+            pending = deque()
+            for batch in self.iter_batches(documents):
+                pending.append((batch, pool.submit(split_batch, [doc.content for doc in batch])))
+                if len(pending) >= 2 * processes:
+                    batch, future = pending.popleft()
+                    yield from zip(batch, future.result())
+            while pending:
+                batch, future = pending.popleft()
+                yield from zip(batch, future.result())
+
+    def iter_split_documents(self, documents: Iterable[Document]) -> Iterator[Document]:
+        # chunks come out in input order while the input is still being read
+        if self.processes == 1:
+            split = ((doc, split_text_with_offsets(self.rcts, doc.content, self.chunk_overlap)) for doc in documents)
+        else:
+            split = self.iter_split_pool(documents)
+        num_documents, num_chunks = 0, 0
+        for doc, chunks in split:
+            for chunk in self.make_chunks(doc, chunks):
+                num_chunks += 1
+                yield chunk
+            num_documents += 1
+            count("splitter.documents")
+            count("splitter.chunks", len(chunks))
+            # progress goes to stderr, stdout may carry a report (see benchmarks/pipeline_benchmark.py)
+            if num_documents % self.progress_every == 0:
+                print(f"Split {num_documents} documents into {num_chunks} chunks so far.", file=sys.stderr)
+        print(f"Split {num_documents} documents into {num_chunks} documents "
+              f"based on chunk size {self.chunk_size} with overlap {self.chunk_overlap}.", file=sys.stderr)
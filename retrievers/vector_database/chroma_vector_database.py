@@ -1,9 +1,134 @@
-from typing import List
+import hashlib
+import chromadb
+import numpy as np
+from typing import Any, Dict, Iterable, List, Optional, Tuple
 from document import Document
+from instrumentation import count, span
 from retriever import Retriever
+from text_splitters import DocumentSplitter
+from embedding_pipeline import EmbeddingPipeline
+
+# metadata fields that can be used to filter retrieval, the values are pushed down into the Chroma query
+filter_fields = ["source", "title"]
+# stored with every chunk so retrieved chunks can be mapped back into their page
+metadata_fields = filter_fields + ["start_index", "end_index"]
+
+
+def chunk_id(doc: Document, occurrence: int) -> str:
+    # deterministic ids make re-adding an unchanged chunk an idempotent upsert
+    source_hash = hashlib.sha1((doc.source or "").encode("utf-8")).hexdigest()
+    content_hash = hashlib.sha1(doc.content.encode("utf-8")).hexdigest()
+    return f"{source_hash}:{content_hash}:{occurrence}"
+
+
+def build_where(filter: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    # {"source": url} or {"source": [url, ...], "title": title} -> Chroma where clause
+    if not filter:
+        return None
+    clauses = []
+    for field, value in filter.items():
+        if field not in filter_fields:
+            raise ValueError(f"Unsupported filter field: {field}")
+        if isinstance(value, (list, tuple, set)):
+            clauses.append({field: {"$in": list(value)}})
+        else:
+            clauses.append({field: value})
+    return clauses[0] if len(clauses) == 1 else {"$and": clauses}
 
 
 class ChromaVectorDatabase(Retriever):
+    embedder: Any
+    collection: Any
+    persist_directory: str = "chroma_db"
+    collection_name: str = "easy_rag"
+
+    @staticmethod
+    def get_collection(persist_directory, collection_name):
+        client = chromadb.PersistentClient(path=str(persist_directory))
+        # embeddings always come from our embedder, so Chroma's own embedding function is never used
+        return client.get_or_create_collection(name=collection_name, embedding_function=None,
+                                               metadata={"hnsw:space": "l2"})
+
+    @classmethod
+    def from_documents(cls, docs, split_docs, embedder, persist_directory="chroma_db", collection_name="easy_rag",
+                       max_batch_tokens=8000, max_in_flight=4, **kwargs) -> 'ChromaVectorDatabase':
+        collection = cls.get_collection(persist_directory, collection_name)
+        inst = cls(embedder=embedder, collection=collection, persist_directory=str(persist_directory),
+                   collection_name=collection_name)
+        inst.add_documents(docs, split_docs, max_batch_tokens=max_batch_tokens, max_in_flight=max_in_flight,
+                           **kwargs)
+        return inst
+
+    @classmethod
+    def load_local(cls, folder_path, embedder, collection_name="easy_rag") -> 'ChromaVectorDatabase':
+        # reopens the persisted collection, nothing is re-embedded
+        collection = cls.get_collection(folder_path, collection_name)
+        return cls(embedder=embedder, collection=collection, persist_directory=str(folder_path),
+                   collection_name=collection_name)
+
+    def add_documents(self, docs, split_docs, max_batch_tokens=8000, max_in_flight=4, **kwargs) -> List[str]:
+        if split_docs:
+            ds = DocumentSplitter(**kwargs)
+            docs = ds.iter_split_documents(docs)
+        pipeline = EmbeddingPipeline(embedder=self.embedder, max_batch_tokens=max_batch_tokens,
+                                     max_in_flight=max_in_flight)
+        occurrences = {}
+        ids = []
+        for _, batch, embeddings in pipeline.run(docs):
+            batch_ids = []
+            for doc in batch:
+                key = (doc.source, doc.content)
+                occurrences[key] = occurrences.get(key, -1) + 1
+                batch_ids.append(chunk_id(doc, occurrences[key]))
+            # Chroma rejects None metadata values
+            metadatas = [{field: getattr(doc, field) for field in metadata_fields if getattr(doc, field) is not None}
+                         for doc in batch]
+            self.collection.upsert(ids=batch_ids, embeddings=embeddings.tolist(),
+                                   documents=[doc.content for doc in batch],
+                                   metadatas=[metadata or None for metadata in metadatas])
+            ids.extend(batch_ids)
+        return ids
+
+    def delete_documents(self, sources: Iterable[str]) -> int:
+        # removes every chunk that was split from one of the given source URLs
+        where = build_where({"source": list(sources)})
+        if where["source"]["$in"] == []:
+            return 0
+        ids = self.collection.get(where=where, include=[])["ids"]
+        if ids:
+            self.collection.delete(ids=ids)
+        return len(ids)
+
+    def upsert_documents(self, docs, split_docs, **kwargs) -> List[str]:
+        # replaces the chunks of every page in docs, pages that are not in docs are left untouched
+        self.delete_documents({doc.source for doc in docs})
+        return self.add_documents(docs, split_docs, **kwargs)
+
+    def query_documents(self, embeddings, max_docs, filter=None) -> List[List[Document]]:
+        with span("retriever.chroma_query", filtered=bool(filter)):
+            result = self.collection.query(query_embeddings=embeddings, n_results=max_docs,
+                                           where=build_where(filter), include=["documents", "metadatas"])
+        docs = []
+        for contents, metadatas in zip(result["documents"], result["metadatas"]):
+            docs.append([Document(content=content, **{field: (metadata or {}).get(field) for field in metadata_fields})
+                         for content, metadata in zip(contents, metadatas)])
+        return docs
+
+    def retrieve_similar_docs(self, query, max_docs=5, filter: Optional[Dict[str, Any]] = None) -> List[Document]:
+        return self.retrieve_similar_docs_with_vector(query, max_docs, filter)[0]
+
+    def retrieve_similar_docs_with_vector(self, query, max_docs=5,
+                                          filter: Optional[Dict[str, Any]] = None) -> Tuple[List[Document], np.ndarray]:
+        count("retriever.queries", mode="chroma")
+        with span("retriever.embed_query"):
+            embedding = self.embedder.embed_query(query)
+        return self.query_documents([embedding], max_docs, filter)[0], np.array([embedding], dtype=np.float32)
 
-    def retrieve_similar_docs(self, query, max_docs=5) -> List[Document]:
-        print(f"query: {query}")
+    def retrieve_similar_docs_batch(self, queries, max_docs=5,
+                                    filter: Optional[Dict[str, Any]] = None) -> List[List[Document]]:
+        if not queries:
+            return []
+        count("retriever.queries", len(queries), mode="chroma")
+        with span("retriever.embed_query"):
+            embeddings = self.embedder.embed_documents(list(queries))
+        return self.query_documents(embeddings, max_docs, filter)
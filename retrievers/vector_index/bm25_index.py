@@ -0,0 +1,207 @@
+import json
+import os
+import re
+import threading
+import numpy as np
+from pathlib import Path
+from typing import Any, Dict, Hashable, Iterable, List, Optional, Sequence, Tuple
+from pydantic import BaseModel, PrivateAttr
+
+# on disk layout written by BM25Index.save, postings are stored CSR style, grouped by term:
+#   bm25.indptr.npy   - int64, the postings of term t are indptr[t]:indptr[t + 1]
+#   bm25.doc_ids.npy  - int64 docstore row id of each posting
+#   bm25.tfs.npy      - float32 term frequency of each posting
+#   bm25.doc_lens.npy - float32 token count per row id, 0 for deleted rows
+#   bm25.json         - k1, b and the vocabulary ordered by term id
+BM25_FILES = ["bm25.indptr.npy", "bm25.doc_ids.npy", "bm25.tfs.npy", "bm25.doc_lens.npy"]
+BM25_META = "bm25.json"
+
+# keeps identifiers like error_code, v2 or 0x1f together, punctuation splits tokens
+TOKEN_RE = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN_RE.findall(text.lower())
+
+
+def reciprocal_rank_fusion(rankings: Iterable[Sequence[Hashable]], k: int = 60,
+                           limit: int = 5) -> List[Tuple[Hashable, float]]:
+    # each id scores sum(1 / (k + rank)) over the rankings it shows up in, no score calibration needed
+    scores: Dict[Hashable, float] = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:limit]
+
+
+class BM25Index(BaseModel):
+    """Okapi BM25 over the same chunks and row ids as the FAISS index.
+
+    New chunks are collected as (term, doc, tf) arrays and only merged into the CSR postings on the
+    next search or save, so adding a batch is cheap but that merge rewrites the whole CSR arrays once
+    for all the batches added since. The postings built so far are already sorted by term, so the
+    stable sort behind it is close to a linear merge.
+    """
+    k1: float = 1.5
+    b: float = 0.75
+
+    _vocab: Any = PrivateAttr(default=None)
+    _indptr: Any = PrivateAttr(default=None)
+    _doc_ids: Any = PrivateAttr(default=None)
+    _tfs: Any = PrivateAttr(default=None)
+    _doc_lens: Any = PrivateAttr(default=None)
+    # [(term_ids, doc_ids, tfs, row_ids, row_lens)] per added batch, not yet in the CSR arrays
+    _pending: list = PrivateAttr(default_factory=list)
+    _deleted: set = PrivateAttr(default_factory=set)
+    _num_docs: int = PrivateAttr(default=0)
+    _avg_len: float = PrivateAttr(default=0.0)
+    _lock: Any = PrivateAttr(default=None)
+
+    def __init__(self, **data):
+        super().__init__(**data)
+        self._vocab = {}
+        self._indptr = np.zeros(1, dtype=np.int64)
+        self._doc_ids = np.zeros(0, dtype=np.int64)
+        self._tfs = np.zeros(0, dtype=np.float32)
+        self._doc_lens = np.zeros(0, dtype=np.float32)
+        self._lock = threading.Lock()
+
+    def add(self, ids: Sequence[int], texts: Sequence[str]):
+        term_ids, doc_ids, tfs, lens = [], [], [], []
+        with self._lock:
+            for row_id, text in zip(ids, texts):
+                tokens = [self._vocab.setdefault(token, len(self._vocab)) for token in tokenize(text)]
+                terms, counts = np.unique(np.array(tokens, dtype=np.int64), return_counts=True)
+                term_ids.append(terms)
+                doc_ids.append(np.full(len(terms), row_id, dtype=np.int64))
+                tfs.append(counts.astype(np.float32))
+                lens.append(len(tokens))
+            if ids:
+                self._pending.append((np.concatenate(term_ids), np.concatenate(doc_ids), np.concatenate(tfs),
+                                      np.array(ids, dtype=np.int64), np.array(lens, dtype=np.float32)))
+
+    def delete(self, ids: Iterable[int]):
+        # the postings of deleted rows are dropped by the compaction before the next search or save
+        with self._lock:
+            self._deleted.update(int(row_id) for row_id in ids)
+
+    def compact(self):
+        with self._lock:
+            self.compact_locked()
+
+    def compact_locked(self):
+        if not self._pending and not self._deleted:
+            return
+        term_ids = [np.repeat(np.arange(len(self._indptr) - 1, dtype=np.int64), np.diff(self._indptr))]
+        doc_ids, tfs = [np.asarray(self._doc_ids)], [np.asarray(self._tfs)]
+        max_row = max([len(self._doc_lens) - 1] + [int(rows.max()) for _, _, _, rows, _ in self._pending])
+        doc_lens = np.zeros(max_row + 1, dtype=np.float32)
+        doc_lens[:len(self._doc_lens)] = self._doc_lens
+        for pending_terms, pending_docs, pending_tfs, rows, lens in self._pending:
+            term_ids.append(pending_terms)
+            doc_ids.append(pending_docs)
+            tfs.append(pending_tfs)
+            doc_lens[rows] = lens
+        term_ids, doc_ids, tfs = np.concatenate(term_ids), np.concatenate(doc_ids), np.concatenate(tfs)
+
+        if self._deleted:
+            deleted = np.fromiter(self._deleted, dtype=np.int64)
+            keep = ~np.isin(doc_ids, deleted)
+            term_ids, doc_ids, tfs = term_ids[keep], doc_ids[keep], tfs[keep]
+            doc_lens[deleted[deleted < len(doc_lens)]] = 0
+
+        order = np.argsort(term_ids, kind="stable")
+        self._doc_ids, self._tfs = doc_ids[order], tfs[order]
+        self._indptr = np.zeros(len(self._vocab) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(term_ids, minlength=len(self._vocab)), out=self._indptr[1:])
+        self._doc_lens = doc_lens
+        self._pending = []
+        self._deleted = set()
+        self.update_stats()
+
+    def update_stats(self):
+        live = np.asarray(self._doc_lens) > 0
+        self._num_docs = int(live.sum())
+        self._avg_len = float(np.asarray(self._doc_lens)[live].mean()) if self._num_docs else 0.0
+
+    def search(self, query: str, max_docs: int = 5) -> List[int]:
+        return [doc_id for doc_id, _ in self.search_scored(query, max_docs)]
+
+    def collection_stats(self, query: str) -> Tuple[Dict[str, int], int, float]:
+        # (document frequency of each query term, live documents, total tokens). Summed over the shards
+        # of a sharded index they give every shard the same idf and average length to score with.
+        with self._lock:
+            self.compact_locked()
+            doc_freqs = {token: int(self._indptr[self._vocab[token] + 1] - self._indptr[self._vocab[token]])
+                         for token in set(tokenize(query)) if token in self._vocab}
+            return doc_freqs, self._num_docs, self._avg_len * self._num_docs
+
+    def search_scored(self, query: str, max_docs: int = 5, allowed: Optional[np.ndarray] = None,
+                      stats: Optional[Tuple[Dict[str, int], int, float]] = None) -> List[Tuple[int, float]]:
+        # allowed restricts the results to those row ids, like the FAISS id selector does for dense search.
+        # stats overrides this index's own collection_stats.
+        with self._lock:
+            self.compact_locked()
+            terms = {token: self._vocab[token] for token in set(tokenize(query)) if token in self._vocab}
+            if stats is None:
+                doc_freqs, num_docs, avg_len = None, self._num_docs, self._avg_len
+            else:
+                doc_freqs, num_docs, total_len = stats
+                avg_len = total_len / num_docs if num_docs else 0.0
+            if not terms or not self._num_docs:
+                return []
+            lengths = self._doc_lens
+            doc_ids, scores = [], []
+            for token, term_id in terms.items():
+                start, end = self._indptr[term_id], self._indptr[term_id + 1]
+                postings, tfs = np.asarray(self._doc_ids[start:end]), np.asarray(self._tfs[start:end])
+                doc_freq = doc_freqs[token] if doc_freqs is not None else len(postings)
+                idf = np.log(1.0 + (num_docs - doc_freq + 0.5) / (doc_freq + 0.5))
+                norm = self.k1 * (1.0 - self.b + self.b * lengths[postings] / avg_len)
+                doc_ids.append(postings)
+                scores.append(idf * tfs * (self.k1 + 1.0) / (tfs + norm))
+        # sum the per-term contributions of each document, then keep the best max_docs
+        unique_ids, inverse = np.unique(np.concatenate(doc_ids), return_inverse=True)
+        totals = np.bincount(inverse, weights=np.concatenate(scores))
+        if allowed is not None:
+            keep = np.isin(unique_ids, allowed)
+            unique_ids, totals = unique_ids[keep], totals[keep]
+        if len(totals) > max_docs:
+            top = np.argpartition(-totals, max_docs - 1)[:max_docs]
+        else:
+            top = np.arange(len(totals))
+        top = top[np.argsort(-totals[top], kind="stable")]
+        return list(zip(unique_ids[top].tolist(), totals[top].tolist()))
+
+    def save(self, folder_path):
+        path = Path(folder_path)
+        path.mkdir(exist_ok=True, parents=True)
+        with self._lock:
+            self.compact_locked()
+            for name, array in zip(BM25_FILES, [self._indptr, self._doc_ids, self._tfs, self._doc_lens]):
+                # replaced rather than overwritten, a loaded index may still have the old file mapped
+                tmp_path = path / (name + ".tmp")
+                with open(tmp_path, "wb") as f:
+                    np.save(f, array)
+                os.replace(tmp_path, path / name)
+            terms = sorted(self._vocab, key=self._vocab.get)
+        with open(path / (BM25_META + ".tmp"), "w", encoding="utf-8") as f:
+            json.dump({"k1": self.k1, "b": self.b, "vocab": terms}, f)
+        os.replace(path / (BM25_META + ".tmp"), path / BM25_META)
+
+    @classmethod
+    def exists(cls, folder_path) -> bool:
+        return (Path(folder_path) / BM25_META).exists()
+
+    @classmethod
+    def load(cls, folder_path) -> 'BM25Index':
+        path = Path(folder_path)
+        with open(path / BM25_META, encoding="utf-8") as f:
+            meta = json.load(f)
+        inst = cls(k1=meta["k1"], b=meta["b"])
+        inst._vocab = {term: term_id for term_id, term in enumerate(meta["vocab"])}
+        # the postings are memory-mapped like the docstore, pages are read as queries touch them
+        inst._indptr, inst._doc_ids, inst._tfs, inst._doc_lens = [np.load(path / name, mmap_mode="r")
+                                                                   for name in BM25_FILES]
+        inst.update_stats()
+        return inst
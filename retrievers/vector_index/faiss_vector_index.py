@@ -1,89 +1,475 @@
+import asyncio
 import faiss
+import json
 import numpy as np
-import uuid
-import pickle
+import os
+import shutil
 from pathlib import Path
-from typing import List, Any, Dict
-from document import Document, DocStore
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+from pydantic import PrivateAttr
+from document import DOCSTORE_BLOB, Document, DocStore, ScoredDocument
+from instrumentation import count, span
 from retriever import Retriever
 from text_splitters import DocumentSplitter
+from embedding_pipeline import EmbeddingPipeline
+from index_factory import IndexSpec, apply_search_params, build_index, exact_rerank, train_index
+from full_vectors import FULL_VECTORS, FullPrecisionVectors
+from bm25_index import BM25Index, reciprocal_rank_fusion
+
+# dense: FAISS only, lexical: BM25 only (never calls the embedder), hybrid: both fused with reciprocal rank fusion
+search_modes = ["dense", "hybrid", "lexical"]
+# maps the codes of flat and IVF indexes alike where FAISS supports it, older versions only map IVF lists
+MMAP_FLAG = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP)
+
+
+def maximal_marginal_relevance(vectors: np.ndarray, query_vector: Optional[np.ndarray], scores: Sequence[float],
+                               max_docs: int, mmr_lambda: float) -> List[int]:
+    # positions of the candidates to keep, in pick order. 1.0 is pure relevance and 0.0 pure diversity.
+    vectors = vectors / (np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-12)
+    if query_vector is not None:
+        relevance = vectors @ (query_vector / (np.linalg.norm(query_vector) + 1e-12))
+    else:
+        # lexical only: there is no query vector, so the min-max scaled scores stand in for it
+        scores = np.asarray(scores, dtype=np.float64)
+        relevance = (scores - scores.min()) / (np.ptp(scores) or 1.0)
+    similarity = vectors @ vectors.T
+    selected = [int(np.argmax(relevance))]
+    max_similarity = similarity[selected[0]].copy()
+    while len(selected) < min(max_docs, len(vectors)):
+        mmr_scores = mmr_lambda * relevance - (1.0 - mmr_lambda) * max_similarity
+        mmr_scores[selected] = -np.inf
+        selected.append(int(np.argmax(mmr_scores)))
+        np.maximum(max_similarity, similarity[selected[-1]], out=max_similarity)
+    return selected
 
 
 class FAISSVectorIndex(Retriever):
     embedder: Any
     docstore: DocStore
+    # FAISS ids are the docstore row ids, they are never reused so deletes don't shift later ids
     index: Any
-    index_to_docstore_id: Dict[int, str]
-
-    def retrieve_similar_docs(self, query, max_docs=5) -> List[Document]:
-        embedding = self.embedder.embed_query(query)
-        vector = np.array([embedding], dtype=np.float32)
-        scores, indices = self.index.search(vector, max_docs)
-        docs_and_scores = []
-        for i, idx_id in enumerate(indices[0]):
-            if idx_id == -1:
-                # This happens when not enough docs are returned.
-                continue
-            ds_id = self.index_to_docstore_id[idx_id]
-            doc = self.docstore.search(ds_id)
+    index_spec: IndexSpec = IndexSpec()
+    # built from the same chunks and row ids as the FAISS index, None for dense only indexes
+    bm25: Optional[BM25Index] = None
+    # dense unless chosen otherwise, "hybrid" and "lexical" need the bm25 postings
+    search_mode: str = "dense"
+    # each list contributes this many candidates to the fusion, the rrf_k constant damps the top ranks
+    fusion_candidates: int = 20
+    rrf_k: int = 60
+    # float32 copies of the vectors for exact re-ranking, kept when index_spec.rerank_k is set
+    full_vectors: Optional[FullPrecisionVectors] = None
+    # loaded with the FAISS index memory-mapped, which FAISS can search but not add to or remove from
+    mmapped: bool = False
+    # (ids, vectors) added before a trainable index has seen enough vectors to be trained
+    _train_buffer: list = PrivateAttr(default_factory=list)
+
+    def resolve_documents(self, rows: List[List[Tuple[int, float]]]) -> List[List[ScoredDocument]]:
+        # looks up every distinct hit once, then fans the documents back out per query row
+        with span("retriever.docstore"):
+            docs = {idx_id: self.docstore.search(idx_id) for idx_id in {idx_id for row in rows for idx_id, _ in row}}
+        for idx_id, doc in docs.items():
             if not isinstance(doc, Document):
                 raise ValueError(
-                    f"Could not find document for id {ds_id}, got {doc}")
-            docs_and_scores.append((doc, scores[0][i]))
+                    f"Could not find document for id {idx_id}, got {doc}")
+        return [[ScoredDocument(document=docs[idx_id], score=score, id=idx_id) for idx_id, score in row]
+                for row in rows]
+
+    @property
+    def mode(self) -> str:
+        if self.search_mode not in search_modes:
+            raise ValueError(f"Unsupported search mode: {self.search_mode}")
+        # an index saved without BM25 postings can only be searched densely
+        return self.search_mode if self.bm25 is not None else "dense"
+
+    def allowed_ids(self, filter: Optional[Dict[str, Any]]) -> Optional[np.ndarray]:
+        # {"source": url} or {"source": [url, ...], "title": title} -> sorted row ids matching every field
+        if not filter:
+            return None
+        allowed = None
+        for field, value in filter.items():
+            values = list(value) if isinstance(value, (list, tuple, set)) else [value]
+            ids = np.unique(np.array(self.docstore.ids_for_field(field, values), dtype=np.int64))
+            allowed = ids if allowed is None else np.intersect1d(allowed, ids)
+        return allowed
+
+    def prepare_vectors(self, vectors) -> np.ndarray:
+        vectors = np.array(vectors, dtype=np.float32)
+        if self.index_spec.metric == "ip":
+            faiss.normalize_L2(vectors)
+        return vectors
+
+    def dense_search(self, vectors, k, allowed: Optional[np.ndarray] = None) -> List[List[Tuple[int, float]]]:
+        vectors = self.prepare_vectors(vectors)
+        rerank = self.full_vectors is not None and self.index_spec.rerank_k > 0
+        final_k, k = k, max(k, self.index_spec.rerank_k) if rerank else k
+        with span("retriever.dense_search", index=self.index_spec.kind, filtered=allowed is not None):
+            if allowed is None:
+                distances, indices = self.index.search(vectors, k)
+            else:
+                # the selector is applied inside the scan, so filtered queries still get k hits when k exist
+                selector = faiss.IDSelectorBatch(allowed)
+                if self.index_spec.is_ivf:
+                    params = faiss.SearchParametersIVF(sel=selector, nprobe=self.index_spec.nprobe)
+                elif self.index_spec.kind == "hnsw":
+                    params = faiss.SearchParametersHNSW(sel=selector, efSearch=self.index_spec.ef_search)
+                else:
+                    params = faiss.SearchParameters(sel=selector)
+                distances, indices = self.index.search(vectors, k, params=params)
+        if rerank:
+            # the compressed codes only pick the candidates, their order comes from the float32 vectors
+            rows = []
+            with span("retriever.rerank"):
+                for vector, row_ids in zip(vectors, indices):
+                    row_ids = row_ids[row_ids != -1]
+                    scores, positions = exact_rerank(self.full_vectors.get(row_ids), vector,
+                                                     np.arange(len(row_ids)), final_k, self.index_spec.metric)
+                    rows.append([(int(row_ids[i]), float(score)) for i, score in zip(positions, scores)])
+            return rows
+        # -1 happens when not enough docs are returned. L2 distances are negated so higher is better.
+        sign = 1.0 if self.index_spec.metric == "ip" else -1.0
+        return [[(int(idx_id), sign * float(distance)) for idx_id, distance in zip(row_ids, row_distances)
+                 if idx_id != -1]
+                for row_ids, row_distances in zip(indices, distances)]
+
+    def candidate_vectors(self, ids: np.ndarray) -> np.ndarray:
+        # exact vectors when they are kept, otherwise as decoded from the index (approximate for PQ/SQ/PCA)
+        if self.full_vectors is not None:
+            return self.full_vectors.get(ids)
+        return self.index.reconstruct_batch(np.asarray(ids, dtype=np.int64))
+
+    def mmr(self, row: List[Tuple[int, float]], query_vector, max_docs: int,
+            mmr_lambda: float) -> List[Tuple[int, float]]:
+        if len(row) <= 1:
+            return row
+        vectors = self.candidate_vectors(np.array([idx_id for idx_id, _ in row], dtype=np.int64))
+        selected = maximal_marginal_relevance(vectors, query_vector, [score for _, score in row], max_docs, mmr_lambda)
+        return [row[i] for i in selected]
+
+    def search_scored(self, queries, vectors, max_docs, filter: Optional[Dict[str, Any]] = None,
+                      mmr_lambda: Optional[float] = None, fetch_k: int = 20) -> List[List[Tuple[int, float]]]:
+        # (row id, score) pairs per query, best first. With mmr_lambda the best fetch_k candidates are
+        # re-ranked for diversity, 1.0 is pure relevance and 0.0 pure diversity.
+        allowed = self.allowed_ids(filter)
+        if allowed is not None and not len(allowed):
+            return [[] for _ in queries]
+        k = max(max_docs, fetch_k) if mmr_lambda is not None else max_docs
+        if self.mode == "dense":
+            rows = self.dense_search(vectors, k, allowed)
+        elif self.mode == "lexical":
+            with span("retriever.lexical_search"):
+                rows = [self.bm25.search_scored(query, k, allowed) for query in queries]
+        else:
+            candidates = max(k, self.fusion_candidates)
+            dense = self.dense_search(vectors, candidates, allowed)
+            with span("retriever.lexical_search"):
+                lexical = [self.bm25.search_scored(query, candidates, allowed) for query in queries]
+            rows = [reciprocal_rank_fusion([[idx_id for idx_id, _ in dense_row], [idx_id for idx_id, _ in lexical_row]],
+                                           k=self.rrf_k, limit=k)
+                    for dense_row, lexical_row in zip(dense, lexical)]
+        if mmr_lambda is not None:
+            with span("retriever.mmr"):
+                rows = [self.mmr(row, vectors[i] if vectors is not None else None, max_docs, mmr_lambda)
+                        for i, row in enumerate(rows)]
+        return [row[:max_docs] for row in rows]
+
+    def embed_queries(self, queries) -> Optional[np.ndarray]:
+        count("retriever.queries", len(queries), mode=self.mode)
+        if self.mode == "lexical":
+            return None
+        with span("retriever.embed_query"):
+            if len(queries) == 1:
+                return np.array([self.embedder.embed_query(queries[0])], dtype=np.float32)
+            # one embedding request for the whole batch
+            return np.array(self.embedder.embed_documents(list(queries)), dtype=np.float32)
+
+    def retrieve_scored_docs_batch(self, queries, max_docs=5, filter: Optional[Dict[str, Any]] = None,
+                                   mmr_lambda: Optional[float] = None, fetch_k=20) -> List[List[ScoredDocument]]:
+        if not queries:
+            return []
+        rows = self.search_scored(list(queries), self.embed_queries(list(queries)), max_docs, filter, mmr_lambda,
+                                  fetch_k)
+        return self.resolve_documents(rows)
+
+    def retrieve_scored_docs(self, query, max_docs=5, filter: Optional[Dict[str, Any]] = None,
+                             mmr_lambda: Optional[float] = None, fetch_k=20) -> List[ScoredDocument]:
+        return self.retrieve_scored_docs_batch([query], max_docs, filter, mmr_lambda, fetch_k)[0]
+
+    async def aretrieve_scored_docs(self, query, max_docs=5, filter: Optional[Dict[str, Any]] = None,
+                                    mmr_lambda: Optional[float] = None, fetch_k=20) -> List[ScoredDocument]:
+        return (await self.aretrieve_scored_docs_with_vector(query, max_docs, filter, mmr_lambda, fetch_k))[0]
+
+    async def aretrieve_scored_docs_with_vector(self, query, max_docs=5, filter: Optional[Dict[str, Any]] = None,
+                                                mmr_lambda: Optional[float] = None,
+                                                fetch_k=20) -> Tuple[List[ScoredDocument], Optional[np.ndarray]]:
+        vectors = None
+        count("retriever.queries", mode=self.mode)
+        if self.mode != "lexical":
+            with span("retriever.embed_query"):
+                if hasattr(self.embedder, "aembed_query"):
+                    embedding = await self.embedder.aembed_query(query)
+                else:
+                    embedding = await asyncio.to_thread(self.embedder.embed_query, query)
+            vectors = np.array([embedding], dtype=np.float32)
+        # FAISS releases the GIL while searching, so other sessions keep running meanwhile
+        rows = await asyncio.to_thread(self.search_scored, [query], vectors, max_docs, filter, mmr_lambda, fetch_k)
+        return self.resolve_documents(rows)[0], vectors
+
+    def retrieve_similar_docs(self, query, max_docs=5, filter: Optional[Dict[str, Any]] = None,
+                              mmr_lambda: Optional[float] = None) -> List[Document]:
+        return [scored.document for scored in self.retrieve_scored_docs(query, max_docs, filter, mmr_lambda)]
+
+    async def aretrieve_similar_docs(self, query, max_docs=5, filter: Optional[Dict[str, Any]] = None,
+                                     mmr_lambda: Optional[float] = None) -> List[Document]:
+        return [scored.document for scored in await self.aretrieve_scored_docs(query, max_docs, filter, mmr_lambda)]
+
+    def retrieve_similar_docs_with_vector(self, query, max_docs=5, filter: Optional[Dict[str, Any]] = None,
+                                          mmr_lambda: Optional[float] = None
+                                          ) -> Tuple[List[Document], Optional[np.ndarray]]:
+        # the query vector is None in lexical mode, the query is never embedded then
+        vectors = self.embed_queries([query])
+        rows = self.search_scored([query], vectors, max_docs, filter, mmr_lambda, 20)
+        return [scored.document for scored in self.resolve_documents(rows)[0]], vectors
+
+    async def aretrieve_similar_docs_with_vector(self, query, max_docs=5, filter: Optional[Dict[str, Any]] = None,
+                                                 mmr_lambda: Optional[float] = None
+                                                 ) -> Tuple[List[Document], Optional[np.ndarray]]:
+        scored_docs, vectors = await self.aretrieve_scored_docs_with_vector(query, max_docs, filter, mmr_lambda)
+        return [scored.document for scored in scored_docs], vectors
 
-        # scores can be used later
-        return [doc for doc, _ in docs_and_scores[:max_docs]]
+    def retrieve_similar_docs_batch(self, queries, max_docs=5, filter: Optional[Dict[str, Any]] = None,
+                                    mmr_lambda: Optional[float] = None) -> List[List[Document]]:
+        return [[scored.document for scored in row]
+                for row in self.retrieve_scored_docs_batch(queries, max_docs, filter, mmr_lambda)]
+
+    def retrieve_similar_docs_batch_with_vectors(self, queries, max_docs=5, filter: Optional[Dict[str, Any]] = None,
+                                                 mmr_lambda: Optional[float] = None
+                                                 ) -> Tuple[List[List[Document]], Optional[np.ndarray]]:
+        if not queries:
+            return [], None
+        vectors = self.embed_queries(list(queries))
+        rows = self.search_scored(list(queries), vectors, max_docs, filter, mmr_lambda, 20)
+        return [[scored.document for scored in row] for row in self.resolve_documents(rows)], vectors
 
     @classmethod
-    def from_documents(cls, docs, split_docs, embedder, **kwargs) -> 'FAISSVectorIndex':
+    def from_documents(cls, docs, split_docs, embedder, index_spec: Optional[IndexSpec] = None,
+                       checkpoint_dir=None, checkpoint_every=500, max_batch_tokens=8000, max_in_flight=4,
+                       bm25=None, search_mode="dense", spill_dir=None, **kwargs) -> 'FAISSVectorIndex':
+        # docs can be any iterable, chunks are embedded batch by batch and added to the index as
+        # each batch completes. With a checkpoint_dir the build resumes after the last saved batch.
+        # Each checkpoint rewrites the FAISS index and BM25 postings in full, see save_checkpoint.
+        # With a spill_dir the chunk texts and float32 vectors are moved there every checkpoint_every
+        # batches, so a corpus streamed from a loader never has to fit in memory as text. Checkpoints
+        # release them the same way, so spill_dir is only used without a checkpoint_dir.
         if split_docs:
             ds = DocumentSplitter(**kwargs)
-            docs = ds.split_documents(docs)
-        texts = [doc.content for doc in docs]
-        embeddings = embedder.embed_documents(texts)
-        index = faiss.IndexFlatL2(len(embeddings[0]))
+            docs = ds.iter_split_documents(docs)
+        pipeline = EmbeddingPipeline(embedder=embedder, max_batch_tokens=max_batch_tokens,
+                                     max_in_flight=max_in_flight)
+        index_spec = index_spec or IndexSpec()
+
+        inst, batches_done = None, 0
+        if checkpoint_dir is not None:
+            inst, batches_done = cls.load_checkpoint(checkpoint_dir, embedder)
+            if inst is not None:
+                print(f"Resuming index build after {batches_done} committed batches.")
 
-        inst = cls(embedder=embedder, docstore=DocStore(), index=index, index_to_docstore_id={})
-        inst.add_to_index(docs, texts, embeddings)
+        for batch_no, batch, embeddings in pipeline.run(docs, skip_batches=batches_done):
+            if inst is None:
+                inst = cls.empty(embedder, embeddings.shape[1], index_spec, bm25, search_mode)
+            inst.add_to_index(batch, [doc.content for doc in batch], embeddings)
+            batches_done = batch_no + 1
+            # batches waiting for training only live in memory, so there is nothing to checkpoint yet
+            if checkpoint_dir is not None and batches_done % checkpoint_every == 0 and not inst.training_pending:
+                inst.save_checkpoint(checkpoint_dir, batches_done)
+            if spill_dir is not None and checkpoint_dir is None and batches_done % checkpoint_every == 0:
+                inst.spill(spill_dir)
 
+        if inst is None:
+            raise ValueError("Cannot build an index without any documents.")
+        inst.train_pending()
+        if checkpoint_dir is not None:
+            inst.save_checkpoint(checkpoint_dir, batches_done)
+        if spill_dir is not None and checkpoint_dir is None:
+            inst.spill(spill_dir)
         return inst
 
-    def add_to_index(self, documents, texts, embeddings) -> List[str]:
-        # Add to the index.
-        vector = np.array(embeddings, dtype=np.float32)
-        # if self._normalize_L2:
-        #     faiss.normalize_L2(vector)
-        self.index.add(vector)
+    @classmethod
+    def empty(cls, embedder, dim, index_spec: IndexSpec, bm25=None, search_mode="dense") -> 'FAISSVectorIndex':
+        # bm25=None builds the postings only when the search mode uses them, True also builds them for a
+        # dense index so it can be switched to hybrid later
+        if bm25 is None:
+            bm25 = search_mode != "dense"
+        return cls(embedder=embedder, docstore=DocStore(), index=build_index(index_spec, dim), index_spec=index_spec,
+                   bm25=BM25Index() if bm25 else None, search_mode=search_mode,
+                   full_vectors=FullPrecisionVectors(dim=dim) if index_spec.rerank_k else None)
+
+    def add_documents(self, docs, split_docs, max_batch_tokens=8000, max_in_flight=4, **kwargs) -> List[int]:
+        if split_docs:
+            ds = DocumentSplitter(**kwargs)
+            docs = ds.iter_split_documents(docs)
+        pipeline = EmbeddingPipeline(embedder=self.embedder, max_batch_tokens=max_batch_tokens,
+                                     max_in_flight=max_in_flight)
+        ids = []
+        for _, batch, embeddings in pipeline.run(docs):
+            ids.extend(self.add_to_index(batch, [doc.content for doc in batch], embeddings))
+        return ids
+
+    def check_writable(self):
+        # FAISS aborts the whole process on some writes to a mapped index, so they are refused here
+        if self.mmapped:
+            raise ValueError("Cannot modify an index loaded with mmap=True, load it with mmap=False instead.")
+
+    def check_deletable(self):
+        # FAISS HNSW graphs have no remove_ids, so pages can't be deleted or upserted in place
+        self.check_writable()
+        if self.index_spec.kind == "hnsw":
+            raise ValueError("Cannot delete documents from an hnsw index, rebuild it or use another index kind.")
+
+    def add_to_index(self, documents, texts, embeddings) -> List[int]:
+        self.check_writable()
+        # Add to the index, normalized first for inner product indexes.
+        vector = self.prepare_vectors(embeddings)
 
         # Add information to docstore and index.
-        ids = [str(uuid.uuid4()) for _ in texts]
-        self.docstore.add({_id: doc for _id, doc in zip(ids, documents)})
-        starting_len = len(self.index_to_docstore_id)
-        index_to_id = {starting_len + i: _id for i, _id in enumerate(ids)}
-        self.index_to_docstore_id.update(index_to_id)
+        ids = self.docstore.add(documents)
+        index_ids = np.array(ids, dtype=np.int64)
+        if self.full_vectors is not None:
+            self.full_vectors.add(ids, vector)
+        if self.bm25 is not None:
+            self.bm25.add(ids, texts)
+        if self.index.is_trained:
+            self.index.add_with_ids(vector, index_ids)
+        else:
+            self._train_buffer.append((index_ids, vector))
+            if sum(len(ids) for ids, _ in self._train_buffer) >= self.index_spec.train_sample_size:
+                self.train_pending()
         return ids
 
+    def spill(self, folder_path) -> None:
+        # the rows added since the last spill are read back from folder_path, which has to outlive the index
+        self.docstore.spill(folder_path)
+        if self.full_vectors is not None:
+            self.full_vectors.save(folder_path)
+
+    @property
+    def training_pending(self) -> bool:
+        return bool(self._train_buffer)
+
+    def train_pending(self) -> None:
+        # trains on everything buffered so far, then adds the buffered vectors
+        if not self._train_buffer:
+            return
+        index_ids = np.concatenate([ids for ids, _ in self._train_buffer])
+        vectors = np.concatenate([vectors for _, vectors in self._train_buffer])
+        self._train_buffer = []
+        # the spec is replaced too when training had to reduce nlist, so it describes the saved index
+        self.index, self.index_spec = train_index(self.index_spec, self.index, vectors)
+        self.index.add_with_ids(vectors, index_ids)
+
+    def set_search_params(self, nprobe: Optional[int] = None, ef_search: Optional[int] = None,
+                          rerank_k: Optional[int] = None) -> None:
+        if rerank_k is not None:
+            # only has an effect when the index was built with rerank_k, so the float32 vectors exist
+            self.index_spec.rerank_k = rerank_k
+        if nprobe is not None and self.index_spec.is_ivf:
+            self.index_spec.nprobe = nprobe
+            apply_search_params(self.index, nprobe=nprobe)
+        if ef_search is not None and self.index_spec.kind == "hnsw":
+            self.index_spec.ef_search = ef_search
+            apply_search_params(self.index, ef_search=ef_search)
+
+    def delete_documents(self, sources) -> int:
+        # removes every chunk that was split from one of the given source URLs
+        self.check_deletable()
+        index_ids = self.docstore.ids_for_sources(set(sources))
+        if not index_ids:
+            return 0
+        self.index.remove_ids(np.array(index_ids, dtype=np.int64))
+        if self.bm25 is not None:
+            self.bm25.delete(index_ids)
+        self.docstore.delete(index_ids)
+        return len(index_ids)
+
+    def upsert_documents(self, docs, split_docs, **kwargs) -> List[int]:
+        # replaces the chunks of every page in docs, pages that are not in docs are left untouched
+        self.delete_documents({doc.source for doc in docs})
+        return self.add_documents(docs, split_docs, **kwargs)
+
     def save_local(self, folder_path) -> None:
+        self.train_pending()
         path = Path(folder_path)
         path.mkdir(exist_ok=True, parents=True)
 
         # save index separately since it is not picklable
         faiss.write_index(self.index, str(path / "faiss_index.faiss"))
 
-        # save docstore and index_to_docstore_id
-        with open(path / "faiss_index.pkl", "wb") as f:
-            pickle.dump((self.docstore, self.index_to_docstore_id), f)
+        # the docstore writes its own memory-mappable files next to the index
+        self.docstore.save(path)
+        if self.bm25 is not None:
+            self.bm25.save(path)
+        if self.full_vectors is not None:
+            self.full_vectors.save(path)
+        with open(path / "faiss_index.json", "w") as f:
+            json.dump({"index_spec": self.index_spec.dict(), "search_mode": self.search_mode}, f)
 
     @classmethod
-    def load_local(cls, folder_path, embedder) -> 'FAISSVectorIndex':
+    def load_local(cls, folder_path, embedder, mmap=False) -> 'FAISSVectorIndex':
+        # with mmap the FAISS index is paged in from the file like the docstore, and processes serving
+        # the same files share one copy in the page cache. Such an index is read only.
         path = Path(folder_path)
 
         # load index separately since it is not picklable
-        index = faiss.read_index(str(path / "faiss_index.faiss"))
+        index = faiss.read_index(str(path / "faiss_index.faiss"), MMAP_FLAG if mmap else 0)
+
+        # documents are only read from disk once a search hits them
+        docstore = DocStore.load(path)
+        with open(path / "faiss_index.json") as f:
+            meta = json.load(f)
+        bm25 = BM25Index.load(path) if BM25Index.exists(path) else None
+        full_vectors = None
+        if FullPrecisionVectors.exists(path):
+            full_vectors = FullPrecisionVectors.load(path, index.d, len(docstore))
 
-        # load docstore and index_to_docstore_id
-        with open(path / "faiss_index.pkl", "rb") as f:
-            docstore, index_to_docstore_id = pickle.load(f)
+        return cls(embedder=embedder, docstore=docstore, index=index, index_spec=IndexSpec(**meta["index_spec"]),
+                   bm25=bm25, search_mode=meta.get("search_mode", "dense"), full_vectors=full_vectors,
+                   mmapped=mmap)
 
-        return cls(embedder=embedder, docstore=docstore, index=index,
-                   index_to_docstore_id=index_to_docstore_id)
+    def save_checkpoint(self, checkpoint_dir, batches_done) -> None:
+        # write the new checkpoint next to the old one and only then swap it in,
+        # so a crash mid-save still leaves a consistent checkpoint to resume from.
+        # The docstore blob and the float32 vectors are append-only, so the new checkpoint hard-links
+        # the previous one's files and only appends the rows added since; the previous checkpoint
+        # only ever reads the prefix it had. The FAISS index and the BM25 postings have no such
+        # layout and are written in full, which is what checkpoint_every should be sized against.
+        path = Path(checkpoint_dir)
+        tmp_path, current_path, old_path = path / "checkpoint.tmp", path / "checkpoint", path / "checkpoint.old"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        tmp_path.mkdir(parents=True)
+        for name in (DOCSTORE_BLOB, FULL_VECTORS):
+            if (current_path / name).exists():
+                try:
+                    os.link(current_path / name, tmp_path / name)
+                except OSError:
+                    # no hard links on this filesystem, the files are copied in full instead
+                    pass
+        self.save_local(tmp_path)
+        with open(tmp_path / "progress.json", "w") as f:
+            json.dump({"batches": batches_done}, f)
+        if current_path.exists():
+            shutil.rmtree(old_path, ignore_errors=True)
+            current_path.rename(old_path)
+        tmp_path.rename(current_path)
+        shutil.rmtree(old_path, ignore_errors=True)
+        # the saved rows are read back from the checkpoint from now on instead of kept in memory
+        self.docstore.release_saved(current_path)
+
+    @classmethod
+    def load_checkpoint(cls, checkpoint_dir, embedder) -> Tuple[Optional['FAISSVectorIndex'], int]:
+        path = Path(checkpoint_dir)
+        for name in ("checkpoint", "checkpoint.old"):
+            progress_path = path / name / "progress.json"
+            if progress_path.exists():
+                with open(progress_path) as f:
+                    batches_done = json.load(f)["batches"]
+                return cls.load_local(path / name, embedder), batches_done
+        return None, 0
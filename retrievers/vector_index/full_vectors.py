@@ -0,0 +1,91 @@
+import os
+import numpy as np
+from pathlib import Path
+from typing import Any, Sequence
+from pydantic import BaseModel, PrivateAttr
+
+# float32 matrix with one row per docstore row id, written next to the FAISS index by save_local
+FULL_VECTORS = "faiss_vectors.f32"
+
+
+class FullPrecisionVectors(BaseModel):
+    """The float32 vectors behind a compressed index, used to re-score its top candidates exactly.
+
+    Rows loaded from disk are memory-mapped, so only the candidates' pages are ever read. Rows added
+    since are kept in memory until the next save appends them to the file.
+    """
+    dim: int
+
+    _mapped: Any = PrivateAttr(default=None)
+    _mapped_rows: int = PrivateAttr(default=0)
+    _pending: list = PrivateAttr(default_factory=list)
+    _pending_rows: int = PrivateAttr(default=0)
+    # (device, inode) of the file the rows were last saved to
+    _saved_file: Any = PrivateAttr(default=None)
+
+    def __len__(self) -> int:
+        return self._mapped_rows + self._pending_rows
+
+    def add(self, ids: Sequence[int], vectors: np.ndarray):
+        # row ids come from the docstore, which hands them out consecutively
+        if len(ids) and ids[0] != len(self):
+            raise ValueError(f"Expected row id {len(self)}, got {ids[0]}")
+        self._pending.append(np.asarray(vectors, dtype=np.float32))
+        self._pending_rows += len(ids)
+
+    def get(self, ids: np.ndarray) -> np.ndarray:
+        ids = np.asarray(ids, dtype=np.int64)
+        if self._pending and ids.size and ids.max() >= self._mapped_rows:
+            self._pending = [np.concatenate(self._pending)]
+        result = np.empty((len(ids), self.dim), dtype=np.float32)
+        mapped = ids < self._mapped_rows
+        if mapped.any():
+            result[mapped] = self._mapped[ids[mapped]]
+        if not mapped.all():
+            result[~mapped] = self._pending[0][ids[~mapped] - self._mapped_rows]
+        return result
+
+    @staticmethod
+    def file_id(path: Path):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return stat.st_dev, stat.st_ino
+
+    def save(self, folder_path):
+        path = Path(folder_path) / FULL_VECTORS
+        if self._saved_file is not None and self._saved_file == self.file_id(path):
+            # the same file is only appended to, readers mapping the old rows are unaffected
+            with open(path, "r+b") as f:
+                f.seek(self._mapped_rows * self.dim * 4)
+                f.truncate()
+                for vectors in self._pending:
+                    f.write(vectors.tobytes())
+        else:
+            tmp_path = path.with_name(path.name + ".tmp")
+            with open(tmp_path, "wb") as f:
+                for start in range(0, self._mapped_rows, 65536):
+                    f.write(np.ascontiguousarray(self._mapped[start:start + 65536]).tobytes())
+                for vectors in self._pending:
+                    f.write(vectors.tobytes())
+            os.replace(tmp_path, path)
+        rows = len(self)
+        self._pending, self._pending_rows = [], 0
+        self.open(path, rows)
+
+    def open(self, path: Path, rows: int):
+        self._mapped_rows = rows
+        self._mapped = np.memmap(path, dtype=np.float32, mode="r", shape=(rows, self.dim)) if rows else None
+        self._saved_file = self.file_id(path)
+
+    @classmethod
+    def exists(cls, folder_path) -> bool:
+        return (Path(folder_path) / FULL_VECTORS).exists()
+
+    @classmethod
+    def load(cls, folder_path, dim: int, rows: int) -> 'FullPrecisionVectors':
+        # rows comes from the docstore, a save interrupted while appending may have left a partial tail
+        inst = cls(dim=dim)
+        inst.open(Path(folder_path) / FULL_VECTORS, rows)
+        return inst
@@ -0,0 +1,214 @@
+import time
+import warnings
+import faiss
+import numpy as np
+from typing import Dict, List, Optional, Sequence, Tuple
+from pydantic import BaseModel
+
+# index kinds selectable from get_retriever:
+#   flat     - exact brute-force search (IndexFlatL2)
+#   sq8      - exact scan over 8-bit scalar quantized vectors, 4x smaller than flat
+#   ivf_flat - inverted file over nlist clusters, nprobe clusters are scanned per query
+#   ivf_pq   - inverted file with product quantized codes, pq_m bytes per vector at 8 bits
+#   hnsw     - graph index, efSearch trades recall for latency, does not support deletes
+index_kinds = ["flat", "sq8", "ivf_flat", "ivf_pq", "hnsw"]
+# l2: squared euclidean distance. ip: vectors are L2 normalized and compared by inner product (cosine)
+metrics = ["l2", "ip"]
+# how flat, ivf_flat and hnsw store each vector: 4, 2 or 1 bytes per dimension
+storage_codes = {"float32": "Flat", "float16": "SQfp16", "int8": "SQ8"}
+# trained projections applied before indexing, pca keeps the top reduced_dim components and
+# opq additionally rotates them so they quantize with less error
+reductions = ["pca", "opq"]
+
+
+class IndexSpec(BaseModel):
+    kind: str = "flat"
+    nlist: int = 1024
+    pq_m: int = 16
+    pq_nbits: int = 8
+    hnsw_m: int = 32
+    ef_construction: int = 200
+    metric: str = "l2"
+    storage: str = "float32"
+    reduction: Optional[str] = None
+    reduced_dim: int = 256
+    # opq subspaces, reduced_dim has to be a multiple of it
+    opq_m: int = 16
+    # query time parameters, can be changed later with FAISSVectorIndex.set_search_params
+    nprobe: int = 16
+    ef_search: int = 64
+    # the best rerank_k candidates are re-scored exactly against the float32 vectors kept on disk, 0 disables
+    rerank_k: int = 0
+    # trainable indexes buffer this many vectors before training, the rest are added after
+    train_sample_size: int = 100_000
+
+    @property
+    def requires_training(self) -> bool:
+        return self.kind in ("sq8", "ivf_flat", "ivf_pq") or self.storage == "int8" or self.reduction is not None
+
+    @property
+    def is_ivf(self) -> bool:
+        return self.kind in ("ivf_flat", "ivf_pq")
+
+    @property
+    def faiss_metric(self) -> int:
+        if self.metric not in metrics:
+            raise ValueError(f"Unsupported metric: {self.metric}")
+        return faiss.METRIC_INNER_PRODUCT if self.metric == "ip" else faiss.METRIC_L2
+
+    def prefix(self) -> str:
+        if self.reduction is None:
+            return ""
+        if self.reduction == "pca":
+            return f"PCA{self.reduced_dim},"
+        if self.reduction == "opq":
+            return f"OPQ{self.opq_m}_{self.reduced_dim},"
+        raise ValueError(f"Unsupported reduction: {self.reduction}")
+
+    def factory_string(self) -> str:
+        codes = storage_codes.get(self.storage)
+        if codes is None:
+            raise ValueError(f"Unsupported storage: {self.storage}")
+        if self.kind == "flat":
+            return self.prefix() + codes
+        if self.kind == "sq8":
+            return self.prefix() + "SQ8"
+        if self.kind == "ivf_flat":
+            return self.prefix() + f"IVF{self.nlist},{codes}"
+        if self.kind == "ivf_pq":
+            return self.prefix() + f"IVF{self.nlist},PQ{self.pq_m}x{self.pq_nbits}"
+        if self.kind == "hnsw":
+            return self.prefix() + (f"HNSW{self.hnsw_m}" if codes == "Flat" else f"HNSW{self.hnsw_m}_{codes}")
+        raise ValueError(f"Unsupported index kind: {self.kind}")
+
+
+def base_index(index):
+    # the index under a PCA/OPQ pre-transform, or the index itself
+    if isinstance(index, faiss.IndexPreTransform):
+        return faiss.downcast_index(index.index)
+    return index
+
+
+def build_index(spec: IndexSpec, dim: int):
+    index = faiss.index_factory(dim, spec.factory_string(), spec.faiss_metric)
+    if spec.kind == "hnsw":
+        base_index(index).hnsw.efConstruction = spec.ef_construction
+    if spec.is_ivf:
+        # IVF indexes store ids natively, the hashtable direct map allows reconstruct and remove by id
+        faiss.extract_index_ivf(index).set_direct_map_type(faiss.DirectMap.Hashtable)
+    else:
+        index = faiss.IndexIDMap2(index)
+    apply_search_params(index, nprobe=spec.nprobe if spec.is_ivf else None,
+                        ef_search=spec.ef_search if spec.kind == "hnsw" else None)
+    return index
+
+
+def train_index(spec: IndexSpec, index, sample: np.ndarray) -> Tuple[object, IndexSpec]:
+    # returns the trained index and the spec it was built with, IVF indexes are rebuilt with fewer
+    # lists when the sample is too small and nprobe is clamped to the lists that are left
+    if spec.is_ivf and len(sample) < spec.nlist * 39:
+        nlist = max(1, len(sample) // 39)
+        warnings.warn(f"Only {len(sample)} training vectors for {spec.nlist} lists, using nlist={nlist} instead.")
+        spec = spec.copy(update={"nlist": nlist, "nprobe": min(spec.nprobe, nlist)})
+        index = build_index(spec, sample.shape[1])
+    index.train(sample)
+    return index, spec
+
+
+def apply_search_params(index, nprobe: Optional[int] = None, ef_search: Optional[int] = None):
+    params = faiss.ParameterSpace()
+    if nprobe is not None:
+        params.set_index_parameter(index, "nprobe", nprobe)
+    if ef_search is not None:
+        params.set_index_parameter(index, "efSearch", ef_search)
+
+
+def index_size_bytes(index) -> int:
+    return int(faiss.serialize_index(index).size)
+
+
+def exact_rerank(full_vectors: np.ndarray, query: np.ndarray, candidates: np.ndarray, k: int,
+                 metric: str) -> Tuple[np.ndarray, np.ndarray]:
+    # (scores, ids) of the best k candidates scored against the float32 vectors, higher scores are better
+    candidates = candidates[candidates != -1]
+    exact = np.asarray(full_vectors[candidates], dtype=np.float32)
+    if metric == "ip":
+        scores = exact @ query
+    else:
+        scores = -((exact - query) ** 2).sum(axis=1)
+    order = np.argsort(-scores, kind="stable")[:k]
+    return scores[order], candidates[order]
+
+
+def recall_latency_report(vectors: np.ndarray, queries: np.ndarray, specs: Sequence[IndexSpec],
+                          k: int = 10, nprobes: Sequence[int] = (1, 4, 16, 64),
+                          ef_searches: Sequence[int] = (16, 64, 256)) -> List[Dict]:
+    """Measures recall@k, per-query latency and memory of each spec against the exact flat index.
+
+    IVF specs are evaluated at every nprobe and HNSW specs at every efSearch so the
+    recall-vs-latency curve can be read off the returned rows. Specs with rerank_k get a second
+    row per setting with the candidates re-scored exactly, so the recall the compression costs
+    and what the re-rank wins back can be compared directly.
+    """
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    queries = np.ascontiguousarray(queries, dtype=np.float32)
+    float32_bytes = vectors.shape[1] * 4
+
+    rows = []
+    for spec in specs:
+        spec_vectors, spec_queries = vectors, queries
+        if spec.metric == "ip":
+            spec_vectors, spec_queries = vectors.copy(), queries.copy()
+            faiss.normalize_L2(spec_vectors)
+            faiss.normalize_L2(spec_queries)
+        exact = faiss.IndexFlat(vectors.shape[1], spec.faiss_metric)
+        exact.add(spec_vectors)
+        _, ground_truth = exact.search(spec_queries, k)
+
+        start = time.perf_counter()
+        index = build_index(spec, vectors.shape[1])
+        if spec.requires_training:
+            sample_size = min(len(vectors), spec.train_sample_size)
+            sample = spec_vectors[np.random.default_rng(0).choice(len(vectors), sample_size, replace=False)]
+            index, spec = train_index(spec, index, sample)
+        index.add_with_ids(spec_vectors, np.arange(len(vectors), dtype=np.int64))
+        build_seconds = time.perf_counter() - start
+        size_bytes = index_size_bytes(index)
+
+        if spec.is_ivf:
+            settings = [{"nprobe": nprobe} for nprobe in nprobes]
+        elif spec.kind == "hnsw":
+            settings = [{"ef_search": ef_search} for ef_search in ef_searches]
+        else:
+            settings = [{}]
+
+        for setting in settings:
+            apply_search_params(index, **setting)
+            for rerank_k in sorted({0, spec.rerank_k}):
+                latencies = []
+                found = np.full_like(ground_truth, -1)
+                for i in range(len(queries)):
+                    start = time.perf_counter()
+                    _, candidates = index.search(spec_queries[i:i + 1], max(k, rerank_k))
+                    if rerank_k:
+                        _, candidates = exact_rerank(spec_vectors, spec_queries[i], candidates[0], k, spec.metric)
+                    ids = np.ravel(candidates)[:k]
+                    found[i, :len(ids)] = ids
+                    latencies.append(time.perf_counter() - start)
+                hits = sum(len(np.intersect1d(found[i], ground_truth[i])) for i in range(len(queries)))
+                latencies_ms = np.array(latencies) * 1000
+                rows.append({
+                    "index": spec.factory_string(),
+                    "metric": spec.metric,
+                    **setting,
+                    "rerank_k": rerank_k,
+                    "recall_at_k": hits / ground_truth.size,
+                    "latency_p50_ms": float(np.percentile(latencies_ms, 50)),
+                    "latency_p99_ms": float(np.percentile(latencies_ms, 99)),
+                    "build_seconds": build_seconds,
+                    "size_bytes": size_bytes,
+                    "bytes_per_vector": size_bytes / len(vectors),
+                    # against raw float32 storage, the re-rank vectors live on disk and are not counted
+                    "compression": float32_bytes * len(vectors) / size_bytes,
+                })
+    return rows
@@ -0,0 +1,324 @@
+import hashlib
+import heapq
+import itertools
+import json
+import queue
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+from pydantic import PrivateAttr
+from document import Document, ScoredDocument
+from instrumentation import span
+from retriever import Retriever
+from faiss_vector_index import FAISSVectorIndex, maximal_marginal_relevance
+from index_factory import IndexSpec
+from bm25_index import reciprocal_rank_fusion
+
+# on disk layout written by ShardedFAISSIndex.save_local:
+#   sharded_index.json - the number of shards
+#   shard_000/ ...     - one FAISSVectorIndex.save_local folder per shard
+SHARDED_META = "sharded_index.json"
+# FAISSVectorIndex.from_documents arguments naming a directory the build writes to
+shard_dir_args = ["checkpoint_dir", "spill_dir"]
+
+
+def shard_for_source(source: Optional[str], num_shards: int) -> int:
+    # a stable hash, python's hash() of a str changes between processes
+    digest = hashlib.blake2b((source or "").encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little") % num_shards
+
+
+def shard_path(folder_path, shard: int) -> Path:
+    return Path(folder_path) / f"shard_{shard:03d}"
+
+
+def peek(docs: Iterable[Document]) -> Optional[Iterator[Document]]:
+    # the same documents, or None when there are none, without reading past the first one
+    docs = iter(docs)
+    for first in docs:
+        return itertools.chain([first], docs)
+    return None
+
+
+def shard_kwargs(kwargs: Dict[str, Any], shard: int) -> Dict[str, Any]:
+    # shards are built at the same time, so each one checkpoints and spills into its own subdirectory
+    return {key: shard_path(value, shard) if key in shard_dir_args and value is not None else value
+            for key, value in kwargs.items()}
+
+
+class ShardedFAISSIndex(Retriever):
+    """Partitions pages across FAISSVectorIndex shards by source hash and searches them in parallel.
+
+    All chunks of a page live in the same shard, so deletes and upserts touch a single shard and one
+    shard can be rebuilt from its pages without touching the others. Result ids are global ids,
+    row_id * num_shards + shard.
+    """
+    embedder: Any
+    shards: List[FAISSVectorIndex]
+    # threads searching, saving and loading shards, defaults to one per shard. FAISS releases the GIL
+    # while it searches, so the shards really are scanned on separate cores.
+    max_workers: Optional[int] = None
+
+    _executor: Any = PrivateAttr(default=None)
+
+    def __init__(self, **data):
+        super().__init__(**data)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers or len(self.shards),
+                                            thread_name_prefix="faiss-shard")
+
+    @property
+    def num_shards(self) -> int:
+        return len(self.shards)
+
+    def partition(self, docs: Iterable[Document]) -> List[List[Document]]:
+        parts = [[] for _ in range(self.num_shards)]
+        for doc in docs:
+            parts[shard_for_source(doc.source, self.num_shards)].append(doc)
+        return parts
+
+    @classmethod
+    def from_documents(cls, docs, split_docs, embedder, num_shards=4, index_spec: Optional[IndexSpec] = None,
+                       bm25=None, search_mode="dense", max_workers=None, prefetch=64,
+                       **kwargs) -> 'ShardedFAISSIndex':
+        # docs can be any iterable, this thread hands each page to its shard as it is read and every
+        # shard is split, embedded and indexed at the same time. At most prefetch pages wait per shard,
+        # so every shard has a builder thread of its own, one that isn't running would stall the others.
+        queues = [queue.Queue(maxsize=prefetch) for _ in range(num_shards)]
+        done, abort = object(), object()
+
+        def shard_docs(shard: int) -> Iterator[Document]:
+            while True:
+                doc = queues[shard].get()
+                if doc is done:
+                    return
+                if doc is abort:
+                    raise RuntimeError("Sharded index build aborted.")
+                yield doc
+
+        def build(shard: int) -> Optional[FAISSVectorIndex]:
+            part = peek(shard_docs(shard))
+            if part is None:
+                return None
+            return cls.build_shard(part, split_docs, embedder, index_spec, bm25, search_mode,
+                                   **shard_kwargs(kwargs, shard))
+
+        def put(shard: int, item, check=True):
+            while True:
+                try:
+                    queues[shard].put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    # a builder that stopped reading has failed, its error is raised here or by result()
+                    if futures[shard].done():
+                        if check:
+                            futures[shard].result()
+                        return
+
+        with ThreadPoolExecutor(max_workers=num_shards, thread_name_prefix="faiss-shard-build") as pool:
+            futures = [pool.submit(build, shard) for shard in range(num_shards)]
+            end = abort
+            try:
+                for doc in docs:
+                    put(shard_for_source(doc.source, num_shards), doc)
+                end = done
+            finally:
+                for shard in range(num_shards):
+                    put(shard, end, check=False)
+            shards = [future.result() for future in futures]
+
+        built = [shard for shard in shards if shard is not None]
+        if not built:
+            raise ValueError("Cannot build an index without any documents.")
+        # a shard that no page hashed to still needs an index of the same dimension to search
+        shards = [shard if shard is not None else cls.empty_shard(embedder, built[0].index.d, index_spec, bm25,
+                                                                 search_mode)
+                  for shard in shards]
+        return cls(embedder=embedder, shards=shards, max_workers=max_workers)
+
+    @staticmethod
+    def build_shard(docs, split_docs, embedder, index_spec, bm25, search_mode, **kwargs) -> FAISSVectorIndex:
+        # a spec of its own, set_search_params changes it in place
+        index_spec = index_spec.copy() if index_spec is not None else None
+        return FAISSVectorIndex.from_documents(docs, split_docs, embedder, index_spec=index_spec, bm25=bm25,
+                                               search_mode=search_mode, **kwargs)
+
+    @staticmethod
+    def empty_shard(embedder, dim, index_spec, bm25, search_mode) -> FAISSVectorIndex:
+        index_spec = index_spec.copy() if index_spec is not None else IndexSpec()
+        return FAISSVectorIndex.empty(embedder, dim, index_spec, bm25, search_mode)
+
+    def rebuild_shard(self, shard: int, docs, split_docs, **kwargs) -> FAISSVectorIndex:
+        # docs may be the whole corpus, only the pages that hash to this shard are indexed. The new
+        # shard is swapped in once it is complete, searches keep using the old one until then.
+        template = self.shards[shard]
+        part = peek(doc for doc in docs if shard_for_source(doc.source, self.num_shards) == shard)
+        if part is None:
+            self.shards[shard] = self.empty_shard(self.embedder, template.index.d, template.index_spec,
+                                                  template.bm25 is not None, template.search_mode)
+        else:
+            self.shards[shard] = self.build_shard(part, split_docs, self.embedder, template.index_spec,
+                                                  template.bm25 is not None, template.search_mode,
+                                                  **shard_kwargs(kwargs, shard))
+        return self.shards[shard]
+
+    def add_documents(self, docs, split_docs, **kwargs) -> List[int]:
+        ids = []
+        for shard, part in enumerate(self.partition(docs)):
+            if part:
+                ids.extend(row_id * self.num_shards + shard
+                           for row_id in self.shards[shard].add_documents(part, split_docs, **kwargs))
+        return ids
+
+    def delete_documents(self, sources) -> int:
+        by_shard = {}
+        for source in set(sources):
+            by_shard.setdefault(shard_for_source(source, self.num_shards), []).append(source)
+        # checked up front so a refused delete doesn't leave the pages of the first shards deleted
+        for shard in by_shard:
+            self.shards[shard].check_deletable()
+        return sum(self.shards[shard].delete_documents(shard_sources) for shard, shard_sources in by_shard.items())
+
+    def upsert_documents(self, docs, split_docs, **kwargs) -> List[int]:
+        self.delete_documents({doc.source for doc in docs})
+        return self.add_documents(docs, split_docs, **kwargs)
+
+    def shards_for_filter(self, filter: Optional[Dict[str, Any]]) -> List[int]:
+        # a source filter names the pages, so only the shards holding them need to be searched
+        if not filter or "source" not in filter:
+            return list(range(self.num_shards))
+        sources = filter["source"] if isinstance(filter["source"], (list, tuple, set)) else [filter["source"]]
+        return sorted({shard_for_source(source, self.num_shards) for source in sources})
+
+    def global_stats(self, query: str, shards: List[int]) -> Tuple[Dict[str, int], int, float]:
+        # BM25 statistics of the whole collection, so lexical scores from different shards are comparable
+        doc_freqs, num_docs, total_len = {}, 0, 0.0
+        for shard in shards:
+            shard_freqs, shard_docs, shard_len = self.shards[shard].bm25.collection_stats(query)
+            for token, freq in shard_freqs.items():
+                doc_freqs[token] = doc_freqs.get(token, 0) + freq
+            num_docs += shard_docs
+            total_len += shard_len
+        return doc_freqs, num_docs, total_len
+
+    def search_shard(self, shard: int, queries, vectors, k, filter, lexical_stats):
+        # (dense rows, lexical rows) of one shard, either is None when the search mode doesn't use it
+        index = self.shards[shard]
+        with span("retriever.shard_search", shard=shard):
+            allowed = index.allowed_ids(filter)
+            if allowed is not None and not len(allowed):
+                return [[] for _ in queries], [[] for _ in queries]
+            dense = index.dense_search(vectors, k, allowed) if index.mode != "lexical" else None
+            lexical = None
+            if index.mode != "dense":
+                lexical = [index.bm25.search_scored(query, k, allowed, stats)
+                           for query, stats in zip(queries, lexical_stats)]
+            return dense, lexical
+
+    def search_scored(self, queries, vectors, max_docs, filter: Optional[Dict[str, Any]] = None,
+                      mmr_lambda: Optional[float] = None, fetch_k: int = 20) -> List[List[Tuple[int, int, float]]]:
+        # (shard, row id, score) per query, best first. The query vectors are computed once and shared.
+        # Dense and lexical candidates are merged across shards first and only then fused, so a shard's
+        # local ranks never stand in for global ones.
+        mode = self.shards[0].mode
+        k = max(max_docs, fetch_k) if mmr_lambda is not None else max_docs
+        if mode == "hybrid":
+            k = max(k, self.shards[0].fusion_candidates)
+        # an empty shard has nothing to return, and an untrained IVF index can't be searched at all
+        shards = [shard for shard in self.shards_for_filter(filter) if self.shards[shard].index.ntotal]
+        lexical_stats = [None] * len(queries)
+        if mode != "dense":
+            lexical_stats = [self.global_stats(query, shards) for query in queries]
+        results = list(self._executor.map(
+            lambda shard: self.search_shard(shard, queries, vectors, k, filter, lexical_stats), shards))
+
+        def merged(i, which):
+            candidates = ((shard, row_id, score) for shard, shard_results in zip(shards, results)
+                          for row_id, score in shard_results[which][i])
+            return heapq.nlargest(k, candidates, key=lambda candidate: candidate[2])
+
+        rows = []
+        for i in range(len(queries)):
+            if mode == "hybrid":
+                dense, lexical = merged(i, 0), merged(i, 1)
+                fused = reciprocal_rank_fusion([[(shard, row_id) for shard, row_id, _ in dense],
+                                                [(shard, row_id) for shard, row_id, _ in lexical]],
+                                               k=self.shards[0].rrf_k, limit=k)
+                row = [(shard, row_id, score) for (shard, row_id), score in fused]
+            else:
+                row = merged(i, 0 if mode == "dense" else 1)
+            if mmr_lambda is not None and len(row) > 1:
+                candidate_vectors = np.concatenate([self.shards[shard].candidate_vectors(np.array([row_id]))
+                                                    for shard, row_id, _ in row])
+                selected = maximal_marginal_relevance(candidate_vectors,
+                                                      vectors[i] if vectors is not None else None,
+                                                      [score for _, _, score in row], max_docs, mmr_lambda)
+                row = [row[j] for j in selected]
+            rows.append(row[:max_docs])
+        return rows
+
+    def retrieve_scored_docs_batch(self, queries, max_docs=5, filter: Optional[Dict[str, Any]] = None,
+                                   mmr_lambda: Optional[float] = None, fetch_k=20) -> List[List[ScoredDocument]]:
+        if not queries:
+            return []
+        # every shard shares the embedder and search mode, so any of them can embed for all
+        vectors = self.shards[0].embed_queries(list(queries))
+        rows = self.search_scored(list(queries), vectors, max_docs, filter, mmr_lambda, fetch_k)
+        return [[ScoredDocument(document=self.shards[shard].docstore.search(row_id), score=score,
+                                id=row_id * self.num_shards + shard)
+                 for shard, row_id, score in row]
+                for row in rows]
+
+    def retrieve_scored_docs(self, query, max_docs=5, filter: Optional[Dict[str, Any]] = None,
+                             mmr_lambda: Optional[float] = None, fetch_k=20) -> List[ScoredDocument]:
+        return self.retrieve_scored_docs_batch([query], max_docs, filter, mmr_lambda, fetch_k)[0]
+
+    def retrieve_similar_docs(self, query, max_docs=5, filter: Optional[Dict[str, Any]] = None,
+                              mmr_lambda: Optional[float] = None) -> List[Document]:
+        return [scored.document for scored in self.retrieve_scored_docs(query, max_docs, filter, mmr_lambda)]
+
+    def retrieve_similar_docs_with_vector(self, query, max_docs=5, filter: Optional[Dict[str, Any]] = None,
+                                          mmr_lambda: Optional[float] = None
+                                          ) -> Tuple[List[Document], Optional[np.ndarray]]:
+        vectors = self.shards[0].embed_queries([query])
+        rows = self.search_scored([query], vectors, max_docs, filter, mmr_lambda, 20)
+        return [self.shards[shard].docstore.search(row_id) for shard, row_id, _ in rows[0]], vectors
+
+    def retrieve_similar_docs_batch(self, queries, max_docs=5, filter: Optional[Dict[str, Any]] = None,
+                                    mmr_lambda: Optional[float] = None) -> List[List[Document]]:
+        return [[scored.document for scored in row]
+                for row in self.retrieve_scored_docs_batch(queries, max_docs, filter, mmr_lambda)]
+
+    def retrieve_similar_docs_batch_with_vectors(self, queries, max_docs=5, filter: Optional[Dict[str, Any]] = None,
+                                                 mmr_lambda: Optional[float] = None
+                                                 ) -> Tuple[List[List[Document]], Optional[np.ndarray]]:
+        if not queries:
+            return [], None
+        vectors = self.shards[0].embed_queries(list(queries))
+        rows = self.search_scored(list(queries), vectors, max_docs, filter, mmr_lambda, 20)
+        return [[self.shards[shard].docstore.search(row_id) for shard, row_id, _ in row] for row in rows], vectors
+
+    def save_shard(self, folder_path, shard: int) -> None:
+        self.shards[shard].save_local(shard_path(folder_path, shard))
+
+    def load_shard(self, folder_path, shard: int) -> FAISSVectorIndex:
+        # picks up a shard that was rebuilt and saved by another process
+        self.shards[shard] = FAISSVectorIndex.load_local(shard_path(folder_path, shard), self.embedder)
+        return self.shards[shard]
+
+    def save_local(self, folder_path) -> None:
+        path = Path(folder_path)
+        path.mkdir(exist_ok=True, parents=True)
+        list(self._executor.map(lambda shard: self.save_shard(path, shard), range(self.num_shards)))
+        with open(path / SHARDED_META, "w") as f:
+            json.dump({"num_shards": self.num_shards}, f)
+
+    @classmethod
+    def load_local(cls, folder_path, embedder, max_workers=None, mmap=False) -> 'ShardedFAISSIndex':
+        path = Path(folder_path)
+        with open(path / SHARDED_META) as f:
+            num_shards = json.load(f)["num_shards"]
+        with ThreadPoolExecutor(max_workers=max_workers or num_shards) as pool:
+            shards = list(pool.map(lambda shard: FAISSVectorIndex.load_local(shard_path(path, shard), embedder, mmap),
+                                   range(num_shards)))
+        return cls(embedder=embedder, shards=shards, max_workers=max_workers)
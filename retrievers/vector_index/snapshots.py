@@ -0,0 +1,291 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+from pydantic import BaseModel, PrivateAttr
+from instrumentation import count, span
+from retriever import Retriever
+from faiss_vector_index import FAISSVectorIndex
+from sharded_faiss_index import ShardedFAISSIndex
+
+# layout of a snapshot root:
+#   CURRENT                        - the name of the published snapshot, swapped in with os.replace
+#   snapshots/<version>/           - one save_local each, never written to again once published
+#   snapshots/<version>/MANIFEST.json - retriever class, creation time, size and sha256 of every file
+#   snapshots/.tmp-<version>/      - a snapshot being written, renamed into place when complete
+CURRENT = "CURRENT"
+SNAPSHOTS = "snapshots"
+MANIFEST = "MANIFEST.json"
+# unfinished snapshots untouched for this long are left over from a crashed publish
+STALE_TMP_SECONDS = 3600
+
+snapshot_types = {
+    "FAISSVectorIndex": FAISSVectorIndex,
+    "ShardedFAISSIndex": ShardedFAISSIndex,
+}
+
+
+class SnapshotCorrupted(ValueError):
+    pass
+
+
+def file_sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(2 ** 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def fsync_path(path: Path):
+    # directories can't be opened on windows, there renames are durable without it
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class SnapshotManager(BaseModel):
+    """Versioned, immutable saves of an index under one root directory.
+
+    publish writes a complete save_local into a fresh directory, records a checksum of every file
+    and only then points CURRENT at it, so readers see either the old snapshot or the new one and
+    never a mix of both. Old snapshots are removed by gc according to keep_last and keep_seconds.
+
+    Published snapshots are never written to again, so each one is checksummed the first time this
+    manager verifies it and only has its file sizes checked on later loads.
+    """
+    root: str
+    # the newest snapshots gc keeps, the current one is always kept on top
+    keep_last: int = 3
+    # snapshots younger than this are kept too, so processes that reload slowly can still load them
+    keep_seconds: float = 0.0
+
+    # versions whose checksums this manager has already verified
+    _verified: set = PrivateAttr(default_factory=set)
+
+    @property
+    def snapshots_dir(self) -> Path:
+        return Path(self.root) / SNAPSHOTS
+
+    def snapshot_path(self, version: str) -> Path:
+        return self.snapshots_dir / version
+
+    @staticmethod
+    def is_snapshot_root(path) -> bool:
+        return (Path(path) / CURRENT).exists()
+
+    def new_version(self) -> str:
+        # sorts in publish order
+        return datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%fZ")
+
+    def publish(self, index, version: Optional[str] = None) -> str:
+        if type(index).__name__ not in snapshot_types:
+            raise ValueError(f"Unsupported snapshot type: {type(index).__name__}")
+        version = version or self.new_version()
+        tmp_path = self.snapshots_dir / f".tmp-{version}"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        with span("snapshot.publish"):
+            index.save_local(tmp_path)
+            files = {}
+            for path in sorted(p for p in tmp_path.rglob("*") if p.is_file()):
+                files[path.relative_to(tmp_path).as_posix()] = {"bytes": path.stat().st_size,
+                                                                 "sha256": file_sha256(path)}
+                fsync_path(path)
+            manifest = {"version": version, "created_at": time.time(), "retriever": type(index).__name__,
+                        "files": files}
+            with open(tmp_path / MANIFEST, "w") as f:
+                json.dump(manifest, f, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            fsync_path(tmp_path)
+            # fails if the version exists, a published snapshot is never overwritten
+            tmp_path.rename(self.snapshot_path(version))
+            fsync_path(self.snapshots_dir)
+            # read back what was written before any reader is pointed at it
+            self.verify(version)
+            self.set_current(version)
+        print(f"Published index snapshot {version}.")
+        self.gc()
+        return version
+
+    def set_current(self, version: str):
+        # also rolls back, any published version can be made current again
+        if not (self.snapshot_path(version) / MANIFEST).exists():
+            raise ValueError(f"No snapshot {version} in {self.root}")
+        tmp_path = Path(self.root) / (CURRENT + ".tmp")
+        with open(tmp_path, "w") as f:
+            f.write(version)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, Path(self.root) / CURRENT)
+        fsync_path(Path(self.root))
+
+    def current_version(self) -> Optional[str]:
+        try:
+            with open(Path(self.root) / CURRENT) as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def versions(self) -> List[str]:
+        # published snapshots, oldest first
+        if not self.snapshots_dir.exists():
+            return []
+        return sorted(path.name for path in self.snapshots_dir.iterdir()
+                      if not path.name.startswith(".") and (path / MANIFEST).exists())
+
+    def manifest(self, version: str) -> Dict[str, Any]:
+        with open(self.snapshot_path(version) / MANIFEST) as f:
+            return json.load(f)
+
+    def verify(self, version: str, checksums: bool = True):
+        # sizes are checked in a stat per file, checksums read every byte of the snapshot
+        path = self.snapshot_path(version)
+        damaged = []
+        for name, expected in self.manifest(version)["files"].items():
+            file_path = path / name
+            if not file_path.exists() or file_path.stat().st_size != expected["bytes"]:
+                damaged.append(name)
+            elif checksums and file_sha256(file_path) != expected["sha256"]:
+                damaged.append(name)
+        if damaged:
+            self._verified.discard(version)
+            count("snapshot.corrupted")
+            raise SnapshotCorrupted(f"Snapshot {version} has damaged files: {', '.join(damaged)}")
+        if checksums:
+            self._verified.add(version)
+
+    def load(self, embedder, version: Optional[str] = None, mmap: bool = True,
+             checksums: Optional[bool] = None) -> Tuple[str, Any]:
+        # (version, retriever) of the given snapshot, the current one by default. checksums None
+        # checksums a version the first time it is loaded and only checks file sizes after that.
+        version = version or self.current_version()
+        if version is None:
+            raise ValueError(f"No snapshot has been published in {self.root}")
+        if checksums is None:
+            checksums = version not in self._verified
+        with span("snapshot.load", mmap=mmap):
+            self.verify(version, checksums=checksums)
+            snapshot_type = self.manifest(version)["retriever"]
+            retriever_class = snapshot_types.get(snapshot_type)
+            if not retriever_class:
+                raise ValueError(f"Unsupported snapshot type: {snapshot_type}")
+            return version, retriever_class.load_local(self.snapshot_path(version), embedder, mmap=mmap)
+
+    def gc(self) -> List[str]:
+        # removes the snapshots the retention policy no longer keeps, returns their versions
+        versions = self.versions()
+        keep = set(versions[-self.keep_last:]) if self.keep_last > 0 else set()
+        keep.add(self.current_version())
+        now = time.time()
+        removed = []
+        for version in versions:
+            if version in keep or now - self.manifest(version)["created_at"] < self.keep_seconds:
+                continue
+            try:
+                shutil.rmtree(self.snapshot_path(version))
+            except OSError as e:
+                # e.g. files still mapped by a process on windows, the next gc retries
+                print(f"Could not remove index snapshot {version}: {e}")
+                continue
+            removed.append(version)
+            count("snapshot.removed")
+        for path in self.snapshots_dir.glob(".tmp-*") if self.snapshots_dir.exists() else []:
+            if now - path.stat().st_mtime > STALE_TMP_SECONDS:
+                shutil.rmtree(path, ignore_errors=True)
+        return removed
+
+
+class SnapshotRetriever(Retriever):
+    """Serves the current snapshot of a SnapshotManager and swaps to newer ones as they are published.
+
+    Every query takes the active index once and runs to completion on it, so a swap never touches
+    queries in flight. The old index is freed when the last of them finishes.
+    """
+    snapshots: SnapshotManager
+    embedder: Any
+    mmap: bool = True
+    # True checksums every file on each load and False only checks their sizes. None checksums each
+    # snapshot the first time it is loaded in this process, reloads of it only check the sizes.
+    checksums: Optional[bool] = None
+    # seconds between checks of CURRENT, 0 only swaps on reload(). The checks are started by queries,
+    # so they also happen in workers forked after the retriever was loaded.
+    reload_interval: float = 30.0
+
+    # (version, retriever), replaced as a whole so a query never sees the version of one and the index of another
+    _active: Tuple[str, Any] = PrivateAttr(default=None)
+    _reload_lock: Any = PrivateAttr(default_factory=threading.Lock)
+    _last_check: float = PrivateAttr(default=0.0)
+
+    def __init__(self, **data):
+        super().__init__(**data)
+        self._active = self.snapshots.load(self.embedder, mmap=self.mmap, checksums=self.checksums)
+        self._last_check = time.monotonic()
+
+    @property
+    def version(self) -> str:
+        return self._active[0]
+
+    @property
+    def retriever(self):
+        return self._active[1]
+
+    def reload(self) -> bool:
+        # loads and swaps in the current snapshot if it changed, True when it did
+        with self._reload_lock:
+            version = self.snapshots.current_version()
+            if version is None or version == self._active[0]:
+                return False
+            self._active = self.snapshots.load(self.embedder, version, mmap=self.mmap, checksums=self.checksums)
+        count("snapshot.swaps")
+        print(f"Serving index snapshot {version}.")
+        return True
+
+    def reload_in_background(self):
+        try:
+            self.reload()
+        except Exception as e:
+            # a snapshot that fails to load is skipped, the active one keeps serving
+            count("snapshot.errors")
+            print(f"Reloading the index snapshot failed: {e}")
+
+    def maybe_reload(self):
+        if not self.reload_interval or time.monotonic() - self._last_check < self.reload_interval:
+            return
+        self._last_check = time.monotonic()
+        if not self._reload_lock.locked():
+            threading.Thread(target=self.reload_in_background, daemon=True).start()
+
+    def retrieve_similar_docs(self, query: str, max_docs: int = 5, **kwargs):
+        self.maybe_reload()
+        return self.retriever.retrieve_similar_docs(query, max_docs, **kwargs)
+
+    def retrieve_similar_docs_batch(self, queries, max_docs: int = 5, **kwargs):
+        self.maybe_reload()
+        return self.retriever.retrieve_similar_docs_batch(queries, max_docs, **kwargs)
+
+    async def aretrieve_similar_docs(self, query: str, max_docs: int = 5, **kwargs):
+        self.maybe_reload()
+        return await self.retriever.aretrieve_similar_docs(query, max_docs, **kwargs)
+
+    def retrieve_similar_docs_with_vector(self, query: str, max_docs: int = 5, **kwargs):
+        self.maybe_reload()
+        return self.retriever.retrieve_similar_docs_with_vector(query, max_docs, **kwargs)
+
+    async def aretrieve_similar_docs_with_vector(self, query: str, max_docs: int = 5, **kwargs):
+        self.maybe_reload()
+        return await self.retriever.aretrieve_similar_docs_with_vector(query, max_docs, **kwargs)
+
+    def retrieve_similar_docs_batch_with_vectors(self, queries, max_docs: int = 5, **kwargs):
+        self.maybe_reload()
+        return self.retriever.retrieve_similar_docs_batch_with_vectors(queries, max_docs, **kwargs)
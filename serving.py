@@ -0,0 +1,252 @@
+import queue
+import threading
+import time
+import uuid
+import weakref
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+from typing import Any, Iterator, Optional, Tuple
+from pydantic import BaseModel, PrivateAttr
+from rag_session import RAGSession, SessionStore
+from instrumentation import count, observe, span
+# retriever and generator have to be imported before their backends, see the note in each module
+from retriever import FAISSVectorIndex, MicroBatchingRetriever, OpenAIEmbeddings, SnapshotManager, SnapshotRetriever
+from generator import Generator, generator_types
+
+
+class ServiceOverloaded(Exception):
+    # every worker is busy and the queue is full, the client should back off and retry
+    pass
+
+
+class RequestTimeout(Exception):
+    pass
+
+
+# marks the end of a streamed answer on the token queue
+_END = object()
+
+
+class TokenStream:
+    """The tokens of a streamed answer.
+
+    Closing it abandons the request, also when it is closed before the first token was read, when a
+    generator's finally block would never run. One dropped without being closed is abandoned too.
+    """
+
+    def __init__(self, tokens: Iterator[str], abandon):
+        self._tokens = tokens
+        self._finalizer = weakref.finalize(self, abandon)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> str:
+        return next(self._tokens)
+
+    def close(self):
+        self._tokens.close()
+        self._finalizer()
+
+
+class RAGService(BaseModel):
+    """Answers questions for many sessions on a bounded worker pool.
+
+    At most max_workers answers are generated at once and at most max_queue more wait for a
+    worker, anything beyond that is rejected with ServiceOverloaded instead of piling up.
+    """
+    generator: Generator
+    sessions: SessionStore = None
+    max_workers: int = 16
+    max_queue: int = 64
+    # seconds from accepting a request to its last token, including the time spent queued
+    request_timeout: float = 60.0
+
+    _executor: Any = PrivateAttr(default=None)
+    _slots: Any = PrivateAttr(default=None)
+
+    def __init__(self, **data):
+        super().__init__(**data)
+        if self.sessions is None:
+            self.sessions = SessionStore()
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="rag-worker")
+        self._slots = threading.BoundedSemaphore(self.max_workers + self.max_queue)
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def acquire_slot(self):
+        if not self._slots.acquire(blocking=False):
+            count("service.rejected")
+            raise ServiceOverloaded(f"More than {self.max_workers + self.max_queue} requests in flight")
+
+    def get_session(self, session_id: Optional[str]) -> RAGSession:
+        return self.sessions.get_or_create(session_id or uuid.uuid4().hex)
+
+    def submit(self, session: RAGSession, fn, *args) -> Future:
+        # requests of one session run one at a time so each sees the turns before it. A request is
+        # handed to the pool only once the one before it has run, so requests waiting for their
+        # session don't hold a worker. Cancelling the returned future drops a request still waiting.
+        result, finished = Future(), Future()
+
+        def run():
+            try:
+                if result.set_running_or_notify_cancel():
+                    try:
+                        result.set_result(fn(*args))
+                    except BaseException as e:
+                        result.set_exception(e)
+            finally:
+                # the next request is chained on this rather than on result, which a cancel completes early
+                finished.set_result(None)
+
+        def start(_=None):
+            try:
+                self._executor.submit(run)
+            except RuntimeError as e:
+                # the service was closed
+                if result.set_running_or_notify_cancel():
+                    result.set_exception(e)
+                finished.set_result(None)
+
+        with session._lock:
+            previous, session._tail = session._tail, finished
+        if previous is None:
+            start()
+        else:
+            previous.add_done_callback(start)
+        return result
+
+    def generate(self, session: RAGSession, question: str, abandoned: threading.Event,
+                 accepted: float) -> Optional[str]:
+        # time spent waiting for a worker and for earlier requests of the same session
+        observe("service.queue_wait_seconds", time.perf_counter() - accepted)
+        if abandoned.is_set():
+            return None
+        try:
+            with span("service.request", stream=False):
+                answer = self.generator.generate_answer(question, list(session.chat_history), session.summary)
+        except Exception:
+            # raised to the caller, a failed question is never recorded as a turn
+            count("service.failures", stream=False)
+            raise
+        # a timed out request is reported as failed, so it must not show up in the history either
+        if not abandoned.is_set():
+            self.record_turn(session, question, answer)
+        return answer
+
+    def record_turn(self, session: RAGSession, question: str, answer: str):
+        # caller runs as the session's current request
+        session.record_turn(question, answer)
+        if self.generator.context_builder.needs_compaction(session.chat_history):
+            # summarizing costs a model call, it runs after the answer is returned instead of before
+            self.submit(session, self.compact_session, session)
+
+    def compact_session(self, session: RAGSession):
+        try:
+            with span("service.compact_session"):
+                session.compact(self.generator.context_builder.split_history,
+                                self.generator.summarize_chat_history)
+        except Exception as e:
+            # the turns stay verbatim and compaction is retried after the next turn
+            print(f"Compacting the chat history of session {session.session_id} failed: {e}")
+
+    def ask(self, question: str, session_id: Optional[str] = None) -> Tuple[str, str]:
+        self.acquire_slot()
+        session = self.get_session(session_id)
+        abandoned = threading.Event()
+        try:
+            future = self.submit(session, self.generate, session, question, abandoned, time.perf_counter())
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout=self.request_timeout), session.session_id
+        except TimeoutError:
+            abandoned.set()
+            future.cancel()
+            count("service.timeouts", stream=False)
+            raise RequestTimeout(f"No answer within {self.request_timeout} seconds")
+
+    def generate_stream(self, session: RAGSession, question: str, tokens: queue.Queue,
+                        abandoned: threading.Event, accepted: float):
+        observe("service.queue_wait_seconds", time.perf_counter() - accepted)
+        try:
+            if abandoned.is_set():
+                return
+            parts = []
+            with span("service.request", stream=True):
+                for token in self.generator.generate_answer_stream(question, list(session.chat_history),
+                                                                   session.summary):
+                    if abandoned.is_set():
+                        return
+                    parts.append(token)
+                    tokens.put(token)
+            self.record_turn(session, question, "".join(parts))
+        except Exception as e:
+            # handed to the reader to raise after the tokens sent so far, the turn is not recorded
+            count("service.failures", stream=True)
+            tokens.put(e)
+        finally:
+            tokens.put(_END)
+
+    def ask_stream(self, question: str, session_id: Optional[str] = None) -> Tuple[TokenStream, str]:
+        # the slot is taken up front so an overloaded service fails before any response is started
+        self.acquire_slot()
+        session = self.get_session(session_id)
+        tokens, abandoned = queue.Queue(), threading.Event()
+        try:
+            future = self.submit(session, self.generate_stream, session, question, tokens, abandoned,
+                                 time.perf_counter())
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        deadline = time.monotonic() + self.request_timeout
+
+        def abandon():
+            abandoned.set()
+            future.cancel()
+
+        def stream():
+            try:
+                while True:
+                    try:
+                        token = tokens.get(timeout=max(deadline - time.monotonic(), 0))
+                    except queue.Empty:
+                        count("service.timeouts", stream=True)
+                        raise RequestTimeout(f"No answer within {self.request_timeout} seconds")
+                    if token is _END:
+                        return
+                    if isinstance(token, Exception):
+                        raise token
+                    yield token
+            finally:
+                # also reached when the client disconnects mid-answer, the worker stops at its next token
+                abandon()
+
+        return TokenStream(stream(), abandon), session.session_id
+
+
+def load_service(index_path: str, embedder=None, generator_type: str = "openai", reload_interval: float = 30.0,
+                 batch_wait_ms: float = 5.0, **kwargs) -> RAGService:
+    # the index is loaded once per process and only ever read by the workers. Under
+    # gunicorn --preload it is loaded in the master and shared copy-on-write by the forks.
+    # index_path may also be the root of a SnapshotManager, then the current snapshot is served
+    # memory-mapped and newly published ones are swapped in every reload_interval seconds.
+    # Questions retrieved within batch_wait_ms of each other share one query embedding request and
+    # one index search, 0 retrieves every question on its own.
+    embedder = embedder or OpenAIEmbeddings()
+    if SnapshotManager.is_snapshot_root(index_path):
+        retriever = SnapshotRetriever(snapshots=SnapshotManager(root=index_path), embedder=embedder,
+                                      reload_interval=reload_interval)
+    else:
+        retriever = FAISSVectorIndex.load_local(index_path, embedder)
+    if batch_wait_ms:
+        retriever = MicroBatchingRetriever(retriever=retriever, max_wait_ms=batch_wait_ms)
+    generator_class = generator_types.get(generator_type)
+    if not generator_class:
+        raise ValueError("Unsupported generator type.")
+    service_fields = {key: kwargs.pop(key) for key in ("max_workers", "max_queue", "request_timeout")
+                      if key in kwargs}
+    return RAGService(generator=generator_class(retriever=retriever, **kwargs), **service_fields)
@@ -0,0 +1,29 @@
+import sys
+from pathlib import Path
+
+root = Path(__file__).resolve().parent.parent
+for folder in ["", "retrievers", "retrievers/vector_index", "retrievers/vector_database", "generators", "loaders",
+               "benchmarks"]:
+    sys.path.insert(0, str(root / folder))
+
+import pytest  # noqa: E402
+# retriever and generator have to be imported before their backends, see the note in each module
+import retriever  # noqa: E402, F401
+import generator  # noqa: E402, F401
+from corpus import synthetic_docs  # noqa: E402
+from fakes import FakeChatClient, FakeEmbeddings  # noqa: E402
+
+
+@pytest.fixture
+def embedder():
+    return FakeEmbeddings(dim=64)
+
+
+@pytest.fixture
+def docs():
+    return synthetic_docs(60, paragraphs=1)
+
+
+@pytest.fixture
+def chat_client():
+    return FakeChatClient(latency=0.0)
@@ -0,0 +1,134 @@
+import json
+import threading
+import time
+import pytest
+import app as app_module
+from context_builder import ContextBuilder
+from faiss_vector_index import FAISSVectorIndex
+from fakes import FakeChatClient
+from instrumentation import MetricsRegistry, use_instrumentation
+from serving import ServiceOverloaded, load_service
+
+
+def make_service(docs, embedder, chat_client, tmp_path, **kwargs):
+    FAISSVectorIndex.from_documents(docs, False, embedder).save_local(tmp_path)
+    # the estimating token counter, so no tokenizer files have to be downloaded
+    return load_service(str(tmp_path), embedder=embedder, client=chat_client,
+                        context_builder=ContextBuilder(encoding_name=None), **kwargs)
+
+
+@pytest.fixture
+def service(docs, embedder, chat_client, tmp_path):
+    service = make_service(docs, embedder, chat_client, tmp_path)
+    app_module.app.config["SERVICE"] = service
+    yield service
+    app_module.app.config["SERVICE"] = None
+    service.close()
+
+
+@pytest.fixture
+def client(service):
+    return app_module.app.test_client()
+
+
+def parse_events(body: str):
+    # [(event, data)] of a Server-Sent Events body, events without a name are "message"
+    events = []
+    for block in body.strip().split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.split("\n"))
+        events.append((fields.get("event", "message"), json.loads(fields["data"])))
+    return events
+
+
+def test_question_streams_tokens_as_events(client, service, chat_client):
+    response = client.post("/question", json={"question": "What is topic 3?", "stream": True})
+    assert response.status_code == 200
+    assert response.mimetype == "text/event-stream"
+
+    events = parse_events(response.get_data(as_text=True))
+    assert events[0][0] == "session"
+    session_id = events[0][1]["session_id"]
+    assert events[-1] == ("done", {})
+    tokens = [data["token"] for event, data in events[1:-1]]
+    assert all(event == "message" for event, _ in events[1:-1])
+    assert len(tokens) > 1
+    assert "".join(tokens) == chat_client.answer
+    assert service.sessions.get(session_id).chat_history == [("What is topic 3?", chat_client.answer)]
+
+
+def test_question_without_stream_returns_json(client, chat_client):
+    response = client.post("/question", json={"question": "What is topic 3?"})
+    assert response.status_code == 200
+    assert response.get_json()["answer"] == chat_client.answer
+
+
+def test_question_requires_a_question(client):
+    assert client.post("/question", json={}).status_code == 400
+
+
+def test_streamed_turns_share_a_session(client, service, chat_client):
+    first = parse_events(client.post("/question", json={"question": "first", "stream": True}).get_data(as_text=True))
+    session_id = first[0][1]["session_id"]
+    second = parse_events(client.post("/question", json={"question": "second", "session_id": session_id,
+                                                         "stream": True}).get_data(as_text=True))
+    assert second[0][1]["session_id"] == session_id
+    assert [question for question, _ in service.sessions.get(session_id).chat_history] == ["first", "second"]
+
+
+def test_a_failed_stream_ends_with_an_error_event(client, service, chat_client):
+    def fail(**kwargs):
+        raise ValueError("model unavailable")
+
+    chat_client.chat.completions.create = fail
+    registry = MetricsRegistry()
+    with use_instrumentation(registry):
+        response = client.post("/question", json={"question": "What is topic 3?", "stream": True})
+        events = parse_events(response.get_data(as_text=True))
+    assert events[-1] == ("error", {"error": "model unavailable"})
+    assert service.sessions.get(events[0][1]["session_id"]).chat_history == []
+    assert registry.counter_value("service.failures", stream=True) == 1
+
+
+def test_requests_beyond_the_queue_are_rejected(docs, embedder, tmp_path):
+    service = make_service(docs, embedder, FakeChatClient(latency=0.5), tmp_path, max_workers=1, max_queue=0)
+    app_module.app.config["SERVICE"] = service
+    try:
+        busy = threading.Thread(target=service.ask, args=("first",))
+        busy.start()
+        time.sleep(0.1)
+        with pytest.raises(ServiceOverloaded):
+            service.ask("second")
+        response = app_module.app.test_client().post("/question", json={"question": "third"})
+        assert response.status_code == 429
+        assert response.headers["Retry-After"] == "1"
+        busy.join()
+        assert service.ask("fourth")[0]
+    finally:
+        app_module.app.config["SERVICE"] = None
+        service.close()
+
+
+def test_turns_of_one_session_run_in_order(service):
+    _, session_id = service.ask("first")
+    threads = [threading.Thread(target=service.ask, args=(question, session_id)) for question in ["second", "third"]]
+    for thread in threads:
+        thread.start()
+        time.sleep(0.05)
+    for thread in threads:
+        thread.join()
+    assert [question for question, _ in service.sessions.get(session_id).chat_history] == ["first", "second", "third"]
+
+
+def test_a_stream_closed_before_the_first_token_is_abandoned(docs, embedder, tmp_path):
+    chat_client = FakeChatClient(latency=0.3)
+    service = make_service(docs, embedder, chat_client, tmp_path)
+    try:
+        tokens, session_id = service.ask_stream("What is topic 3?")
+        tokens.close()
+        session = service.sessions.get(session_id)
+        # runs once the abandoned request has finished, requests of a session are chained
+        service.submit(session, lambda: None).result(timeout=5)
+        assert session.chat_history == []
+    finally:
+        service.close()
+
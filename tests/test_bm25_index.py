@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+from bm25_index import BM25Index, reciprocal_rank_fusion, tokenize
+from document import Document
+from faiss_vector_index import FAISSVectorIndex
+
+TEXTS = ["the error_code E1234 means the disk is full",
+         "restart the service after changing the config",
+         "the disk quota can be raised in the admin panel",
+         "error messages are written to the service log"]
+
+
+def test_identifiers_stay_single_tokens():
+    assert tokenize("Set error_code=E1234, then v2.") == ["set", "error_code", "e1234", "then", "v2"]
+
+
+def test_rare_terms_outrank_common_ones():
+    index = BM25Index()
+    index.add(list(range(len(TEXTS))), TEXTS)
+    assert index.search("e1234 disk")[:2] == [0, 2]
+    scored = index.search_scored("service", max_docs=4)
+    assert [doc_id for doc_id, _ in scored] == [1, 3]
+    assert index.search("nothing matches") == []
+
+
+def test_deletes_and_reloads_keep_the_scores(tmp_path):
+    index = BM25Index()
+    index.add([0, 1], TEXTS[:2])
+    index.add([2, 3], TEXTS[2:])
+    index.delete([0])
+    assert index.search("disk", max_docs=4) == [2]
+    index.save(tmp_path)
+
+    loaded = BM25Index.load(tmp_path)
+    for query in ["disk", "service log", "error"]:
+        assert loaded.search_scored(query, 4) == pytest.approx(index.search_scored(query, 4))
+    assert [doc_id for doc_id, _ in loaded.search_scored("error service", 4, allowed=np.array([3]))] == [3]
+
+
+def test_reciprocal_rank_fusion_rewards_agreement():
+    fused = reciprocal_rank_fusion([["a", "b", "c"], ["b", "d"]], k=60, limit=3)
+    assert [doc_id for doc_id, _ in fused] == ["b", "a", "d"]
+
+
+def test_search_modes(embedder):
+    docs = [Document(content=text, source=f"https://example.com/{i}") for i, text in enumerate(TEXTS)]
+    dense = FAISSVectorIndex.from_documents(docs, False, embedder)
+    assert dense.bm25 is None
+    lexical = FAISSVectorIndex.from_documents(docs, False, embedder, search_mode="lexical")
+    assert [doc.source for doc in lexical.retrieve_similar_docs("E1234", max_docs=2)] == ["https://example.com/0"]
+    hybrid = FAISSVectorIndex.from_documents(docs, False, embedder, search_mode="hybrid")
+    assert hybrid.retrieve_similar_docs("what does E1234 mean", max_docs=1)[0].source == "https://example.com/0"
+    with pytest.raises(ValueError, match="search mode"):
+        FAISSVectorIndex.from_documents(docs, False, embedder, search_mode="fuzzy").retrieve_similar_docs("disk")
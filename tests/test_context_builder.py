@@ -0,0 +1,53 @@
+from context_builder import ContextBuilder
+from document import Document
+from rag_session import RAGSession
+
+
+def doc(words, source="https://example.com/a"):
+    return Document(content=" ".join(words), source=source)
+
+
+def test_near_duplicate_chunks_are_dropped():
+    builder = ContextBuilder(encoding_name=None)
+    words = [f"word{i}" for i in range(60)]
+    original, overlapping = doc(words), doc(words[:-1] + ["changed"], "https://example.com/b")
+    other = doc([f"other{i}" for i in range(60)])
+    assert builder.pack([original, overlapping, other]) == [original, other]
+
+
+def test_chunks_are_packed_best_first_within_the_budget():
+    builder = ContextBuilder(encoding_name=None, max_context_tokens=100)
+    long, short, fits = doc(["long"] * 60), doc(["short"] * 30), doc(["tiny"] * 10)
+    # long takes ~75 tokens, short no longer fits after it but tiny still does
+    packed = builder.pack([long, short, fits])
+    assert packed == [long, fits]
+    assert sum(builder.count_tokens(d.content) for d in packed) <= 100
+
+
+def test_an_oversized_best_chunk_is_truncated():
+    builder = ContextBuilder(encoding_name=None, max_context_tokens=10)
+    [packed] = builder.pack([doc(["word"] * 100), doc(["small"])])
+    assert builder.count_tokens(packed.content) <= 11
+    assert packed.content.startswith("word word")
+
+
+def test_old_turns_are_summarized_once_the_history_is_over_budget():
+    builder = ContextBuilder(encoding_name=None, max_history_tokens=100)
+    session = RAGSession(session_id="s")
+    for i in range(6):
+        session.record_turn(f"question {i} " + "x" * 60, f"answer {i} " + "y" * 60)
+    assert builder.needs_compaction(session.chat_history)
+
+    summarized = []
+
+    def summarize(summary, turns):
+        summarized.append(turns)
+        return summary + f"{len(turns)} turns. "
+
+    folded = session.compact(builder.split_history, summarize)
+    assert folded == len(summarized[0]) > 0
+    assert session.summary == f"{folded} turns. "
+    assert [question.split(" ")[1] for question, _ in session.chat_history] == [str(i) for i in range(folded, 6)]
+    assert builder.history_tokens(session.chat_history) <= builder.max_history_tokens // 2
+    assert not builder.needs_compaction(session.chat_history)
+    assert session.compact(builder.split_history, summarize) == 0
@@ -0,0 +1,88 @@
+import json
+import pytest
+from document import DOCSTORE_FIELDS, DOCSTORE_META, Document, DocStore
+
+
+def make_docs(start, end):
+    return [Document(content=f"chunk {i}", source=f"https://example.com/{i % 7}",
+                     title=None if i % 5 == 0 else f"Page {i % 3}", start_index=i)
+            for i in range(start, end)]
+
+
+def expected_ids(docs, deleted, field, value):
+    return sorted(i for i, doc in enumerate(docs) if i not in deleted and getattr(doc, field) == value)
+
+
+def assert_same_store(store, docs, deleted):
+    assert len(store) == len(docs)
+    for i, doc in enumerate(docs):
+        if i not in deleted:
+            assert store.search(i) == doc
+    for value in {doc.source for doc in docs} | {"https://example.com/missing"}:
+        assert sorted(store.ids_for_sources([value])) == expected_ids(docs, deleted, "source", value)
+    for value in {doc.title for doc in docs}:
+        assert sorted(store.ids_for_field("title", [value])) == expected_ids(docs, deleted, "title", value)
+
+
+def test_round_trip(tmp_path):
+    docs = make_docs(0, 40)
+    store = DocStore()
+    store.add(docs)
+    store.delete([3, 17])
+    store.save(tmp_path)
+
+    loaded = DocStore.load(tmp_path)
+    assert_same_store(loaded, docs, {3, 17})
+    with open(tmp_path / DOCSTORE_META) as f:
+        assert set(json.load(f)) == {"rows", "deleted"}
+    for file_name in DOCSTORE_FIELDS.values():
+        assert (tmp_path / file_name).exists()
+
+
+def test_saves_after_a_load_append(tmp_path):
+    docs = make_docs(0, 30)
+    store = DocStore()
+    store.add(docs)
+    store.save(tmp_path)
+
+    loaded = DocStore.load(tmp_path)
+    more = make_docs(30, 55)
+    assert loaded.add(more) == list(range(30, 55))
+    loaded.delete(loaded.ids_for_sources(["https://example.com/2"]))
+    deleted = {i for i, doc in enumerate(docs + more) if doc.source == "https://example.com/2"}
+    assert_same_store(loaded, docs + more, deleted)
+    loaded.save(tmp_path)
+
+    assert_same_store(DocStore.load(tmp_path), docs + more, deleted)
+
+
+def test_stores_without_a_field_index_are_scanned(tmp_path):
+    docs = make_docs(0, 20)
+    store = DocStore()
+    store.add(docs)
+    store.delete([4])
+    store.save(tmp_path)
+    for file_name in DOCSTORE_FIELDS.values():
+        (tmp_path / file_name).unlink()
+
+    assert_same_store(DocStore.load(tmp_path), docs, {4})
+
+
+def test_a_crash_while_rewriting_keeps_the_previous_save(tmp_path, monkeypatch):
+    docs = make_docs(0, 20)
+    store = DocStore()
+    store.add(docs)
+    store.save(tmp_path)
+
+    def crash(self, id):
+        raise OSError("disk full")
+
+    # a different store saved to the same folder rewrites the blob instead of appending to it
+    other = DocStore()
+    other.add(make_docs(100, 130))
+    monkeypatch.setattr(DocStore, "serialize", crash)
+    with pytest.raises(OSError):
+        other.save(tmp_path)
+    monkeypatch.undo()
+
+    assert_same_store(DocStore.load(tmp_path), docs, set())
@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+from embedding_cache import CachedEmbeddings
+from fakes import FakeEmbeddings
+
+
+class CountingEmbeddings(FakeEmbeddings):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.texts = 0
+
+    def embed_documents(self, texts):
+        self.texts += len(texts)
+        return super().embed_documents(texts)
+
+    def embed_query(self, text):
+        self.texts += 1
+        return super().embed_query(text)
+
+
+def open_cache(path, embedder, **kwargs):
+    return CachedEmbeddings(embedder=embedder, cache_dir=str(path), model_name="fake", **kwargs)
+
+
+def test_repeated_texts_are_embedded_once(tmp_path):
+    embedder = CountingEmbeddings(dim=16)
+    cache = open_cache(tmp_path, embedder)
+    first = cache.embed_documents(["alpha", "beta", "alpha"])
+    second = cache.embed_documents(["beta", "alpha"])
+    assert embedder.texts == 2
+    assert second == [first[1], first[0]]
+    assert cache.embed_query("alpha") == first[0]
+    assert embedder.texts == 2
+    cache.close()
+
+
+def test_entries_survive_a_reopen(tmp_path):
+    texts = [f"text number {i}" for i in range(50)]
+    cache = open_cache(tmp_path, CountingEmbeddings(dim=16), flush_every=7)
+    expected = cache.embed_documents(texts)
+    cache.close()
+
+    embedder = CountingEmbeddings(dim=16)
+    reopened = open_cache(tmp_path, embedder)
+    assert np.allclose(reopened.embed_documents(texts), expected)
+    assert embedder.texts == 0
+    reopened.close()
+
+
+def test_evicted_entries_are_embedded_again(tmp_path):
+    embedder = CountingEmbeddings(dim=16)
+    cache = open_cache(tmp_path, embedder, max_entries=10, flush_every=3)
+    texts = [f"text number {i}" for i in range(30)]
+    vectors = cache.embed_documents(texts)
+    # every lookup has to return the vector of its own text, whichever slots were reused
+    assert np.allclose(cache.embed_documents(texts), vectors)
+    assert cache.evictions > 0
+    cache.close()
+
+
+def test_a_directory_belongs_to_one_cache(tmp_path):
+    cache = open_cache(tmp_path, FakeEmbeddings(dim=16))
+    with pytest.raises(RuntimeError):
+        open_cache(tmp_path, FakeEmbeddings(dim=16))
+    cache.close()
+    open_cache(tmp_path, FakeEmbeddings(dim=16)).close()
@@ -0,0 +1,76 @@
+import threading
+import time
+import pytest
+from embedding_pipeline import EmbeddingPipeline, batch_documents, estimate_tokens
+from faiss_vector_index import FAISSVectorIndex
+from fakes import FakeEmbeddings
+
+
+class RateLimitError(Exception):
+    status_code = 429
+
+
+class RecordingEmbeddings(FakeEmbeddings):
+    """Records every embed_documents batch and how many of them ran at once, failing the first rate_limits."""
+
+    def __init__(self, rate_limits=0, **kwargs):
+        super().__init__(**kwargs)
+        self.rate_limits = rate_limits
+        self.batches = []
+        self.active = self.peak = 0
+        self._lock = threading.Lock()
+
+    def embed_documents(self, texts):
+        with self._lock:
+            if self.rate_limits:
+                self.rate_limits -= 1
+                raise RateLimitError()
+            self.batches.append(list(texts))
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+        time.sleep(0.01)
+        with self._lock:
+            self.active -= 1
+        return super().embed_documents(texts)
+
+
+def test_batches_stay_within_the_token_budget_and_size(docs):
+    budget = 3 * estimate_tokens(docs[0].content)
+    batches = list(batch_documents(docs, max_batch_tokens=budget, max_batch_size=2))
+    assert [doc for batch in batches for doc in batch] == docs
+    assert all(1 <= len(batch) <= 2 for batch in batches)
+    assert all(len(batch) == 1 or sum(estimate_tokens(doc.content) for doc in batch) <= budget for batch in batches)
+
+
+def test_batches_come_back_in_order_with_bounded_requests_in_flight(docs):
+    embedder = RecordingEmbeddings(dim=64)
+    pipeline = EmbeddingPipeline(embedder=embedder, max_batch_size=4, max_in_flight=3)
+    results = list(pipeline.run(docs))
+    assert [batch_no for batch_no, _, _ in results] == list(range(len(results)))
+    assert [doc for _, batch, _ in results for doc in batch] == docs
+    assert all(embeddings.shape == (len(batch), 64) for _, batch, embeddings in results)
+    assert 1 < embedder.peak <= 3
+
+
+def test_rate_limited_batches_are_retried(docs):
+    embedder = RecordingEmbeddings(rate_limits=2, dim=64)
+    pipeline = EmbeddingPipeline(embedder=embedder, max_in_flight=1, initial_backoff=0.0)
+    [(_, batch, embeddings)] = list(pipeline.run(docs[:3]))
+    assert len(embeddings) == 3
+    assert embedder.batches == [[doc.content for doc in docs[:3]]]
+
+    pipeline = EmbeddingPipeline(embedder=RecordingEmbeddings(rate_limits=5, dim=64), max_retries=2,
+                                 initial_backoff=0.0)
+    with pytest.raises(RateLimitError):
+        list(pipeline.run(docs[:3]))
+
+
+def test_a_build_resumes_after_its_last_checkpoint(docs, tmp_path):
+    FAISSVectorIndex.from_documents(docs[:30], False, FakeEmbeddings(dim=64), checkpoint_dir=tmp_path,
+                                    checkpoint_every=1, max_batch_tokens=1)
+    embedder = RecordingEmbeddings(dim=64)
+    index = FAISSVectorIndex.from_documents(docs, False, embedder, checkpoint_dir=tmp_path, checkpoint_every=1,
+                                            max_batch_tokens=1)
+    assert embedder.batches == [[doc.content] for doc in docs[30:]]
+    assert len(index.docstore) == len(docs)
+    assert index.index.ntotal == len(docs)
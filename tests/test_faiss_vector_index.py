@@ -0,0 +1,64 @@
+import pytest
+from crawl_manifest import CrawlDiff
+from document import Document
+from faiss_vector_index import FAISSVectorIndex
+from index_factory import IndexSpec
+from sharded_faiss_index import ShardedFAISSIndex
+from sitemap_loader import SitemapLoader
+
+
+def test_hnsw_indexes_refuse_deletes_before_touching_the_index(docs, embedder):
+    index = FAISSVectorIndex.from_documents(docs, False, embedder, index_spec=IndexSpec(kind="hnsw"))
+    with pytest.raises(ValueError, match="hnsw"):
+        index.delete_documents([docs[0].source])
+    with pytest.raises(ValueError, match="hnsw"):
+        index.upsert_documents(docs[:1], False)
+    assert len(index.docstore) == len(docs)
+    assert index.index.ntotal == len(docs)
+
+
+def test_sharded_hnsw_indexes_refuse_deletes_on_every_shard(docs, embedder):
+    index = ShardedFAISSIndex.from_documents(docs, False, embedder, num_shards=3, index_spec=IndexSpec(kind="hnsw"))
+    with pytest.raises(ValueError, match="hnsw"):
+        index.delete_documents([doc.source for doc in docs])
+    assert sum(shard.index.ntotal for shard in index.shards) == len(docs)
+
+
+def test_refreshing_an_hnsw_index_leaves_the_manifest_alone(docs, embedder, tmp_path):
+    class StaticLoader(SitemapLoader):
+        def refresh_documents(self, manifest):
+            return CrawlDiff(deleted=[docs[0].source], changed=docs[1:2])
+
+    index = FAISSVectorIndex.from_documents(docs, False, embedder, index_spec=IndexSpec(kind="hnsw"))
+    manifest_path = tmp_path / "manifest.json"
+    with pytest.raises(ValueError, match="hnsw"):
+        StaticLoader(url="https://example.com/sitemap.xml").refresh_index(index, manifest_path, split_docs=False)
+    assert not manifest_path.exists()
+
+
+def test_scored_results_come_best_first_with_their_ids(docs, embedder):
+    index = FAISSVectorIndex.from_documents(docs, False, embedder)
+    scored = index.retrieve_scored_docs(docs[5].content, max_docs=5)
+    assert scored[0].document == docs[5]
+    assert [item.score for item in scored] == sorted((item.score for item in scored), reverse=True)
+    assert all(index.docstore.search(item.id) == item.document for item in scored)
+
+
+def test_filters_restrict_the_candidates(docs, embedder):
+    index = FAISSVectorIndex.from_documents(docs, False, embedder)
+    sources = [docs[3].source, docs[7].source]
+    found = index.retrieve_similar_docs(docs[5].content, max_docs=5, filter={"source": sources})
+    assert {doc.source for doc in found} == set(sources)
+    assert index.retrieve_similar_docs(docs[5].content, filter={"source": "https://example.com/missing"}) == []
+    with pytest.raises(ValueError, match="filter field"):
+        index.retrieve_similar_docs(docs[5].content, filter={"author": "nobody"})
+
+
+def test_mmr_trades_near_duplicates_for_other_pages(docs, embedder):
+    copies = [Document(content=docs[0].content, source=f"https://example.com/copy/{i}") for i in range(3)]
+    index = FAISSVectorIndex.from_documents(copies + docs, False, embedder)
+    relevant = index.retrieve_similar_docs(docs[0].content, max_docs=4)
+    diverse = index.retrieve_similar_docs(docs[0].content, max_docs=4, mmr_lambda=0.3)
+    assert sum(doc.content == docs[0].content for doc in relevant) == 4
+    assert sum(doc.content == docs[0].content for doc in diverse) == 1
+    assert diverse[0].content == docs[0].content
@@ -0,0 +1,56 @@
+import pytest
+from corpus import render_html, synthetic_docs
+from html_extractor import extract_document, iter_extract_documents
+from sitemap_loader import SitemapLoader
+
+NESTED = """<html><head><title> Nested page </title></head><body>
+<div>intro text<div><p>first <span>inline</span> paragraph</p><p>second paragraph</p></div>outro text</div>
+<table><tr><td>a cell outside any block</td></tr></table>
+<ul><li>item <a href="/x" title="link title">link</a></li></ul>
+<span data-sheets-value='{"1": {"2": "sheet value"}}'>sheet cell</span>
+<!-- a comment --><footer><p>footer text</p></footer>
+</body></html>"""
+
+
+def test_nested_blocks_emit_each_line_once_in_document_order():
+    doc = extract_document(NESTED, "https://example.com/nested")
+    assert doc.title == "Nested page"
+    assert doc.source == "https://example.com/nested"
+    assert doc.content.split("\n") == ["intro text", "first inline paragraph", "second paragraph", "outro text",
+                                       "item link", "link title", "sheet cell", "sheet value"]
+
+
+def test_a_given_title_wins_and_empty_pages_have_no_content():
+    assert extract_document(NESTED, "u", page_title="From the driver").title == "From the driver"
+    empty = extract_document("  \n", "u", page_title="t")
+    assert (empty.content, empty.title) == ("", "t")
+
+
+def test_lxml_keeps_the_lines_the_soup_walk_finds():
+    loader = SitemapLoader(url="https://example.com/sitemap.xml", extractor="soup")
+    for doc in synthetic_docs(5, paragraphs=3):
+        page = render_html(doc)
+        fast = extract_document(page, doc.source)
+        slow = loader.parse_html(page, doc.source)
+        assert fast.title == slow.title == doc.title
+        lines = fast.content.split("\n")
+        assert len(lines) == len(set(lines))
+        # soup repeats the text of nested blocks once per enclosing tag, lxml keeps it once
+        assert set(lines) <= set(slow.content.split("\n"))
+        assert all(paragraph in lines for paragraph in doc.content.split("\n\n"))
+        assert "footer text" not in fast.content and "Home" not in fast.content
+
+
+def test_unknown_extractor_is_rejected():
+    loader = SitemapLoader(url="https://example.com/sitemap.xml", extractor="regex")
+    with pytest.raises(ValueError, match="Unsupported extractor"):
+        loader.parse_html("<p>text</p>", "u")
+
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_iter_extract_documents_keeps_the_input_order(processes):
+    docs = synthetic_docs(12, paragraphs=1)
+    pages = [(render_html(doc), doc.source, None) for doc in docs]
+    extracted = list(iter_extract_documents(pages, processes=processes, batch_size=5))
+    assert [doc.source for doc in extracted] == [doc.source for doc in docs]
+    assert extracted == [extract_document(*page) for page in pages]
@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+from faiss_vector_index import FAISSVectorIndex
+from index_factory import IndexSpec, build_index, recall_latency_report, train_index
+
+
+def clustered_vectors(n, dim=32, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(20, dim))
+    return (centers[rng.integers(0, 20, n)] + 0.3 * rng.normal(size=(n, dim))).astype(np.float32)
+
+
+def test_factory_strings():
+    assert IndexSpec().factory_string() == "Flat"
+    assert IndexSpec(storage="float16").factory_string() == "SQfp16"
+    assert IndexSpec(kind="ivf_pq", nlist=64, pq_m=8).factory_string() == "IVF64,PQ8x8"
+    assert IndexSpec(kind="hnsw", storage="int8", reduction="pca", reduced_dim=16).factory_string() == "PCA16,HNSW32_SQ8"
+    with pytest.raises(ValueError, match="storage"):
+        IndexSpec(storage="float8").factory_string()
+
+
+def test_training_on_a_small_sample_shrinks_nlist_and_nprobe():
+    spec = IndexSpec(kind="ivf_flat", nlist=1024, nprobe=64)
+    with pytest.warns(UserWarning, match="nlist"):
+        index, spec = train_index(spec, build_index(spec, 32), clustered_vectors(400))
+    assert spec.nlist == 400 // 39
+    assert spec.nprobe == spec.nlist
+    assert index.is_trained
+
+
+def test_report_rows_show_compression_and_what_reranking_wins_back():
+    vectors, queries = clustered_vectors(2000), clustered_vectors(50, seed=1)
+    specs = [IndexSpec(), IndexSpec(kind="sq8"), IndexSpec(kind="ivf_pq", nlist=16, pq_m=4, pq_nbits=4, rerank_k=50)]
+    rows = recall_latency_report(vectors, queries, specs, k=10, nprobes=(16,))
+    by_index = {(row["index"], row["rerank_k"]): row for row in rows}
+
+    assert by_index[("Flat", 0)]["recall_at_k"] == 1.0
+    assert by_index[("SQ8", 0)]["compression"] > 3
+    compressed, reranked = by_index[("IVF16,PQ4x4", 0)], by_index[("IVF16,PQ4x4", 50)]
+    assert compressed["bytes_per_vector"] < by_index[("Flat", 0)]["bytes_per_vector"]
+    assert reranked["recall_at_k"] > compressed["recall_at_k"]
+
+
+@pytest.mark.parametrize("spec", [IndexSpec(storage="float16"), IndexSpec(storage="int8", rerank_k=20),
+                                  IndexSpec(reduction="pca", reduced_dim=16, rerank_k=20, metric="ip")])
+def test_compact_indexes_find_what_the_flat_index_finds(docs, embedder, spec):
+    spec.train_sample_size = len(docs)
+    flat = FAISSVectorIndex.from_documents(docs, False, embedder)
+    compact = FAISSVectorIndex.from_documents(docs, False, embedder, index_spec=spec)
+    hits = sum(compact.retrieve_similar_docs(doc.content, max_docs=1) == flat.retrieve_similar_docs(doc.content,
+                                                                                                   max_docs=1)
+               for doc in docs[:20])
+    assert hits >= 18
@@ -0,0 +1,86 @@
+import io
+import json
+import pytest
+from instrumentation import (Fanout, JSONLogger, MetricsRegistry, configure_from_env, count, get_instrumentation,
+                             metrics_registry, observe, set_instrumentation, span, use_instrumentation)
+
+
+def test_snapshot_counts_and_observes():
+    registry = MetricsRegistry()
+    with use_instrumentation(registry):
+        count("cache.hits", cache="semantic")
+        count("cache.hits", 2, cache="semantic")
+        count("cache.misses", cache="semantic")
+        observe("llm.first_token_seconds", 0.25, purpose="answer")
+        observe("llm.first_token_seconds", 0.75, purpose="answer")
+
+    snapshot = registry.snapshot()
+    assert snapshot["counters"]["cache.hits"] == {(("cache", "semantic"),): 3.0}
+    assert snapshot["counters"]["cache.misses"] == {(("cache", "semantic"),): 1.0}
+    assert snapshot["histograms"]["llm.first_token_seconds"] == {(("purpose", "answer"),): {"count": 2.0,
+                                                                                            "sum": 1.0}}
+
+
+def test_snapshot_records_spans_and_their_errors():
+    registry = MetricsRegistry()
+    with use_instrumentation(registry):
+        with span("retriever.dense_search", shard="0"):
+            pass
+        with pytest.raises(ValueError):
+            with span("retriever.dense_search", shard="0"):
+                raise ValueError("boom")
+
+    snapshot = registry.snapshot()
+    assert snapshot["histograms"]["retriever.dense_search_seconds"][(("shard", "0"),)]["count"] == 2.0
+    assert snapshot["counters"]["retriever.dense_search_errors"] == {(("error", "ValueError"), ("shard", "0")): 1.0}
+
+
+def test_snapshot_is_a_copy():
+    registry = MetricsRegistry()
+    registry.count("service.rejected")
+    snapshot = registry.snapshot()
+    registry.count("service.rejected")
+    assert snapshot["counters"]["service.rejected"] == {(): 1.0}
+    assert registry.counter_value("service.rejected") == 2.0
+
+
+def test_render_prometheus_exposes_counters_and_cumulative_buckets():
+    registry = MetricsRegistry()
+    registry.count("cache.hits", cache="semantic")
+    registry.observe("llm.first_token_seconds", 0.001)
+    registry.observe("llm.first_token_seconds", 1000.0)
+    lines = registry.render_prometheus().splitlines()
+    assert "# TYPE rag_cache_hits_total counter" in lines
+    assert 'rag_cache_hits_total{cache="semantic"} 1.0' in lines
+    assert "rag_llm_first_token_seconds_count 2.0" in lines
+    buckets = [line for line in lines if "_bucket" in line]
+    counts = [float(line.rsplit(" ", 1)[1]) for line in buckets]
+    assert counts == sorted(counts) and counts[0] == 1.0 and counts[-1] == 2.0
+    assert 'le="+Inf"' in buckets[-1]
+
+
+def test_json_logger_links_child_spans_to_their_parent():
+    stream = io.StringIO()
+    with use_instrumentation(JSONLogger(stream)):
+        with span("service.answer"):
+            with span("retriever.search", k=5):
+                pass
+    child, parent = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert (child["span"], parent["span"]) == ("retriever.search", "service.answer")
+    assert child["trace_id"] == parent["trace_id"]
+    assert child["parent_id"] == parent["span_id"] and parent["parent_id"] is None
+    assert child["labels"] == {"k": "5"}
+
+
+def test_configure_from_env_picks_the_exporters():
+    previous = get_instrumentation()
+    try:
+        both = configure_from_env("prometheus, json")
+        assert isinstance(both, Fanout) and metrics_registry() is both.find(MetricsRegistry)
+        assert isinstance(configure_from_env("prometheus"), MetricsRegistry)
+        configure_from_env("")
+        assert metrics_registry() is None
+        with pytest.raises(ValueError, match="Unsupported metrics exporter"):
+            configure_from_env("statsd")
+    finally:
+        set_instrumentation(previous)
@@ -0,0 +1,79 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from faiss_vector_index import FAISSVectorIndex
+from fakes import FakeEmbeddings
+from micro_batcher import MicroBatchingRetriever
+from context_builder import ContextBuilder
+from corpus import synthetic_questions
+from serving import load_service
+
+
+class CountingEmbeddings(FakeEmbeddings):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.document_calls = self.query_calls = 0
+        self._lock = threading.Lock()
+
+    def embed_documents(self, texts):
+        with self._lock:
+            self.document_calls += 1
+        return super().embed_documents(texts)
+
+    def embed_query(self, text):
+        with self._lock:
+            self.query_calls += 1
+        return super().embed_query(text)
+
+
+def ask_concurrently(fn, questions):
+    start = threading.Barrier(len(questions))
+
+    def ask(question):
+        start.wait()
+        return fn(question)
+
+    with ThreadPoolExecutor(max_workers=len(questions)) as pool:
+        return list(pool.map(ask, questions))
+
+
+def test_concurrent_queries_share_one_embedding_request(docs):
+    embedder = CountingEmbeddings(dim=64)
+    index = FAISSVectorIndex.from_documents(docs, False, embedder)
+    embedder.document_calls = 0
+    batcher = MicroBatchingRetriever(retriever=index, max_wait_ms=200)
+    questions = synthetic_questions(8)
+    try:
+        results = ask_concurrently(batcher.retrieve_similar_docs_with_vector, questions)
+    finally:
+        batcher.close()
+
+    assert (embedder.document_calls, embedder.query_calls) == (1, 0)
+    for question, (found, vector) in zip(questions, results):
+        assert found == index.retrieve_similar_docs(question)
+        assert np.allclose(vector, [embedder.embed(question)], atol=1e-6)
+
+
+def test_each_caller_gets_its_own_number_of_documents(docs, embedder):
+    batcher = MicroBatchingRetriever(retriever=FAISSVectorIndex.from_documents(docs, False, embedder), max_wait_ms=200)
+    try:
+        results = ask_concurrently(lambda max_docs: batcher.retrieve_similar_docs("release notes", max_docs), [1, 3, 5])
+    finally:
+        batcher.close()
+    assert [len(found) for found in results] == [1, 3, 5]
+    assert results[0] == results[2][:1]
+
+
+def test_the_service_batches_retrieval(docs, chat_client, tmp_path):
+    embedder = CountingEmbeddings(dim=64)
+    FAISSVectorIndex.from_documents(docs, False, embedder).save_local(tmp_path)
+    service = load_service(str(tmp_path), embedder=embedder, client=chat_client, batch_wait_ms=200,
+                           context_builder=ContextBuilder(encoding_name=None))
+    embedder.document_calls = 0
+    try:
+        assert isinstance(service.generator.retriever, MicroBatchingRetriever)
+        ask_concurrently(lambda question: service.ask(question), synthetic_questions(6))
+    finally:
+        service.generator.retriever.close()
+        service.close()
+    assert (embedder.document_calls, embedder.query_calls) == (1, 0)
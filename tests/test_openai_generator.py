@@ -0,0 +1,95 @@
+import asyncio
+from types import SimpleNamespace
+import pytest
+from context_builder import ContextBuilder
+from faiss_vector_index import FAISSVectorIndex
+from fakes import FakeChatClient
+from instrumentation import MetricsRegistry, use_instrumentation
+from openai_generator import OpenAIGenerator
+
+
+def make_generator(docs, embedder, client, **kwargs):
+    # the estimating token counter, so no tokenizer files have to be downloaded
+    return OpenAIGenerator(retriever=FAISSVectorIndex.from_documents(docs, False, embedder), client=client,
+                           context_builder=ContextBuilder(encoding_name=None), **kwargs)
+
+
+class UsageChatClient(FakeChatClient):
+    # streams like the real API: a role-only delta first and a usage chunk without choices last
+    def stream(self):
+        yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=None))])
+        yield from super().stream()
+        yield SimpleNamespace(choices=[], usage=SimpleNamespace(prompt_tokens=10, completion_tokens=5))
+
+
+def test_answers_stream_token_by_token(docs, embedder):
+    client = UsageChatClient(latency=0.0)
+    generator = make_generator(docs, embedder, client)
+    tokens = list(generator.generate_answer_stream("What is topic 3?", []))
+    assert len(tokens) > 1
+    assert "".join(tokens) == client.answer
+    assert client.calls == 1
+
+
+def test_a_failing_stream_raises_to_the_caller(docs, embedder, chat_client):
+    def fail(**kwargs):
+        raise ValueError("model unavailable")
+
+    chat_client.chat.completions.create = fail
+    generator = make_generator(docs, embedder, chat_client)
+    with pytest.raises(ValueError, match="model unavailable"):
+        list(generator.generate_answer_stream("What is topic 3?", []))
+
+
+class AsyncChatClient:
+    """Async stand-in for client.chat.completions.create, rewrites return rewrite or else the follow up unchanged."""
+
+    def __init__(self, answer="An async answer.", rewrite=None):
+        self.answer = answer
+        self.rewrite = rewrite
+        self.prompts = []
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    async def create(self, model, messages, stream=False, **kwargs):
+        prompt = messages[-1]["content"]
+        self.prompts.append(prompt)
+        content = self.answer
+        if "Standalone question:" in prompt:
+            content = self.rewrite or prompt.split("Follow Up Input: ")[1].split("\n")[0]
+        if stream:
+            return self.stream(content)
+        await asyncio.sleep(0.01)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+    async def stream(self, content):
+        for word in content.split(" "):
+            await asyncio.sleep(0)
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=word + " "))])
+
+
+@pytest.mark.parametrize("rewrite, used", [(None, True), ("A different standalone question?", False)])
+def test_the_speculative_retrieval_is_used_when_the_rewrite_keeps_the_question(docs, embedder, chat_client,
+                                                                               rewrite, used):
+    generator = make_generator(docs, embedder, chat_client, async_client=AsyncChatClient(rewrite=rewrite))
+    registry = MetricsRegistry()
+    with use_instrumentation(registry):
+        answer = asyncio.run(generator.aanswer_user_question("What is topic 3?", [("hi", "hello")]))
+    assert answer == "An async answer."
+    assert registry.counter_value("generator.speculative_retrievals", used=used) == 1
+    assert chat_client.calls == 0
+
+
+def test_concurrent_async_questions_share_the_client(docs, embedder, chat_client):
+    client = AsyncChatClient()
+    generator = make_generator(docs, embedder, chat_client, async_client=client)
+
+    async def run():
+        answers = await asyncio.gather(*[generator.aanswer_user_question(f"What is topic {i}?", [])
+                                         for i in range(5)])
+        streamed = [token async for token in generator.aanswer_user_question_stream("What is topic 3?", [])]
+        return answers, streamed
+
+    answers, streamed = asyncio.run(run())
+    assert answers == ["An async answer."] * 5
+    assert "".join(streamed).strip() == "An async answer."
+    assert len(client.prompts) == 6
@@ -0,0 +1,34 @@
+import json
+import sys
+import pytest
+import pipeline_benchmark
+
+
+def test_main_keeps_stdout_for_the_json_report(monkeypatch, capsys):
+    def noisy_benchmark_size(args, size, work_dir):
+        print(f"Split {size} documents into {size} documents.")
+        return [{"stage": "split", "docs": size, "seconds": 0.1}]
+
+    monkeypatch.setattr(pipeline_benchmark, "benchmark_size", noisy_benchmark_size)
+    monkeypatch.setattr(sys, "argv", ["pipeline_benchmark.py", "--sizes", "10", "20"])
+    with pytest.raises(SystemExit) as exit_info:
+        pipeline_benchmark.main()
+    assert exit_info.value.code == 0
+    out, err = capsys.readouterr()
+    report = json.loads(out)
+    assert [row["docs"] for row in report["results"]] == [10, 20]
+    assert "Split 10 documents" in err
+
+
+def test_main_flags_regressions_against_a_baseline(monkeypatch, capsys, tmp_path):
+    baseline = tmp_path / "baseline.json"
+    baseline.write_text(json.dumps({"results": [{"stage": "split", "docs": 10, "seconds": 0.1}]}))
+    monkeypatch.setattr(pipeline_benchmark, "benchmark_size",
+                        lambda args, size, work_dir: [{"stage": "split", "docs": size, "seconds": 0.5}])
+    monkeypatch.setattr(sys, "argv", ["pipeline_benchmark.py", "--sizes", "10", "--baseline", str(baseline)])
+    with pytest.raises(SystemExit) as exit_info:
+        pipeline_benchmark.main()
+    assert exit_info.value.code == 1
+    out, err = capsys.readouterr()
+    assert json.loads(out)["regressions"][0]["stage"] == "split"
+    assert "Regression: split on 10 docs" in err
@@ -0,0 +1,93 @@
+import threading
+import semantic_cache as semantic_cache_module
+from context_builder import ContextBuilder
+from document import Document
+from faiss_vector_index import FAISSVectorIndex
+from fakes import FakeEmbeddings
+from openai_generator import OpenAIGenerator
+from semantic_cache import SemanticCache, chunk_ids
+
+
+class CountingEmbeddings(FakeEmbeddings):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.query_calls = 0
+        self._lock = threading.Lock()
+
+    def embed_query(self, text):
+        with self._lock:
+            self.query_calls += 1
+        return super().embed_query(text)
+
+
+def store(cache, question, docs, answer="answer"):
+    cache.store(cache.embed(question), chunk_ids(docs), docs, answer, 1.0)
+
+
+def test_hits_need_a_close_question_and_the_same_chunks(embedder):
+    cache = SemanticCache(embedder=embedder)
+    docs = [Document(content="chunk one", source="https://example.com/a")]
+    store(cache, "how do I reset my password", docs, "use the reset link")
+
+    assert cache.lookup(cache.embed("How do I reset my password?"), chunk_ids(docs)) == "use the reset link"
+    assert cache.lookup(cache.embed("where is the billing page"), chunk_ids(docs)) is None
+    changed = [Document(content="chunk one, edited", source="https://example.com/a")]
+    assert cache.lookup(cache.embed("how do I reset my password"), chunk_ids(changed)) is None
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_expired_entries_miss_and_are_dropped(embedder, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(semantic_cache_module.time, "time", lambda: now[0])
+    cache = SemanticCache(embedder=embedder, ttl_seconds=60)
+    docs = [Document(content="chunk", source="https://example.com/a")]
+    store(cache, "question", docs)
+
+    now[0] += 30
+    assert cache.lookup(cache.embed("question"), chunk_ids(docs)) == "answer"
+    now[0] += 31
+    assert cache.lookup(cache.embed("question"), chunk_ids(docs)) is None
+    assert cache.metrics()["entries"] == 0
+
+
+def test_the_least_recently_used_entry_is_evicted(embedder):
+    cache = SemanticCache(embedder=embedder, max_entries=2)
+    docs = {name: [Document(content=name, source=f"https://example.com/{name}")] for name in "abc"}
+    store(cache, "question about apples", docs["a"], "a")
+    store(cache, "question about bananas", docs["b"], "b")
+    # reading a makes b the least recently used one
+    assert cache.lookup(cache.embed("question about apples"), chunk_ids(docs["a"])) == "a"
+    store(cache, "question about cherries", docs["c"], "c")
+
+    assert cache.metrics()["entries"] == 2
+    assert cache.lookup(cache.embed("question about bananas"), chunk_ids(docs["b"])) is None
+    assert cache.lookup(cache.embed("question about apples"), chunk_ids(docs["a"])) == "a"
+    assert cache.lookup(cache.embed("question about cherries"), chunk_ids(docs["c"])) == "c"
+
+
+def test_invalidating_a_source_drops_its_answers(embedder):
+    cache = SemanticCache(embedder=embedder)
+    a = [Document(content="a", source="https://example.com/a")]
+    both = a + [Document(content="b", source="https://example.com/b")]
+    store(cache, "first question", a)
+    store(cache, "second question", both)
+    store(cache, "third question", [Document(content="c", source="https://example.com/c")])
+
+    assert cache.invalidate_sources(["https://example.com/a"]) == 2
+    assert cache.metrics()["entries"] == 1
+
+
+def test_a_cached_answer_skips_the_completion_and_the_second_embedding(docs, chat_client):
+    embedder = CountingEmbeddings(dim=64)
+    generator = OpenAIGenerator(retriever=FAISSVectorIndex.from_documents(docs, False, embedder), client=chat_client,
+                                context_builder=ContextBuilder(encoding_name=None),
+                                semantic_cache=SemanticCache(embedder=embedder))
+    embedder.query_calls = 0
+
+    first = generator.generate_answer("What is topic 3?", [])
+    second = generator.generate_answer("what is topic 3", [])
+    assert first == second == chat_client.answer
+    assert chat_client.calls == 1
+    # one embedding per question, shared by the retriever and the cache
+    assert embedder.query_calls == 2
+    assert generator.semantic_cache.hits == 1
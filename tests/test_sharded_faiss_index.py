@@ -0,0 +1,95 @@
+import threading
+import pytest
+from faiss_vector_index import FAISSVectorIndex
+from sharded_faiss_index import ShardedFAISSIndex
+from corpus import synthetic_questions
+from fakes import FakeEmbeddings
+
+
+def results(index, query, **kwargs):
+    return [(scored.document.source, round(scored.score, 4))
+            for scored in index.retrieve_scored_docs(query, max_docs=5, **kwargs)]
+
+
+@pytest.mark.parametrize("search_mode", ["dense", "lexical", "hybrid"])
+def test_shards_return_what_a_single_index_returns(docs, embedder, search_mode):
+    single = FAISSVectorIndex.from_documents(docs, False, embedder, search_mode=search_mode)
+    sharded = ShardedFAISSIndex.from_documents(docs, False, embedder, num_shards=3, search_mode=search_mode)
+    assert sum(len(shard.docstore) for shard in sharded.shards) == len(single.docstore)
+    for query in synthetic_questions(10):
+        assert results(sharded, query) == results(single, query)
+
+
+def test_filters_and_deletes_match(docs, embedder):
+    single = FAISSVectorIndex.from_documents(docs, False, embedder)
+    sharded = ShardedFAISSIndex.from_documents(docs, False, embedder, num_shards=3)
+    sources = [doc.source for doc in docs[:4]]
+    query = synthetic_questions(1)[0]
+    assert results(sharded, query, filter={"source": sources}) == results(single, query, filter={"source": sources})
+
+    assert sharded.delete_documents(sources[:2]) == single.delete_documents(sources[:2])
+    assert results(sharded, query) == results(single, query)
+
+
+def test_save_and_load_keep_the_results(docs, embedder, tmp_path):
+    sharded = ShardedFAISSIndex.from_documents(docs, False, embedder, num_shards=3)
+    sharded.save_local(tmp_path)
+    loaded = ShardedFAISSIndex.load_local(tmp_path, embedder)
+    for query in synthetic_questions(5):
+        assert results(loaded, query) == results(sharded, query)
+
+
+class CountingEmbeddings(FakeEmbeddings):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.document_calls = self.query_calls = 0
+        self._lock = threading.Lock()
+
+    def embed_documents(self, texts):
+        with self._lock:
+            self.document_calls += 1
+        return super().embed_documents(texts)
+
+    def embed_query(self, text):
+        with self._lock:
+            self.query_calls += 1
+        return super().embed_query(text)
+
+
+def test_empty_shards_take_the_dimension_of_a_built_one(docs):
+    embedder = CountingEmbeddings(dim=64)
+    sharded = ShardedFAISSIndex.from_documents(docs[:2], False, embedder, num_shards=8)
+    assert embedder.query_calls == 0
+    assert sum(shard.index.ntotal == 0 for shard in sharded.shards) >= 6
+    assert {shard.index.d for shard in sharded.shards} == {64}
+    assert results(sharded, docs[0].content)[0][0] == docs[0].source
+
+    empty = next(i for i, shard in enumerate(sharded.shards) if shard.index.ntotal == 0)
+    assert sharded.rebuild_shard(empty, docs[:2], False).index.d == 64
+    assert embedder.query_calls == 1
+
+
+def test_shards_are_built_while_the_pages_are_read(docs):
+    embedder = CountingEmbeddings(dim=64)
+    embedded_before_the_end = []
+
+    def pages():
+        yield from docs[:-1]
+        embedded_before_the_end.append(embedder.document_calls)
+        yield docs[-1]
+
+    sharded = ShardedFAISSIndex.from_documents(pages(), False, embedder, num_shards=3, prefetch=2,
+                                               max_batch_tokens=1)
+    assert sum(len(shard.docstore) for shard in sharded.shards) == len(docs)
+    assert embedded_before_the_end[0] > 0
+
+
+def test_a_failing_input_stops_every_shard(docs, embedder):
+    def pages():
+        yield from docs[:10]
+        raise OSError("crawl failed")
+
+    with pytest.raises(OSError, match="crawl failed"):
+        ShardedFAISSIndex.from_documents(pages(), False, embedder, num_shards=3, prefetch=2)
+    with pytest.raises(ValueError, match="without any documents"):
+        ShardedFAISSIndex.from_documents([], False, embedder, num_shards=3)
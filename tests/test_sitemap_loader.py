@@ -0,0 +1,150 @@
+import asyncio
+import time
+import httpx
+from async_crawler import HostRateLimiter, RobotsCache
+from crawl_manifest import CrawlDiff, CrawlManifest, ManifestEntry
+from document import Document
+from faiss_vector_index import FAISSVectorIndex
+from semantic_cache import SemanticCache, chunk_ids
+from sitemap_loader import SitemapLoader
+
+
+class CountingLoader(SitemapLoader):
+    fetched: int = 0
+
+    async def crawl_url(self, client, url, limiter, robots, drivers):
+        self.fetched += 1
+        return Document(content=f"page {url}", source=url)
+
+
+def test_the_async_crawl_stops_fetching_while_the_consumer_is_behind():
+    loader = CountingLoader(url="https://example.com/sitemap.xml", crawl_mode="async", max_connections=2,
+                            prefetch=4, respect_robots=False)
+    urls = [f"https://example.com/{i}" for i in range(200)]
+    stream = loader.stream_documents(urls)
+    try:
+        first = next(stream)
+        time.sleep(0.3)
+        # the document read, prefetch in the handoff, one waiting to get into it, prefetch queued by the
+        # crawl and one held by each worker
+        assert loader.fetched <= 1 + loader.prefetch + 1 + loader.prefetch + loader.max_connections
+        docs = [first] + list(stream)
+    finally:
+        stream.close()
+    assert len(docs) == len(urls)
+    assert loader.fetched == len(urls)
+
+
+PAGE = "<html><head><title>Page {n}</title></head><body><p>{text}</p></body></html>"
+
+
+def mock_client(routes, requests=None):
+    # serves routes {path -> (status, body, headers)}, anything else is a 404
+    def handle(request):
+        if requests is not None:
+            requests.append(request)
+        status, body, headers = routes.get(request.url.path, (404, "", {}))
+        return httpx.Response(status, text=body, headers={"content-type": "text/html", **headers})
+
+    return httpx.AsyncClient(transport=httpx.MockTransport(handle))
+
+
+def test_crawl_url_parses_static_pages_and_respects_robots():
+    loader = SitemapLoader(url="https://example.com/sitemap.xml", crawl_mode="async")
+    routes = {"/robots.txt": (200, "User-agent: *\nDisallow: /private", {}),
+              "/docs": (200, PAGE.format(n=1, text="Static page text " * 20), {}),
+              "/private": (200, PAGE.format(n=2, text="secret"), {})}
+
+    async def run():
+        async with mock_client(routes) as client:
+            robots = RobotsCache(client, loader.user_agent)
+            limiter = HostRateLimiter()
+            return [await loader.crawl_url(client, f"https://example.com{path}", limiter, robots, None)
+                    for path in ["/docs", "/private", "/missing"]]
+
+    docs, private, missing = asyncio.run(run())
+    assert docs.title == "Page 1"
+    assert docs.source == "https://example.com/docs"
+    assert "Static page text" in docs.content
+    assert private is None
+    assert missing is None
+
+
+def test_host_rate_limiter_caps_concurrent_requests_per_host():
+    limiter = HostRateLimiter(per_host_concurrency=2)
+    active, peak = {}, {}
+
+    async def fetch(url):
+        host = url.split("/")[2]
+        async with limiter.slot(url):
+            active[host] = active.get(host, 0) + 1
+            peak[host] = max(peak.get(host, 0), active[host])
+            await asyncio.sleep(0.01)
+            active[host] -= 1
+
+    async def run():
+        await asyncio.gather(*[fetch(f"https://{host}/{i}") for host in ["a.com", "b.com"] for i in range(8)])
+
+    asyncio.run(run())
+    assert peak == {"a.com": 2, "b.com": 2}
+
+
+def refresh(loader, manifest, entries, routes, requests=None):
+    async def run():
+        async with mock_client(routes, requests) as client:
+            return [await loader.refresh_url(client, entry, HostRateLimiter(), None, None, manifest=manifest)
+                    for entry in entries]
+
+    return asyncio.run(run())
+
+
+def test_refresh_skips_pages_whose_lastmod_etag_or_content_did_not_change():
+    loader = SitemapLoader(url="https://example.com/sitemap.xml", crawl_mode="async")
+    text = "Unchanged page text " * 20
+    routes = {"/a": (200, PAGE.format(n=1, text=text), {"etag": '"v1"'}),
+              "/b": (200, PAGE.format(n=2, text=text), {})}
+    manifest = CrawlManifest()
+    entries = [("https://example.com/a", "2024-01-01"), ("https://example.com/b", None)]
+    assert [status for status, _ in refresh(loader, manifest, entries, routes)] == ["changed", "changed"]
+
+    # same lastmod: no request at all. No lastmod: fetched again, but the content hash matches
+    requests = []
+    assert [status for status, _ in refresh(loader, manifest, entries, routes, requests)] == ["unchanged", "unchanged"]
+    assert [request.url.path for request in requests] == ["/b"]
+
+    # a new lastmod sends the etag and a 304 keeps the page
+    requests = []
+    routes["/a"] = (304, "", {})
+    entries[0] = ("https://example.com/a", "2024-02-01")
+    assert refresh(loader, manifest, entries[:1], routes, requests) == [("unchanged", None)]
+    assert requests[0].headers["If-None-Match"] == '"v1"'
+    assert manifest.entries["https://example.com/a"].lastmod == "2024-02-01"
+
+    routes["/b"] = (200, PAGE.format(n=2, text="Edited page text " * 20), {})
+    [(status, doc)] = refresh(loader, manifest, entries[1:], routes)
+    assert status == "changed"
+    assert "Edited page text" in doc.content
+
+
+def test_refresh_index_applies_the_diff_and_invalidates_cached_answers(docs, embedder, tmp_path):
+    changed = docs[1].copy(update={"content": "Rewritten " + docs[1].content})
+
+    class StaticLoader(SitemapLoader):
+        def refresh_documents(self, manifest):
+            manifest.entries[changed.source] = ManifestEntry(lastmod="2024-01-01")
+            return CrawlDiff(deleted=[docs[0].source], changed=[changed])
+
+    index = FAISSVectorIndex.from_documents(docs, False, embedder)
+    cache = SemanticCache(embedder=embedder)
+    for doc in docs[:3]:
+        cache.store(cache.embed(doc.content), chunk_ids([doc]), [doc], "answer", 1.0)
+    manifest_path = tmp_path / "manifest.json"
+
+    diff = StaticLoader(url="https://example.com/sitemap.xml").refresh_index(index, manifest_path, split_docs=False,
+                                                                              semantic_cache=cache)
+    assert diff.deleted == [docs[0].source]
+    assert index.docstore.ids_for_sources([docs[0].source]) == []
+    [row] = index.docstore.ids_for_sources([docs[1].source])
+    assert index.docstore.search(row).content == changed.content
+    assert cache.metrics()["entries"] == 1
+    assert list(CrawlManifest.load(manifest_path).entries) == [changed.source]
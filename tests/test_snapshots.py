@@ -0,0 +1,137 @@
+import os
+import time
+import pytest
+import snapshots
+from faiss_vector_index import FAISSVectorIndex
+from sharded_faiss_index import ShardedFAISSIndex
+from snapshots import SnapshotCorrupted, SnapshotManager, SnapshotRetriever
+
+
+@pytest.fixture
+def index(docs, embedder):
+    return FAISSVectorIndex.from_documents(docs, False, embedder)
+
+
+def largest_file(manager, version):
+    files = manager.manifest(version)["files"]
+    return manager.snapshot_path(version) / max(files, key=lambda name: files[name]["bytes"])
+
+
+def flip_byte(path):
+    # same size, different content, so only a checksum notices
+    data = bytearray(path.read_bytes())
+    data[len(data) // 2] ^= 0xFF
+    path.write_bytes(bytes(data))
+
+
+def count_checksums(monkeypatch):
+    calls = []
+    real_sha256 = snapshots.file_sha256
+
+    def recording_sha256(path):
+        calls.append(path)
+        return real_sha256(path)
+
+    monkeypatch.setattr(snapshots, "file_sha256", recording_sha256)
+    return calls
+
+
+def test_publish_points_current_at_a_verified_snapshot(index, embedder, tmp_path, docs):
+    manager = SnapshotManager(root=str(tmp_path))
+    version = manager.publish(index, version="v1")
+    assert SnapshotManager.is_snapshot_root(tmp_path)
+    assert manager.current_version() == "v1" and manager.versions() == ["v1"]
+    assert manager.manifest(version)["retriever"] == "FAISSVectorIndex"
+    manager.verify(version)
+    loaded_version, loaded = SnapshotManager(root=str(tmp_path)).load(embedder)
+    assert loaded_version == "v1"
+    assert loaded.retrieve_similar_docs(docs[3].content, 1)[0].source == docs[3].source
+    with pytest.raises(OSError):
+        manager.publish(index, version="v1")
+
+
+def test_the_first_load_checksums_and_later_loads_check_sizes(index, embedder, tmp_path, monkeypatch):
+    SnapshotManager(root=str(tmp_path)).publish(index, version="v1")
+    manager = SnapshotManager(root=str(tmp_path))
+    calls = count_checksums(monkeypatch)
+    manager.load(embedder)
+    assert len(calls) == len(manager.manifest("v1")["files"])
+    manager.load(embedder)
+    assert len(calls) == len(manager.manifest("v1")["files"])
+    manager.load(embedder, checksums=True)
+    assert len(calls) == 2 * len(manager.manifest("v1")["files"])
+
+
+def test_a_corrupted_snapshot_is_caught_on_its_first_load(index, embedder, tmp_path):
+    SnapshotManager(root=str(tmp_path)).publish(index, version="v1")
+    manager = SnapshotManager(root=str(tmp_path))
+    flip_byte(largest_file(manager, "v1"))
+    manager.verify("v1", checksums=False)
+    with pytest.raises(SnapshotCorrupted, match="v1"):
+        manager.load(embedder)
+    # a missing file is caught by the size check alone
+    damaged = largest_file(manager, "v1")
+    damaged.unlink()
+    with pytest.raises(SnapshotCorrupted, match=damaged.name):
+        manager.load(embedder, checksums=False)
+
+
+def test_gc_keeps_the_newest_and_the_current_snapshot(index, tmp_path):
+    manager = SnapshotManager(root=str(tmp_path), keep_last=2)
+    for version in ["v1", "v2", "v3", "v4"]:
+        manager.publish(index, version=version)
+    assert manager.versions() == ["v3", "v4"]
+    # a rollback keeps the snapshot it rolled back to
+    manager.set_current("v3")
+    manager.keep_last = 1
+    assert manager.gc() == []
+    manager.publish(index, version="v5")
+    assert manager.versions() == ["v5"]
+    with pytest.raises(ValueError, match="No snapshot v1"):
+        manager.set_current("v1")
+
+
+def test_gc_keeps_snapshots_younger_than_keep_seconds(index, tmp_path):
+    manager = SnapshotManager(root=str(tmp_path), keep_last=1, keep_seconds=3600)
+    for version in ["v1", "v2", "v3"]:
+        manager.publish(index, version=version)
+    assert manager.versions() == ["v1", "v2", "v3"]
+    manager.keep_seconds = 0
+    assert manager.gc() == ["v1", "v2"]
+
+
+def test_gc_removes_stale_unfinished_snapshots(index, tmp_path):
+    manager = SnapshotManager(root=str(tmp_path))
+    manager.publish(index, version="v1")
+    stale, fresh = manager.snapshots_dir / ".tmp-v0", manager.snapshots_dir / ".tmp-v2"
+    stale.mkdir()
+    fresh.mkdir()
+    old = time.time() - 2 * snapshots.STALE_TMP_SECONDS
+    os.utime(stale, (old, old))
+    manager.gc()
+    assert not stale.exists() and fresh.exists()
+
+
+def test_snapshot_retriever_swaps_in_published_snapshots(docs, embedder, tmp_path):
+    manager = SnapshotManager(root=str(tmp_path))
+    manager.publish(FAISSVectorIndex.from_documents(docs[:30], False, embedder), version="v1")
+    retriever = SnapshotRetriever(snapshots=manager, embedder=embedder, reload_interval=0)
+    assert retriever.version == "v1"
+    assert retriever.reload() is False
+    manager.publish(ShardedFAISSIndex.from_documents(docs, False, embedder, num_shards=2), version="v2")
+    assert retriever.retrieve_similar_docs(docs[45].content, 1)[0].source != docs[45].source
+    assert retriever.reload() is True
+    assert retriever.version == "v2" and isinstance(retriever.retriever, ShardedFAISSIndex)
+    assert retriever.retrieve_similar_docs(docs[45].content, 1)[0].source == docs[45].source
+
+
+def test_a_snapshot_that_fails_to_load_leaves_the_active_one_serving(index, embedder, tmp_path):
+    manager = SnapshotManager(root=str(tmp_path))
+    manager.publish(index, version="v1")
+    retriever = SnapshotRetriever(snapshots=manager, embedder=embedder, reload_interval=0)
+    manager.publish(index, version="v2")
+    # a fresh manager, as in another process that hasn't verified v2 yet
+    retriever.snapshots = SnapshotManager(root=str(tmp_path))
+    flip_byte(largest_file(manager, "v2"))
+    retriever.reload_in_background()
+    assert retriever.version == "v1"
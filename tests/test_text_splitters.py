@@ -0,0 +1,30 @@
+from corpus import synthetic_docs
+from document import Document
+from text_splitters import DocumentSplitter
+
+
+def test_chunk_offsets_point_back_into_the_page():
+    pages = synthetic_docs(5, paragraphs=6)
+    chunks = DocumentSplitter(chunk_size=200, chunk_overlap=40).split_documents(pages)
+    by_source = {page.source: page for page in pages}
+    assert len(chunks) > len(pages)
+    for chunk in chunks:
+        page = by_source[chunk.source]
+        assert page.content[chunk.start_index:chunk.end_index] == chunk.content
+        assert chunk.title == page.title
+
+
+def test_offsets_of_an_already_split_document_are_relative_to_its_page():
+    page = Document(content="intro " * 100 + "the part that matters " * 20, source="https://example.com/a")
+    part = Document(content=page.content[600:], source=page.source, start_index=600)
+    for chunk in DocumentSplitter(chunk_size=100, chunk_overlap=0).split_document(part):
+        assert page.content[chunk.start_index:chunk.end_index] == chunk.content
+
+
+def test_the_process_pool_splits_like_a_single_process(capsys):
+    pages = synthetic_docs(20, paragraphs=4)
+    single = DocumentSplitter(chunk_size=300, chunk_overlap=50).split_documents(pages)
+    pooled = DocumentSplitter(chunk_size=300, chunk_overlap=50, processes=2, batch_chars=2000).split_documents(pages)
+    assert pooled == single
+    # progress goes to stderr so stdout stays usable for reports
+    assert capsys.readouterr().out == ""